@@ -5,22 +5,37 @@ import streamlit as st
 import pandas as pd
 from scipy import stats
 import numpy as np
-import math
 import io
 import uuid
+import codecs
 import copy
+import functools
+import contextlib
+import hashlib
 import zipfile
 import duckdb
 import time
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict
 import os
 import shutil
+import tempfile
+import warnings
+import colorsys
 import matplotlib.pyplot as plt
+from matplotlib.cbook import boxplot_stats
+from matplotlib.colors import to_rgb
+from matplotlib.lines import Line2D
+from matplotlib.patches import Rectangle
 import seaborn as sns
 import base64
 
+# O DuckDB 0.10 lê colunas ``string[pyarrow]`` por um atributo que o pandas 2.2
+# marcou como obsoleto; o aviso sairia a cada ``register`` do DataFrame.
+warnings.filterwarnings("ignore", message="ArrowStringArray._data is a deprecated", category=FutureWarning)
+
 # --- PAGE CONFIGURATION & THEME ---
 st.set_page_config(
     page_title="DataSift",
@@ -35,7 +50,9 @@ from security import audit, ratelimit, sanitize, tenancy, ui as security_ui  # n
 from security.guard import hide_admin_nav, require_login, require_permission  # noqa: E402
 from security.models import PERM_DATA_EXPORT, PERM_DATA_UPLOAD  # noqa: E402
 from security.sanitize import safe_filename  # noqa: E402
-from security.uploads import secure_tempfile, validate_upload  # noqa: E402
+from security.uploads import SessionFile, secure_tempfile, validate_upload  # noqa: E402
+from engine import export, haeckel, harris_boyd, numeric, readers, sniff, summary, upload_cache, xlsx  # noqa: E402
+from engine.dataset import derived_key  # noqa: E402
 
 
 def guard_processing(user) -> bool:
@@ -297,6 +314,79 @@ DEFAULT_FILTERS = [
 ]
 
 # --- PROCESSING ENGINE CLASSES ---
+def _numeric_cast_sql(col: str) -> str:
+    """Leitura numérica de uma coluna citada: vírgula decimal aceita, inválido vira NULL."""
+    return f"TRY_CAST(REPLACE(CAST({col} AS VARCHAR), ',', '.') AS DOUBLE)"
+
+# Teto de memória do DuckDB no modo streaming. O processo do Streamlit Cloud é
+# compartilhado por todos os laboratórios: uma exportação grande não pode
+# levar a memória inteira junto.
+STREAM_MEMORY_LIMIT = "1GB"
+
+class RuleMaskCache:
+    """
+    Máscaras do filtro, uma por regra, guardadas na sessão do usuário.
+
+    A chave é a impressão digital da planilha mais o SQL da própria regra, que
+    já codifica coluna, operadores, valores e a condição de idade/sexo. Ao
+    editar ou religar uma regra, só ela volta ao DuckDB; as demais saem daqui
+    e o resultado final é o AND das máscaras. Cada máscara fica compactada em
+    bits (``np.packbits``): 5 milhões de linhas ocupam ~600 KB por regra.
+
+    Fica em ``st.session_state``, nunca em cache global: a máscara é derivada
+    dos dados de um laboratório e não pode ser servida a outro.
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, fingerprint: str, rule_sql: str, n_rows: int) -> Optional[np.ndarray]:
+        key = (fingerprint, rule_sql)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != n_rows:
+            return None
+        self._entries.move_to_end(key)
+        return np.unpackbits(entry[1], count=n_rows).view(bool)
+
+    def put(self, fingerprint: str, rule_sql: str, keep: np.ndarray) -> None:
+        key = (fingerprint, rule_sql)
+        self._entries[key] = (len(keep), np.packbits(keep))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class NumericViewCache:
+    """
+    Colunas da visão numérica (``build_numeric_view``), uma por
+    ``(impressão digital, coluna)``, guardadas na sessão do usuário.
+
+    A decisão "parece numérica" é tomada coluna a coluna, então cada coluna é
+    convertida uma vez por planilha e o filtro e a estratificação reaproveitam
+    a conversão a cada clique. Coluna que não parece numérica também fica
+    registrada (``None``), para não ser sondada de novo. Mesmo desenho do
+    ``RuleMaskCache``.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, fingerprint: str, column: str) -> Tuple[bool, Optional[pd.Series]]:
+        """``(encontrada, coluna numérica ou None)``."""
+        key = (fingerprint, column)
+        if key not in self._entries:
+            return False, None
+        self._entries.move_to_end(key)
+        return True, self._entries[key]
+
+    def put(self, fingerprint: str, column: str, values: Optional[pd.Series]) -> None:
+        key = (fingerprint, column)
+        self._entries[key] = values
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
 @st.cache_resource
 def get_data_processor():
     return DataProcessor()
@@ -317,8 +407,32 @@ class DataProcessor:
     usada antes e reescrevia a cláusula WHERE.
     """
 
-    def _build_single_sql_cond(self, col: str, op: str, val: Any) -> str:
-        """``col`` já deve chegar citado por ``sanitize.safe_column_ref``."""
+    def _column_refs(self, name: Any, allowed_columns, numeric_view: Optional[pd.DataFrame] = None):
+        """
+        Devolve ``(col, num_col)`` prontos para o SQL, ou ``(None, None)``.
+
+        ``col`` é a coluna da planilha, conferida e citada por
+        ``sanitize.safe_column_ref``. ``num_col`` é a mesma coluna na visão
+        numérica (ver ``build_numeric_view``), ou ``None`` quando a coluna não
+        tem versão numérica. As duas vêm qualificadas pela tabela porque, com a
+        visão presente, os mesmos nomes existem dos dois lados do POSITIONAL JOIN.
+        """
+        resolved = sanitize.resolve_column(name, allowed_columns)
+        safe_col = sanitize.safe_column_ref(name, allowed_columns)
+        if resolved is None or safe_col is None:
+            return None, None
+        num_col = None
+        if numeric_view is not None and resolved in numeric_view.columns:
+            num_col = f"num_df.{safe_col}"
+        return f"local_df.{safe_col}", num_col
+
+    def _build_single_sql_cond(self, col: str, op: str, val: Any, num_col: Optional[str] = None) -> str:
+        """
+        ``col`` já deve chegar citado por ``sanitize.safe_column_ref``.
+
+        ``num_col``, quando presente, é a coluna já convertida da visão
+        numérica e substitui o ``TRY_CAST`` em texto nas comparações numéricas.
+        """
         if not col:
             return "FALSE"
 
@@ -334,7 +448,7 @@ class DataProcessor:
 
         v_num = sanitize.safe_number(val)
         if v_num is not None:
-            safe_cast = f"TRY_CAST(REPLACE(CAST({col} AS VARCHAR), ',', '.') AS DOUBLE)"
+            safe_cast = num_col or _numeric_cast_sql(col)
             return f"({safe_cast} IS NOT NULL AND {safe_cast} {sql_op} {v_num})"
 
         try:
@@ -343,16 +457,16 @@ class DataProcessor:
             return "FALSE"
         return f"(CAST({col} AS VARCHAR) IS NOT NULL AND LOWER(TRIM(CAST({col} AS VARCHAR))) {sql_op} {v_str})"
 
-    def _create_main_sql(self, f: Dict, col: str, allowed_columns) -> str:
+    def _create_main_sql(self, f: Dict, col: str, allowed_columns, numeric_view: Optional[pd.DataFrame] = None) -> str:
         op1, val1 = f.get('p_op1'), f.get('p_val1')
-        safe_col = sanitize.safe_column_ref(col, allowed_columns)
+        safe_col, num_col = self._column_refs(col, allowed_columns, numeric_view)
         if safe_col is None:
             # Coluna que não existe no arquivo carregado. Antes isso virava um
             # identificador arbitrário dentro da consulta.
             return "FALSE"
 
         if not f.get('p_expand'):
-            return self._build_single_sql_cond(safe_col, op1, val1)
+            return self._build_single_sql_cond(safe_col, op1, val1, num_col)
 
         op_central = sanitize.normalize_logical_operator(f.get('p_op_central', ''))
         if op_central is None:
@@ -365,42 +479,78 @@ class DataProcessor:
             if v1_num is None or v2_num is None:
                 return "FALSE"
             min_v, max_v = sorted([v1_num, v2_num])
-            safe_cast = f"TRY_CAST(REPLACE(CAST({safe_col} AS VARCHAR), ',', '.') AS DOUBLE)"
+            safe_cast = num_col or _numeric_cast_sql(safe_col)
             return f"({safe_cast} IS NOT NULL AND {safe_cast} BETWEEN {min_v} AND {max_v})"
 
-        cond1 = self._build_single_sql_cond(safe_col, op1, val1)
-        cond2 = self._build_single_sql_cond(safe_col, op2, val2)
+        cond1 = self._build_single_sql_cond(safe_col, op1, val1, num_col)
+        cond2 = self._build_single_sql_cond(safe_col, op2, val2, num_col)
         return f"({cond1} {op_central} {cond2})"
 
-    def _create_conditional_sql(self, f: Dict, global_config: Dict, allowed_columns) -> str:
+    def _create_conditional_sql(self, f: Dict, global_config: Dict, allowed_columns, numeric_view: Optional[pd.DataFrame] = None) -> str:
         if not f.get('c_check'): return "TRUE"
         conds = []
         col_idade = global_config.get('coluna_idade')
         if f.get('c_idade_check') and col_idade:
-            safe_idade = sanitize.safe_column_ref(col_idade, allowed_columns)
+            safe_idade, num_idade = self._column_refs(col_idade, allowed_columns, numeric_view)
             if safe_idade:
                 op1, val1 = f.get('c_idade_op1'), f.get('c_idade_val1')
-                if op1 and val1: conds.append(self._build_single_sql_cond(safe_idade, op1, val1))
+                if op1 and val1: conds.append(self._build_single_sql_cond(safe_idade, op1, val1, num_idade))
                 op2, val2 = f.get('c_idade_op2'), f.get('c_idade_val2')
-                if op2 and val2: conds.append(self._build_single_sql_cond(safe_idade, op2, val2))
+                if op2 and val2: conds.append(self._build_single_sql_cond(safe_idade, op2, val2, num_idade))
         col_sexo = global_config.get('coluna_sexo')
         if f.get('c_sexo_check') and col_sexo:
             val_sexo = f.get('c_sexo_val')
-            safe_sexo = sanitize.safe_column_ref(col_sexo, allowed_columns)
+            safe_sexo, num_sexo = self._column_refs(col_sexo, allowed_columns, numeric_view)
             if val_sexo and safe_sexo:
-                conds.append(self._build_single_sql_cond(safe_sexo, '=', val_sexo))
+                conds.append(self._build_single_sql_cond(safe_sexo, '=', val_sexo, num_sexo))
         return " AND ".join(conds) if conds else "TRUE"
 
-    def apply_filters(self, df_input: pd.DataFrame, filters_config: List[Dict], global_config: Dict, progress_bar) -> pd.DataFrame:
-        start_time = time.perf_counter()
-        active_filters = [f for f in filters_config if f['p_check']]
-        
-        if not active_filters:
-            end_time = time.perf_counter()
-            progress_bar.progress(1.0, text=f"No active filter rules. (Time: {end_time - start_time:.4f}s)")
-            return df_input
+    def _numeric_view_for(self, df: pd.DataFrame, global_config: Dict) -> Optional[pd.DataFrame]:
+        """
+        Visão numérica alinhada às linhas de ``df``, ou ``None``.
+
+        A visão é construída uma vez, sobre a planilha enviada. O resultado do
+        filtro é um subconjunto dela, com os mesmos rótulos de índice, então
+        basta reindexar. Qualquer coisa fora disso cai no ``TRY_CAST`` em texto.
+        """
+        view = global_config.get('numeric_view')
+        if view is None or df is None:
+            return None
+        if view.index is df.index or (len(view) == len(df) and view.index.equals(df.index)):
+            return view
+        if not df.index.is_unique or not view.index.is_unique or not df.index.isin(view.index).all():
+            return None
+        return view.reindex(df.index)
+
+    def _select_flags(self, df: pd.DataFrame, exprs: List[str], numeric_view: Optional[pd.DataFrame] = None) -> Dict[str, np.ndarray]:
+        """
+        Avalia as expressões booleanas ``exprs`` sobre ``df`` numa única varredura.
 
-        exclusion_clauses = []
+        O DataFrame é registrado direto no DuckDB, que varre as colunas do
+        pandas no lugar: não há ``copy()``, coluna auxiliar de id nem o
+        ``isin`` de volta. Com ``preserve_insertion_order`` a posição i de cada
+        máscara é a linha i do frame. A visão numérica, quando existe, entra
+        lado a lado por POSITIONAL JOIN.
+        """
+        con = duckdb.connect()
+        try:
+            con.execute("SET preserve_insertion_order = true")
+            con.register('local_df', df)
+            source = "local_df"
+            if numeric_view is not None:
+                con.register('num_df', numeric_view)
+                source = "local_df POSITIONAL JOIN num_df"
+            result = con.execute(f"SELECT {', '.join(exprs)} FROM {source}").fetchnumpy()
+        finally:
+            con.close()
+        flags = {name: np.asarray(values, dtype=bool) for name, values in result.items()}
+        if any(len(v) != len(df) for v in flags.values()):
+            raise RuntimeError("Selection vector does not match the number of rows.")
+        return flags
+
+    def _compile_rules(self, active_filters: List[Dict], allowed_columns, global_config: Dict, progress_bar, numeric_view: Optional[pd.DataFrame] = None) -> List[tuple]:
+        """``[(regra, sql_da_regra)]``: o SQL é verdadeiro nas linhas que a regra exclui."""
+        rules_sql = []
         for i, f_config in enumerate(active_filters):
             progress_bar.progress((i + 1) / len(active_filters), text=f"Mapping SQL rule {i+1}...")
             col_config_str = f_config.get('p_col', '')
@@ -409,39 +559,121 @@ class DataProcessor:
 
             main_conds = []
             for sub_col in cols_to_check:
-                main_conds.append(self._create_main_sql(f_config, sub_col, df_input.columns))
+                main_conds.append(self._create_main_sql(f_config, sub_col, allowed_columns, numeric_view))
 
             combined_main_sql = " AND ".join([f"({c})" for c in main_conds]) if main_conds else "FALSE"
-            cond_sql = self._create_conditional_sql(f_config, global_config, df_input.columns)
+            cond_sql = self._create_conditional_sql(f_config, global_config, allowed_columns, numeric_view)
             rule_sql = f"({combined_main_sql}) AND ({cond_sql})"
-            exclusion_clauses.append(f"NOT ({rule_sql})")
+            rules_sql.append((f_config, rule_sql))
+        return rules_sql
+
+    def export_filtered_stream(self, csv_path: str, sep: str, filters_config: List[Dict], global_config: Dict, out_path: str, out_format: str, progress_bar) -> int:
+        """
+        Filtra um CSV direto do disco para ``out_path``, sem passar pelo pandas.
+
+        O DuckDB lê ``csv_path`` em blocos, aplica as mesmas regras do
+        ``apply_filters`` e grava o resultado com ``COPY ... TO`` (CSV ``;`` ou
+        Parquet). A tabela inteira nunca entra no heap do Python; o consumo de
+        memória do motor fica preso a ``STREAM_MEMORY_LIMIT`` e o excedente vai
+        para um diretório temporário apagado ao final.
 
-        if not exclusion_clauses:
+        Todas as colunas são lidas como texto (``all_varchar``): os valores
+        saem exatamente como entraram, e as regras numéricas já convertem
+        com ``TRY_CAST``. Devolve o número de linhas gravadas.
+        """
+        spill_dir = tempfile.mkdtemp(prefix="datasift_spill_")
+        os.chmod(spill_dir, 0o700)
+        con = duckdb.connect()
+        try:
+            con.execute(f"SET memory_limit = {sanitize.quote_literal(STREAM_MEMORY_LIMIT)}")
+            con.execute(f"SET temp_directory = {sanitize.quote_literal(spill_dir)}")
+            con.execute("SET preserve_insertion_order = true")
+            con.execute(
+                f"CREATE VIEW local_df AS SELECT * FROM read_csv({sanitize.quote_literal(csv_path)}, "
+                f"delim = {sanitize.quote_literal(sep)}, header = true, all_varchar = true)"
+            )
+            allowed_columns = [row[0] for row in con.execute("DESCRIBE local_df").fetchall()]
+
+            active_filters = [f for f in filters_config if f['p_check']]
+            rules_sql = self._compile_rules(active_filters, allowed_columns, global_config, progress_bar)
+            where_clause = " AND ".join(f"COALESCE(NOT ({rule_sql}), FALSE)" for _, rule_sql in rules_sql) or "TRUE"
+
+            if out_format == 'parquet':
+                options = "FORMAT PARQUET"
+            else:
+                options = "FORMAT CSV, DELIMITER ';', HEADER true"
+            progress_bar.progress(0.8, text="Streaming rows through DuckDB...")
+            rows = con.execute(
+                f"COPY (SELECT * FROM local_df WHERE {where_clause}) TO {sanitize.quote_literal(out_path)} ({options})"
+            ).fetchone()[0]
+        finally:
+            con.close()
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        return int(rows or 0)
+
+    def apply_filters(self, df_input: pd.DataFrame, filters_config: List[Dict], global_config: Dict, progress_bar) -> pd.DataFrame:
+        keep = self.filter_mask(df_input, filters_config, global_config, progress_bar)
+        return df_input if keep is None else df_input[keep]
+
+    def filter_mask(self, df_input: pd.DataFrame, filters_config: List[Dict], global_config: Dict, progress_bar) -> Optional[np.ndarray]:
+        """
+        Máscara das linhas que sobrevivem às regras; ``None`` quando nada é
+        filtrado (nenhuma regra ativa, ou erro — registrado em ``filter_error``).
+
+        ``df_input`` só precisa ter as colunas que as regras citam: o main()
+        passa ``dataset.select`` dessas colunas e materializa a tabela inteira
+        só depois, já com a máscara (``Dataset.to_frame(rows)``).
+        """
+        start_time = time.perf_counter()
+        active_filters = [f for f in filters_config if f['p_check']]
+        
+        if not active_filters:
+            end_time = time.perf_counter()
+            progress_bar.progress(1.0, text=f"No active filter rules. (Time: {end_time - start_time:.4f}s)")
+            return None
+
+        numeric_view = self._numeric_view_for(df_input, global_config)
+        rules_sql = self._compile_rules(active_filters, df_input.columns, global_config, progress_bar, numeric_view)
+
+        if not rules_sql:
             end_time = time.perf_counter()
             progress_bar.progress(1.0, text=f"Processing complete! (Time: {end_time - start_time:.4f}s)")
-            return df_input
+            return None
 
-        where_clause = " AND ".join(exclusion_clauses)
-        local_df = df_input.copy()
-        local_df['_temp_row_id'] = range(len(local_df))
-        
-        con = duckdb.connect()
-        con.register('local_df', local_df)
-        query = f"SELECT _temp_row_id FROM local_df WHERE {where_clause}"
+        # Máscara por regra: linhas que sobrevivem a ela. COALESCE(NOT ..., FALSE)
+        # reproduz o WHERE NOT (r1) AND NOT (r2)...: regra que dá NULL exclui.
+        mask_cache = global_config.get('mask_cache')
+        fingerprint = global_config.get('dataset_fingerprint')
+        use_cache = mask_cache is not None and bool(fingerprint)
 
         try:
             progress_bar.progress(0.8, text="Executing DuckDB Engine (SQL)...")
-            valid_ids_df = con.execute(query).df()
-            filtered_df = local_df[local_df['_temp_row_id'].isin(valid_ids_df['_temp_row_id'])].copy()
-            filtered_df.drop(columns=['_temp_row_id'], inplace=True)
-            con.close()
-            
+            keeps = {}
+            for k, (_, rule_sql) in enumerate(rules_sql):
+                cached = mask_cache.get(fingerprint, rule_sql, len(df_input)) if use_cache else None
+                if cached is not None:
+                    keeps[k] = cached
+            pending = [k for k in range(len(rules_sql)) if k not in keeps]
+            if pending:
+                # Só as regras novas ou alteradas vão ao DuckDB, todas numa varredura.
+                exprs = [f"COALESCE(NOT ({rules_sql[k][1]}), FALSE) AS r{k}" for k in pending]
+                flags = self._select_flags(df_input, exprs, numeric_view)
+                for k in pending:
+                    keeps[k] = flags[f"r{k}"]
+                    if use_cache:
+                        mask_cache.put(fingerprint, rules_sql[k][1], keeps[k])
+
+            keep = np.logical_and.reduce([keeps[k] for k in range(len(rules_sql))])
+            st.session_state.filter_rule_counts = [
+                {'Rule': self._describe_rule(f_config), 'Rows excluded': int(len(df_input) - np.count_nonzero(keeps[k]))}
+                for k, (f_config, _) in enumerate(rules_sql)
+            ]
+
             end_time = time.perf_counter()
             tempo_execucao = end_time - start_time
             progress_bar.progress(1.0, text=f"Filtering complete! Processing time: {tempo_execucao:.4f} seconds.")
-            return filtered_df
+            return keep
         except Exception as e:
-            con.close()
             # A mensagem crua expunha a consulta montada, nomes de coluna e
             # caminhos internos. O detalhe vai para a auditoria; o usuário
             # recebe um código para citar ao administrador.
@@ -452,8 +684,16 @@ class DataProcessor:
                 detail={"correlacao": correlation_id, "erro": sanitize.error_fingerprint(e)},
             )
             st.session_state.filter_error = message
-            return df_input
+            return None
     
+    def _describe_rule(self, f: Dict) -> str:
+        text = f"{f.get('p_col', '')} {f.get('p_op1', '')} {f.get('p_val1', '')}"
+        if f.get('p_expand'):
+            text += f" {f.get('p_op_central', '')} {f.get('p_op2', '')} {f.get('p_val2', '')}"
+        if f.get('c_check'):
+            text += " (conditional)"
+        return text
+
     def apply_stratification(self, df_input: pd.DataFrame, strata_config: Dict, global_config: Dict, progress_bar) -> Dict[str, pd.DataFrame]:
         col_idade = global_config.get('coluna_idade')
         col_sexo = global_config.get('coluna_sexo')
@@ -470,8 +710,9 @@ class DataProcessor:
 
         # Identificadores conferidos contra as colunas reais antes de entrarem
         # na consulta — ver docstring da classe.
-        safe_idade = sanitize.safe_column_ref(col_idade, df_input.columns) if col_idade else ""
-        safe_sexo = sanitize.safe_column_ref(col_sexo, df_input.columns) if col_sexo else ""
+        numeric_view = self._numeric_view_for(df_input, global_config)
+        safe_idade, num_idade = self._column_refs(col_idade, df_input.columns, numeric_view) if col_idade else ("", None)
+        safe_sexo, num_sexo = self._column_refs(col_sexo, df_input.columns, numeric_view) if col_sexo else ("", None)
 
         if age_strata and not safe_idade:
             st.session_state.stratification_error = "Age column is not valid for this spreadsheet."
@@ -492,49 +733,65 @@ class DataProcessor:
 
         total_files = len(final_strata_to_process)
         generated_dfs = {}
-
-        local_df = df_input.copy()
-        local_df['_temp_row_id'] = range(len(local_df))
-        
-        con = duckdb.connect()
-        con.register('local_df', local_df)
+        if not total_files:
+            progress_bar.progress(1.0, text="Stratification complete!")
+            return generated_dfs
+
+        # Uma única varredura classifica todas as linhas: cada regra de idade e
+        # cada regra de sexo vira uma coluna booleana (a0..aN, s0..sM), em vez
+        # de uma consulta por estrato. Regras de idade que se sobrepõem
+        # continuam funcionando: a linha fica marcada em todas as faixas que a
+        # contêm, exatamente como nas consultas separadas.
+        flag_exprs = []
+        for k, age_rule in enumerate(age_strata):
+            conditions = []
+            if age_rule.get('op1') and age_rule.get('val1'):
+                conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op1'], age_rule['val1'], num_idade))
+            if age_rule.get('op2') and age_rule.get('val2'):
+                conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op2'], age_rule['val2'], num_idade))
+            clause = " AND ".join([f"({c})" for c in conditions]) if conditions else "TRUE"
+            flag_exprs.append(f"COALESCE(({clause}), FALSE) AS a{k}")
+        for k, sex_rule in enumerate(sex_strata):
+            clause = self._build_single_sql_cond(safe_sexo, '=', sex_rule['value'], num_sexo) if sex_rule.get('value') else "TRUE"
+            flag_exprs.append(f"COALESCE(({clause}), FALSE) AS s{k}")
+
+        progress_bar.progress(0.1, text="Classifying rows into strata (single pass)...")
+        try:
+            flags = pd.DataFrame(self._select_flags(df_input, flag_exprs, numeric_view))
+        except Exception as e:
+            message, correlation_id = sanitize.redact_error(e)
+            audit.record(
+                "analysis.error", audit.OUTCOME_FAILURE,
+                target="apply_stratification",
+                detail={"correlacao": correlation_id, "erro": sanitize.error_fingerprint(e)},
+            )
+            st.session_state.stratification_error = message
+            return generated_dfs
+
+        # Um único groupby sobre as colunas de marcação: cada grupo é uma
+        # combinação de faixas/sexos e traz as posições das suas linhas. Com
+        # faixas disjuntas, cada estrato corresponde a exatamente um grupo.
+        flag_cols = list(flags.columns)
+        groups = []
+        for key, positions in flags.groupby(flag_cols, sort=False).indices.items():
+            key = key if isinstance(key, tuple) else (key,)
+            groups.append((dict(zip(flag_cols, key)), positions))
 
         for i, stratum in enumerate(final_strata_to_process):
-            progress = (i + 1) / total_files
-            conditions = []
             age_rule = stratum.get('age')
-            if age_rule:
-                if age_rule.get('op1') and age_rule.get('val1'):
-                    conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op1'], age_rule['val1']))
-                if age_rule.get('op2') and age_rule.get('val2'):
-                    conditions.append(self._build_single_sql_cond(safe_idade, age_rule['op2'], age_rule['val2']))
-
             sex_rule = stratum.get('sex')
-            if sex_rule and sex_rule.get('value'):
-                conditions.append(self._build_single_sql_cond(safe_sexo, '=', sex_rule['value']))
-
-            where_clause = " AND ".join([f"({c})" for c in conditions]) if conditions else "TRUE"
-            query = f"SELECT _temp_row_id FROM local_df WHERE {where_clause}"
-
             filename = self._generate_stratum_name(age_rule, sex_rule)
-            progress_bar.progress(progress, text=f"Generating stratum {i+1}/{total_files}: {filename}...")
-            
-            try:
-                valid_ids_df = con.execute(query).df()
-                if not valid_ids_df.empty:
-                    stratum_df = local_df[local_df['_temp_row_id'].isin(valid_ids_df['_temp_row_id'])].copy()
-                    stratum_df.drop(columns=['_temp_row_id'], inplace=True)
-                    generated_dfs[filename] = stratum_df
-            except Exception as e:
-                message, correlation_id = sanitize.redact_error(e)
-                audit.record(
-                    "analysis.error", audit.OUTCOME_FAILURE,
-                    target="apply_stratification",
-                    detail={"correlacao": correlation_id, "erro": sanitize.error_fingerprint(e)},
-                )
-                st.session_state.stratification_error = message
+            progress_bar.progress((i + 1) / total_files, text=f"Generating stratum {i+1}/{total_files}: {filename}...")
+
+            a_col = f"a{age_strata.index(age_rule)}" if age_rule else None
+            s_col = f"s{sex_strata.index(sex_rule)}" if sex_rule else None
+            parts = [pos for key, pos in groups
+                     if (a_col is None or key[a_col]) and (s_col is None or key[s_col])]
+            if not parts:
+                continue
+            positions = parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+            generated_dfs[filename] = df_input.take(positions)
 
-        con.close()
         progress_bar.progress(1.0, text="Stratification complete!")
         return generated_dfs
 
@@ -583,26 +840,115 @@ class DataProcessor:
 # logo após a leitura, então uma entrada antiga nunca volta a ser reaproveitada —
 # sem limite, cada arquivo já lido ficava guardado inteiro na memória para sempre.
 @st.cache_data(show_spinner="Reading file...", max_entries=1)
-def _read_csv_engine(_tenant, path, sep, decimal, encoding):
+def _read_csv_engine(_tenant, path, sep, decimal, encoding, engine='pyarrow', ascii_sample=False):
     """
-    Lê CSV com PyArrow (rápido). Se o PyArrow falhar — por exemplo em linhas/campos
-    muito grandes, que geram 'straddling object straddles two block boundaries' —,
-    refaz a leitura com o parser C padrão do pandas, que não tem essa limitação de
-    blocos. Colunas, valores e dtypes resultantes são equivalentes aos do PyArrow.
+    Lê CSV com ``engine.readers``: PyArrow (rápido), ou direto com o parser C
+    quando ``engine='c'`` — o ``sniff`` já indica isso para linhas/campos muito
+    grandes, que geram 'straddling object straddles two block boundaries' no
+    PyArrow. Se o PyArrow ainda assim falhar (arquivo malformado), refaz a
+    leitura com o parser C, que é mais tolerante.
 
     ``_tenant`` não é usado no corpo: existe só para entrar na chave do cache.
     O cache do Streamlit é global do processo, não por sessão — sem essa chave,
     a separação entre laboratórios dependeria de os demais argumentos nunca
     coincidirem, o que é garantia acidental, não estrutural.
     """
-    try:
-        return pd.read_csv(path, sep=sep, decimal=decimal, encoding=encoding, engine='pyarrow')
-    except Exception:
-        return pd.read_csv(path, sep=sep, decimal=decimal, encoding=encoding, engine='c', low_memory=False)
+    return readers.read_csv(path, sniff.CsvDialect(sep, decimal, encoding, engine, ascii_sample))
+
+def _read_csv_sniffed(tenant, path):
+    """CSV lido em um único parse, com o dialeto detectado por ``engine.sniff``."""
+    dialect = sniff.sniff_path(path)
+    return _read_csv_engine(tenant, path, dialect.sep, dialect.decimal, dialect.encoding, dialect.engine, dialect.ascii_sample)
         
-def load_dataframe(uploaded_file, user=None):
+def _parse_upload(uploaded_file, tenant, all_zip_members: bool = False):
+    """
+    Parse do arquivo enviado: CSV, Excel ou ZIP. Do ZIP vem o primeiro
+    membro ou, com ``all_zip_members``, todos eles empilhados com a coluna
+    ``Source file`` (ver ``engine.readers.read_zip``).
+    """
+    file_name = uploaded_file.name.lower()
+    uploaded_file.seek(0)
+
+    with secure_tempfile(os.path.splitext(file_name)[1]) as tmp_path:
+        with open(tmp_path, 'wb') as tmp_file:
+            shutil.copyfileobj(uploaded_file, tmp_file)
+
+        df = None
+        if file_name.endswith('.zip'):
+            try:
+                df = readers.read_zip(tmp_path, all_members=all_zip_members, source_column="Source file")
+            except readers.EmptyArchiveError:
+                st.error("The ZIP file contains no valid CSV or Excel files.")
+                return None
+        elif file_name.endswith('.csv'):
+            df = _read_csv_sniffed(tenant, tmp_path)
+        else:
+            df = xlsx.read_excel(tmp_path)
+    return df
+
+def _arrow_strings(series: pd.Series):
+    """Coluna ``object`` como array Arrow de texto; valores não textuais viram ``str(v)``."""
+    import pyarrow as pa
+
+    try:
+        arr = pa.array(series, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        arr = None
+    if arr is None or not pa.types.is_string(arr.type):
+        # Tipos misturados (número e texto na mesma coluna do Excel), booleanos,
+        # datas: mesmo resultado do antigo ``astype(str)`` nas células não nulas.
+        mask = series.notna()
+        arr = pa.array(series.where(~mask, series[mask].astype(str)), type=pa.string(), from_pandas=True)
+    return arr
+
+def normalize_dtypes(df: pd.DataFrame, data_column: Optional[str] = None) -> pd.DataFrame:
+    """
+    Tipos compactos para a planilha recém-lida, coluna a coluna e sem laços por célula.
+
+    - Texto (``object``) vira texto Arrow (``string[pyarrow]``): um buffer
+      contíguo em vez de um objeto Python por célula.
+    - Texto com poucos valores distintos (menos da metade das linhas) vira
+      ``category``. A cardinalidade sai do próprio ``dictionary_encode`` do
+      Arrow, que já devolve os códigos — sem ``nunique`` à parte. As
+      categorias ficam em ordem alfabética, como no ``astype('category')``.
+      ``data_column`` (a coluna de resultados) nunca vira categoria.
+    - Inteiros de 64 bits que cabem em 32 (idade, contagens) viram ``int32``.
+      O limite é 32 bits de propósito: ``int8``/``int16`` estouram em
+      operações elemento a elemento como idade², e as somas do numpy já
+      acumulam em 64 bits.
+
+    Substitui o laço que fazia ``df.loc[mask, col].astype(str)`` (uma cópia
+    da coluna) seguido de ``nunique()`` para cada coluna de texto.
     """
-    Lê a planilha enviada.
+    n_rows = len(df)
+    int32 = np.iinfo(np.int32)
+    converted = {}
+    for position, col in enumerate(df.columns):
+        series = df.iloc[:, position]
+        if series.dtype == np.int64:
+            if n_rows == 0 or (series.min() >= int32.min and series.max() <= int32.max):
+                converted[position] = series.astype(np.int32)
+        elif series.dtype == object:
+            arr = _arrow_strings(series)
+            if col != data_column and n_rows:
+                encoded = arr.dictionary_encode()
+                if len(encoded.dictionary) / n_rows < 0.5:
+                    categorical = encoded.to_pandas()
+                    categorical = categorical.cat.reorder_categories(sorted(categorical.cat.categories))
+                    categorical.index = df.index
+                    converted[position] = categorical
+                    continue
+            converted[position] = pd.Series(pd.arrays.ArrowStringArray(arr), index=df.index)
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for position, series in converted.items():
+        df.isetitem(position, series)
+    return df
+
+def load_dataset(uploaded_file, user=None, fingerprint: Optional[str] = None, all_zip_members: bool = False):
+    """
+    Lê a planilha enviada e devolve um ``engine.dataset.Dataset``.
 
     Segurança em relação à versão anterior:
 
@@ -613,6 +959,16 @@ def load_dataframe(uploaded_file, user=None):
     - A mensagem de erro não expõe mais a exceção crua.
     - O cache de leitura é separado por laboratório (``tenant_cache_key``).
 
+    O parse passa pelo cache de uploads em disco (``engine.upload_cache``),
+    endereçado pelo SHA-256 do arquivo: reenviar a mesma planilha, aqui ou
+    em outra sessão do laboratório, não repete o parse. ``fingerprint`` é
+    esse SHA-256, quando o chamador já o calculou. ``all_zip_members`` junta
+    todas as planilhas de um ZIP numa só (ver ``_parse_upload``).
+
+    O handle devolvido lê do Parquet só as colunas pedidas (``select``), e a
+    normalização de tipos roda sobre cada leitura. A tabela inteira só é
+    materializada por quem precisa de todas as colunas (``to_frame``).
+
     ``validate_upload`` já rodou no chamador; aqui tratamos apenas o resto.
     """
     if uploaded_file is None: return None
@@ -620,46 +976,51 @@ def load_dataframe(uploaded_file, user=None):
     tenant = tenancy.tenant_cache_key(user)
 
     try:
-        file_name = uploaded_file.name.lower()
-        uploaded_file.seek(0)
+        digest = fingerprint or upload_fingerprint(uploaded_file)
+        return upload_cache.open_dataset(
+            tenant, digest, "datasift_v2_zipall" if all_zip_members else "datasift_v2",
+            lambda: _parse_upload(uploaded_file, tenant, all_zip_members),
+            # A coluna de resultados ainda não foi escolhida; o main() troca a
+            # normalização por set_transform quando ela é.
+            transform=functools.partial(normalize_dtypes, data_column=None),
+        )
+    except Exception as e:
+        message, correlation_id = sanitize.redact_error(e)
+        audit.record(
+            "data.read_error", audit.OUTCOME_FAILURE,
+            actor_id=user.id if user else None,
+            org_id=user.org_id if user else None,
+            detail={"correlacao": correlation_id, "erro": sanitize.error_fingerprint(e)},
+        )
+        st.error(f"Não foi possível ler o arquivo. {message}")
+        return None
 
-        with secure_tempfile(os.path.splitext(file_name)[1]) as tmp_path:
-            with open(tmp_path, 'wb') as tmp_file:
-                shutil.copyfileobj(uploaded_file, tmp_file)
-
-            df = None
-            if file_name.endswith('.zip'):
-                with zipfile.ZipFile(tmp_path) as z:
-                    valid_files = [f for f in z.namelist() if not f.startswith('__MACOSX/') and
-                                   (f.lower().endswith('.csv') or f.lower().endswith(('.xlsx', '.xls')))]
-                    if not valid_files:
-                        st.error("The ZIP file contains no valid CSV or Excel files.")
-                        return None
-
-                    inner_name = valid_files[0]
-                    with secure_tempfile(os.path.splitext(inner_name)[1]) as inner_path:
-                        with open(inner_path, 'wb') as inner_tmp:
-                            inner_tmp.write(z.read(inner_name))
-                        if inner_name.lower().endswith('.csv'):
-                            try: df = _read_csv_engine(tenant, inner_path, ';', ',', 'latin-1')
-                            except Exception: df = _read_csv_engine(tenant, inner_path, ',', '.', 'utf-8')
-                        else:
-                            df = pd.read_excel(inner_path, engine='openpyxl')
-            elif file_name.endswith('.csv'):
-                try: df = _read_csv_engine(tenant, tmp_path, ';', ',', 'latin-1')
-                except Exception: df = _read_csv_engine(tenant, tmp_path, ',', '.', 'utf-8')
-            else:
-                df = pd.read_excel(tmp_path, engine='openpyxl')
+def replace_dataset(dataset) -> None:
+    """Troca o ``dados_dataset`` da sessão, fechando o Parquet mapeado do anterior."""
+    previous = st.session_state.get('dados_dataset')
+    if previous is not None and previous is not dataset:
+        previous.close()
+    st.session_state.dados_dataset = dataset
 
-        if df is not None:
-            for col in df.select_dtypes(include=['object']).columns:
-                mask = df[col].notna()
-                df.loc[mask, col] = df.loc[mask, col].astype(str)
-                try:
-                    if col != st.session_state.col_dados and df[col].nunique() / len(df[col]) < 0.5:
-                        df[col] = df[col].astype('category')
-                except Exception: pass
-        return df
+def load_csv_preview(uploaded_file, user=None, nrows: int = 5000):
+    """
+    Primeiras ``nrows`` linhas do CSV, para o modo streaming.
+
+    Só alimenta a tela de configuração (nomes de coluna, valores de sexo,
+    validação da idade). O filtro em si roda sobre o arquivo inteiro, em
+    ``stream_filtered_export``.
+    """
+    if uploaded_file is None: return None
+    try:
+        dialect = sniff.sniff_file(uploaded_file)
+        uploaded_file.seek(0)
+        try:
+            return pd.read_csv(uploaded_file, sep=dialect.sep, decimal=dialect.decimal, encoding=dialect.encoding, nrows=nrows, low_memory=False)
+        except UnicodeDecodeError:
+            # Amostra só ASCII e um byte latin-1 mais adiante (ver engine.sniff).
+            if not dialect.ascii_sample: raise
+            uploaded_file.seek(0)
+            return pd.read_csv(uploaded_file, sep=dialect.sep, decimal=dialect.decimal, encoding='latin-1', nrows=nrows, low_memory=False)
     except Exception as e:
         message, correlation_id = sanitize.redact_error(e)
         audit.record(
@@ -670,348 +1031,431 @@ def load_dataframe(uploaded_file, user=None):
         )
         st.error(f"Não foi possível ler o arquivo. {message}")
         return None
+    finally:
+        uploaded_file.seek(0)
 
-def remove_outliers_tukey(df, col_dados, iterations=5, multiplier=2.0):
-    df_clean = df.copy()
-    for _ in range(iterations):
-        if df_clean.empty:
-            break
-        Q1 = df_clean[col_dados].quantile(0.25)
-        Q3 = df_clean[col_dados].quantile(0.75)
-        IQR = Q3 - Q1
-        
-        lower_bound = Q1 - (multiplier * IQR)
-        upper_bound = Q3 + (multiplier * IQR)
-        
-        mask = (df_clean[col_dados] >= lower_bound) & (df_clean[col_dados] <= upper_bound)
-        if mask.all(): 
-            break 
-            
-        df_clean = df_clean[mask]
-        
-    return df_clean
-
-def calcular_limites_haeckel(lri: float, lrs: float):
-    # Interceptação para conversão automática do LRI para 15% do LRS
-    # se o LRI for vazio (None) ou igual a 0.0, DESDE que o LRS seja um valor válido.
-    if lrs is not None and lrs > 0:
-        if lri is None or lri <= 0:
-            lri = 0.15 * lrs
-            
-    if lri is None or lrs is None or lri <= 0 or lrs <= lri:
-        return None
-    
-    se_ln = (math.log(lrs) - math.log(lri)) / 3.92
-    med_ln_val = (math.log(lri) + math.log(lrs)) / 2
-    med = math.exp(med_ln_val)
-    
-    cve_star = 100 * math.sqrt(math.exp(se_ln**2) - 1)
-    val_to_sqrt = cve_star - 0.25
-    pcva = math.sqrt(val_to_sqrt) if val_to_sqrt >= 0 else 0
-    psa_med = pcva * 0.01 * med
-    
-    slope = (psa_med - 0.2 * psa_med) / med
-    intercept = 0.2 * psa_med
-    
-    def calc_for_x(x):
-        if x <= 0: return {'psa': 0, 'pcva': 0, 'pb': 0}
-        psa_x = slope * x + intercept
-        pcva_x = (psa_x / x) * 100
-        pb_x = pcva_x * 0.70
-        return {'psa': psa_x, 'pcva': pcva_x, 'pb': pb_x}
-    
-    return {
-        'lri': lri, 'lrs': lrs, 'cve': cve_star, 'pcva': pcva, 'med': med,
-        'psa_med': psa_med, 'slope': slope, 'intercept': intercept,
-        'm_lri': calc_for_x(lri), 'm_lrs': calc_for_x(lrs)
-    }
-
-def encontrar_limites_casados(idade: float, sexo: str, lista_limites: list) -> Optional[dict]:
-    if not lista_limites: return None
-    sexo_str = str(sexo).strip().lower() if sexo else ""
-    
-    filtrados_sexo = []
-    for item in lista_limites:
-        s_lim = str(item.get('sex', '')).strip().lower()
-        if s_lim in ('all', 'todos', '', sexo_str):
-            filtrados_sexo.append(item)
-            
-    if not filtrados_sexo: return None
-    
-    com_idade = [item for item in filtrados_sexo if item.get('age_min') is not None or item.get('age_max') is not None]
-    globais = [item for item in filtrados_sexo if item.get('age_min') is None and item.get('age_max') is None]
-    
-    if not com_idade:
-        for g in globais:
-            if str(g.get('sex', '')).strip().lower() == sexo_str: return g
-        return globais[0] if globais else None
-        
-    match_direto = []
-    for item in com_idade:
-        amin = item.get('age_min') if item.get('age_min') is not None else 0
-        amax = item.get('age_max') if item.get('age_max') is not None else 9999
-        if amin <= idade <= amax:
-            match_direto.append(item)
-            
-    if match_direto:
-        for m in match_direto:
-            if str(m.get('sex', '')).strip().lower() == sexo_str: return m
-        return match_direto[0]
-        
-    ordenados_por_min = sorted(com_idade, key=lambda x: x.get('age_min') if x.get('age_min') is not None else 0)
-    menor_idade = ordenados_por_min[0].get('age_min', 0) if ordenados_por_min[0].get('age_min') is not None else 0
-    
-    if idade < menor_idade:
-        for o in ordenados_por_min:
-            if str(o.get('sex', '')).strip().lower() == sexo_str: return o
-        return ordenados_por_min[0]
-        
-    ordenados_por_max = sorted(com_idade, key=lambda x: x.get('age_max') if x.get('age_max') is not None else 9999, reverse=True)
-    maior_idade = ordenados_por_max[0].get('age_max', 9999) if ordenados_por_max[0].get('age_max') is not None else 9999
-    
-    if idade > maior_idade:
-        for o in ordenados_por_max:
-            if str(o.get('sex', '')).strip().lower() == sexo_str: return o
-        return ordenados_por_max[0]
-        
-    return globais[0] if globais else None
+def copy_utf8(src, path: str, validate: bool = False, chunk_size: int = 1 << 20) -> bool:
+    """
+    Copia ``src`` para ``path`` em blocos. Com ``validate``, confere o UTF-8
+    no caminho e devolve ``False`` no primeiro byte inválido.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')() if validate else None
+    with open(path, 'wb') as out:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            if decoder is not None:
+                try:
+                    decoder.decode(chunk)
+                except UnicodeDecodeError:
+                    return False
+            out.write(chunk)
+    if decoder is not None:
+        try:
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
 
-# max_entries limita quantos resultados antigos ficam guardados. O cálculo e os
-# valores devolvidos são exatamente os mesmos; só deixa de acumular sem limite.
-@st.cache_data(show_spinner=False, max_entries=16)
-def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto="All"):
-    temp_df = pd.DataFrame()
-    temp_df['Age'] = pd.to_numeric(df[col_idade], errors='coerce')
-
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-
-    temp_df['Data'] = df[col_dados].apply(clean_val).astype('float64')
-    temp_df = temp_df.dropna(subset=['Age', 'Data'])
-    temp_df = temp_df[temp_df['Age'] >= 0].copy()
-    temp_df = remove_outliers_tukey(temp_df, 'Data', iterations=5, multiplier=2.0)
-
-    if temp_df.empty: return pd.DataFrame(), pd.DataFrame(), [], False
-    max_age = int(temp_df['Age'].max())
-    if max_age < 1: return pd.DataFrame(), pd.DataFrame(), [], False
-
-    # =========================================================================
-    # TRACK 1: HARRIS-BOYD — RECURSIVE HIERARCHICAL PARTITIONING
-    # Finds the globally best cut, then recurses on each partition.
-    # Result: typically 2–5 clinically meaningful cuts instead of 70+.
-    # =========================================================================
-    MIN_N = 30  # minimum subjects per partition to attempt a cut
-
-    def find_best_cut(df_sub: pd.DataFrame):
-        """Return the single most statistically significant cut in df_sub, or None."""
-        if len(df_sub) < 2 * MIN_N:
-            return None
+def stream_filtered_export(uploaded_file, filters_config: List[Dict], global_config: Dict, out_format: str, progress_bar):
+    """
+    Modo streaming do filtro: arquivo enviado → disco → DuckDB → arquivo filtrado.
+
+    Devolve ``(arquivo, linhas)`` ou ``None`` em caso de erro. O arquivo é um
+    ``SessionFile``: a saída fica em disco, e não na memória da sessão, e é
+    apagada quando sai do ``st.session_state``. Os demais temporários usam
+    ``secure_tempfile`` e somem mesmo se a consulta falhar.
+    CSV em latin-1 é convertido para UTF-8 em blocos antes da leitura, porque
+    o leitor do DuckDB só aceita UTF-8; a conversão é byte a byte e não
+    depende do tamanho do arquivo.
+    """
+    export_file = SessionFile(f'.{out_format}')
+    try:
+        dialect = sniff.sniff_file(uploaded_file)
+        with secure_tempfile('.csv') as csv_path, secure_tempfile(f'.{out_format}') as out_path:
+            uploaded_file.seek(0)
+            encoding = dialect.encoding
+            if encoding in ('utf-8', 'utf-8-sig'):
+                # Com amostra só ASCII, a cópia confere o resto do arquivo: byte
+                # que não é UTF-8 quer dizer latin-1 (ver engine.sniff).
+                if not copy_utf8(uploaded_file, csv_path, validate=dialect.ascii_sample):
+                    encoding = 'latin-1'
+                    uploaded_file.seek(0)
+            if encoding not in ('utf-8', 'utf-8-sig'):
+                with open(csv_path, 'w', encoding='utf-8', newline='') as tmp_file:
+                    for chunk in iter(lambda: uploaded_file.read(1 << 20), b""):
+                        tmp_file.write(chunk.decode(encoding))
+            uploaded_file.seek(0)
+
+            processor = get_data_processor()
+            if out_format == 'csv':
+                # Mesmo BOM do to_csv, para o Excel abrir os acentos corretamente.
+                # O COPY do DuckDB sempre recria o destino, então o BOM vai antes
+                # e a saída é anexada em blocos, sem passar inteira pela memória.
+                rows = processor.export_filtered_stream(csv_path, dialect.sep, filters_config, global_config, out_path, out_format, progress_bar)
+                with open(export_file.path, 'wb') as dest, open(out_path, 'rb') as src:
+                    dest.write('\ufeff'.encode('utf-8'))
+                    shutil.copyfileobj(src, dest, 1 << 20)
+            else:
+                rows = processor.export_filtered_stream(csv_path, dialect.sep, filters_config, global_config, export_file.path, out_format, progress_bar)
+        progress_bar.progress(1.0, text=f"Streaming filter complete! {rows:,} rows written.")
+        return export_file, rows
+    except Exception as e:
+        export_file.discard()
+        message, correlation_id = sanitize.redact_error(e)
+        audit.record(
+            "analysis.error", audit.OUTCOME_FAILURE,
+            target="stream_filtered_export",
+            detail={"correlacao": correlation_id, "erro": sanitize.error_fingerprint(e)},
+        )
+        st.session_state.filter_error = message
+        return None
 
-        min_a = int(df_sub['Age'].min())
-        max_a = int(df_sub['Age'].max())
-        best_cut = None
-        best_z = 0.0
+def upload_fingerprint(uploaded_file, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 dos bytes enviados, lido em blocos para não duplicar o arquivo na memória."""
+    digest = hashlib.sha256()
+    position = uploaded_file.tell()
+    try:
+        uploaded_file.seek(0)
+        for chunk in iter(lambda: uploaded_file.read(chunk_size), b""):
+            digest.update(chunk)
+    finally:
+        uploaded_file.seek(position)
+    return digest.hexdigest()
 
-        for age_cutoff in range(min_a, max_a):
-            g1 = df_sub[df_sub['Age'] <= age_cutoff]['Data']
-            g2 = df_sub[df_sub['Age'] > age_cutoff]['Data']
-            n1, n2 = len(g1), len(g2)
+def build_numeric_view(df: pd.DataFrame, sample_rows: int = 10000) -> Optional[pd.DataFrame]:
+    """
+    Versão numérica (float64) das colunas da planilha que parecem numéricas.
+
+    Cada regra numérica do filtro e da estratificação compara a coluna através
+    de ``TRY_CAST(REPLACE(CAST(col AS VARCHAR), ',', '.') AS DOUBLE)`` — ou
+    seja, converte milhões de células para texto e de volta a cada regra e a
+    cada estrato. Aqui essa conversão roda uma única vez por upload, com a
+    mesma expressão SQL, e o ``DataProcessor`` passa a comparar direto contra
+    o resultado. Valores inválidos ficam NULL, exatamente como no ``TRY_CAST``.
+
+    "Parece numérica" é decidido numa amostra das primeiras ``sample_rows``
+    linhas: pelo menos metade dos valores preenchidos precisa converter. As
+    demais colunas seguem pela conversão em texto, que continua valendo.
+    """
+    if df is None or df.empty:
+        return None
 
-            if n1 < MIN_N or n2 < MIN_N:
-                continue
+    refs = {}
+    for col in df.columns:
+        try:
+            refs[col] = sanitize.quote_identifier(str(col))
+        except sanitize.SanitizationError:
+            continue
+    if not refs or len({str(c) for c in refs}) != len(refs):
+        return None
 
-            mean1, mean2 = float(np.mean(g1)), float(np.mean(g2))
-            var1,  var2  = float(np.var(g1, ddof=1)), float(np.var(g2, ddof=1))
-            sd1,   sd2   = np.sqrt(var1), np.sqrt(var2)
+    con = duckdb.connect()
+    try:
+        con.execute("SET preserve_insertion_order = true")
+        con.register('local_df', df)
+        probes = []
+        for i, ref in enumerate(refs.values()):
+            probes.append(f"COUNT({_numeric_cast_sql(ref)}) AS n{i}")
+            probes.append(f"COUNT({ref}) AS t{i}")
+        counts = con.execute(
+            f"SELECT {', '.join(probes)} FROM (SELECT * FROM local_df LIMIT {int(sample_rows)})"
+        ).fetchone()
+        numeric_cols = [
+            col for i, col in enumerate(refs)
+            if counts[2 * i] > 0 and counts[2 * i] * 2 >= counts[2 * i + 1]
+        ]
+        if not numeric_cols:
+            return None
+        exprs = [f"{_numeric_cast_sql(refs[col])} AS c{i}" for i, col in enumerate(numeric_cols)]
+        view = con.execute(f"SELECT {', '.join(exprs)} FROM local_df").df()
+    finally:
+        con.close()
 
-            # Fallback seguro: se min(sd1, sd2) for 0, a razão se iguala a 1.0 (não ativando o gatilho falso > 1.5)
-            sd_ratio = max(sd1, sd2) / min(sd1, sd2) if min(sd1, sd2) > 0 else 1.0
-            
-            denom = np.sqrt((var1 / n1) + (var2 / n2))
-            if denom == 0:
-                continue
-                
-            z = abs(mean1 - mean2) / denom
-            z_crit = 3 * np.sqrt((n1 + n2) / 120) if (n1 + n2) < 120 else 3.0
-
-            is_significant = (sd_ratio > 1.5 or z > z_crit)
-
-            # Keep only the most extreme significant cut in this partition
-            if is_significant and z > best_z:
-                best_z = z
-                best_cut = {
-                    'age': age_cutoff,
-                    'Age Cutoff': f"<= {age_cutoff} vs > {age_cutoff}",
-                    'Z-score': round(z, 2),
-                    'SD Ratio': round(sd_ratio, 2),
-                    'Mean (<= Cutoff)': round(mean1, 2),
-                    'Mean (> Cutoff)': round(mean2, 2),
-                }
-        return best_cut
-
-    def recursive_partition(df_sub: pd.DataFrame, found: list, depth: int = 0):
-        """
-        Recursively split df_sub.
-        Each call adds at most ONE cut (the best one in this sub-range),
-        then dives into the two resulting halves.
-        depth cap = 6  →  maximum 2^6 - 1 = 63 cuts, in practice 2–5.
-        """
-        if depth >= 6:
-            return
-        best = find_best_cut(df_sub)
-        if best is None:
-            return
-        found.append(best)
-        cut_age = best['age']
-        recursive_partition(df_sub[df_sub['Age'] <= cut_age], found, depth + 1)
-        recursive_partition(df_sub[df_sub['Age'] > cut_age],  found, depth + 1)
-
-    possible_cuts_hb = []
-    recursive_partition(temp_df, possible_cuts_hb)
-    possible_cuts_hb.sort(key=lambda x: x['age'])
-
-    df_possible = pd.DataFrame(possible_cuts_hb) if possible_cuts_hb else pd.DataFrame()
-
-    # =========================================================================
-    # TRACK 2: DYNAMIC CRITICAL BOUNDARY EVALUATION (HAECKEL VS AEDM)
-    # =========================================================================
-    global_mean = temp_df['Data'].mean()
-    global_sd   = temp_df['Data'].std(ddof=1)
-    global_cv   = (global_sd / global_mean) if global_mean > 0 else 0.10
-    cv_tolerance_margin = global_cv * 0.50
-
-    age_groups = temp_df.groupby('Age')['Data'].agg(['mean', 'count']).reset_index()
-    age_groups = age_groups.sort_values(by='Age').to_dict('records')
-
-    clinical_cuts = []
-    idades_sugeridas = []
-    any_haeckel_applied = False
-
-    if age_groups:
-        current_bracket_means = [age_groups[0]['mean']]
-
-        for i in range(1, len(age_groups)):
-            current_age_data = age_groups[i]
-            reference_mean   = np.mean(current_bracket_means)
-            pct_diff = abs(current_age_data['mean'] - reference_mean) / reference_mean if reference_mean > 0 else 0
-
-            is_significant = False
-            margin_disp    = 0
-
-            limite_casado = encontrar_limites_casados(current_age_data['Age'], sexo_contexto, lista_limites)
-
-            h_local = None
-            if limite_casado and limite_casado.get('lrs') is not None and limite_casado.get('lrs') > 0:
-                h_local = calcular_limites_haeckel(limite_casado.get('lri'), limite_casado.get('lrs'))
-
-            if h_local and reference_mean > 0:
-                any_haeckel_applied = True
-                psa_x        = (h_local['slope'] * reference_mean) + h_local['intercept']
-                pd_margin    = 1.645 * psa_x
-                diff_absoluta = abs(current_age_data['mean'] - reference_mean)
-                is_significant = diff_absoluta > pd_margin
-                margin_disp  = round(pd_margin, 3)
-            else:
-                is_significant = pct_diff > cv_tolerance_margin
-                margin_disp  = round(cv_tolerance_margin * 100, 2)
-
-            if is_significant and current_age_data['count'] >= 5:
-                cutoff_age = int(age_groups[i - 1]['Age'])
-                m_less    = temp_df[temp_df['Age'] <= cutoff_age]['Data'].mean()
-                m_greater = temp_df[temp_df['Age'] > cutoff_age]['Data'].mean()
-
-                clinical_cuts.append({
-                    'age': cutoff_age,
-                    'Age Cutoff': f"<= {cutoff_age} vs > {cutoff_age}",
-                    'Diff %':   round(pct_diff * 100, 2),
-                    'Limit Threshold': margin_disp,
-                    'Mean (<= Cutoff)': round(m_less, 2),
-                    'Mean (> Cutoff)':  round(m_greater, 2),
-                })
-                idades_sugeridas.append(cutoff_age)
-                current_bracket_means = [current_age_data['mean']]
-            else:
-                current_bracket_means.append(current_age_data['mean'])
+    view.columns = numeric_cols
+    view.index = df.index
+    return view
 
-    df_ideal = pd.DataFrame(clinical_cuts).sort_values(by='age') if clinical_cuts else pd.DataFrame()
+def dataset_numeric_view(dataset, columns) -> Optional[pd.DataFrame]:
+    """
+    ``build_numeric_view`` das ``columns`` do ``dataset``, convertida uma vez
+    por ``(dataset.cache_key, coluna)`` e guardada na sessão
+    (``NumericViewCache``): os cliques seguintes só montam o DataFrame com
+    as colunas já convertidas.
+    """
+    wanted = [c for c in dict.fromkeys(columns) if c and c in dataset.columns]
+    fingerprint = dataset.cache_key
+    if fingerprint is None or not wanted:
+        return build_numeric_view(dataset.select(wanted)) if wanted else None
+    cache = st.session_state.setdefault('numeric_view_cache', NumericViewCache())
+    found = {}
+    missing = []
+    for col in wanted:
+        hit, values = cache.get(fingerprint, col)
+        if hit: found[col] = values
+        else: missing.append(col)
+    if missing:
+        view = build_numeric_view(dataset.select(missing))
+        for col in missing:
+            found[col] = view[col] if view is not None and col in view.columns else None
+            cache.put(fingerprint, col, found[col])
+    numeric_cols = {col: found[col] for col in wanted if found[col] is not None}
+    return pd.DataFrame(numeric_cols) if numeric_cols else None
+
+def data_column_values(df: pd.DataFrame, column: str, fingerprint: Optional[str] = None) -> pd.Series:
+    """
+    Coluna de resultados como float64, pela regra do antigo ``clean_val``.
 
-    return df_possible, df_ideal, idades_sugeridas, any_haeckel_applied
+    Com ``fingerprint`` (da planilha ou do resultado filtrado), a conversão é
+    feita uma vez por coluna e guardada na sessão: gráfico, Harris-Boyd e as
+    tabelas de mediana recebem recortes desta mesma Series em vez de
+    converter a coluna de novo cada um.
+    """
+    if fingerprint is None:
+        return numeric.clean_numeric(df[column])
+    cache = st.session_state.setdefault('numeric_column_cache', numeric.NumericColumnCache())
+    values = cache.get(fingerprint, column, 'clean_val', df.index)
+    if values is None:
+        values = numeric.clean_numeric(df[column])
+        cache.put(fingerprint, column, 'clean_val', values)
+    return values
+
+def age_sex_summary(df: pd.DataFrame, col_idade: str, col_dados: str, col_sexo: Optional[str] = None,
+                    fingerprint: Optional[str] = None) -> summary.AgeSexSummary:
+    """
+    Resumo idade × sexo da coluna de resultados (``engine.summary``).
 
+    Com ``fingerprint`` (``Dataset.cache_key`` da planilha ou do resultado
+    filtrado), é montado uma vez por conteúdo e colunas e fica na sessão:
+    refazer a análise com outro intervalo ou outro tipo de gráfico não
+    converte nem varre as linhas de novo. A entrada só vale para uma tabela
+    com o mesmo índice de ``df``.
+    """
+    if fingerprint is None:
+        return summary.AgeSexSummary.from_frame(df, col_idade, col_dados, col_sexo, data_column_values(df, col_dados))
+    cache = st.session_state.setdefault('age_sex_summary_cache', summary.SummaryCache())
+    key = (fingerprint, col_idade, col_dados, col_sexo)
+    resumo = cache.get(key, df.index)
+    if resumo is None:
+        resumo = summary.AgeSexSummary.from_frame(df, col_idade, col_dados, col_sexo, data_column_values(df, col_dados, fingerprint))
+        cache.put(key, df.index, resumo)
+    return resumo
+
+def harris_boyd_inputs(df, col_idade, col_dados, valores=None):
+    """Idades e resultados de ``df`` como arrays float64, na ordem das linhas."""
+    idades = pd.to_numeric(df[col_idade], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    # ``valores``: a coluna de dados já convertida (``data_column_values``), na ordem de ``df``.
+    if valores is None:
+        valores = numeric.clean_numeric(df[col_dados])
+    return idades, valores.to_numpy(dtype='float64')
+
+def harris_boyd_rows(idades, dados) -> int:
+    """Quantas linhas a análise considera (idade >= 0 e resultado presente)."""
+    return int(((idades >= 0) & ~np.isnan(dados)).sum())
+
+def content_cache_key(user, chave: Optional[str]) -> Optional[str]:
+    """
+    Chave de cache de um conteúdo (``Dataset.cache_key`` ou um recorte dele),
+    separada por laboratório. ``None`` continua ``None``.
+    """
+    if chave is None:
+        return None
+    return f"{tenancy.tenant_cache_key(user)}|{chave}"
 
-def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range):
-    temp_df = pd.DataFrame()
-    temp_df['Age'] = pd.to_numeric(df[col_idade], errors='coerce')
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-    temp_df['Data'] = pd.to_numeric(df[col_dados].apply(clean_val), errors='coerce')
-    
-    if col_sexo and col_sexo in df.columns: temp_df['Sex'] = df[col_sexo].astype(str)
-    else: group_by_sex = False
+# As funções cacheadas abaixo recebem o DataFrame como ``_df`` (o Streamlit não
+# faz hash de argumentos com ``_``) e são indexadas por ``chave`` — de
+# content_cache_key, calculada uma vez no upload e a cada derivação — em vez do
+# hash da tabela inteira a cada execução do script, que em milhões de linhas
+# custava quase o mesmo que o cálculo. Sem chave, o cálculo roda sem cache.
+#
+# max_entries limita quantos resultados antigos ficam guardados. O cálculo e os
+# valores devolvidos são exatamente os mesmos; só deixa de acumular sem limite.
+@st.cache_data(show_spinner=False, max_entries=16)
+def _run_harris_boyd_cached(chave, col_idade, col_dados, lista_limites, sexo_contexto, _df, _valores):
+    idades, dados = harris_boyd_inputs(_df, col_idade, col_dados, _valores)
+    return harris_boyd.analyze(idades, dados, lista_limites, sexo_contexto)
+
+def run_harris_boyd(df, col_idade, col_dados, lista_limites=None, sexo_contexto="All", valores=None, chave=None):
+    # O cálculo (Tukey, Harris-Boyd e Haeckel/AEDM) fica em engine.harris_boyd,
+    # que também roda em processos auxiliares (run_harris_boyd_panel).
+    if chave is not None:
+        return _run_harris_boyd_cached(chave, col_idade, col_dados, lista_limites, sexo_contexto, df, valores)
+    idades, dados = harris_boyd_inputs(df, col_idade, col_dados, valores)
+    return harris_boyd.analyze(idades, dados, lista_limites, sexo_contexto)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _run_harris_boyd_panel_cached(chave, col_idade, colunas_dados, lista_limites, col_sexo, sexos, _df, _resumos):
+    return _harris_boyd_panel(_df, col_idade, colunas_dados, lista_limites, col_sexo, sexos, _resumos)
+
+def run_harris_boyd_panel(df, col_idade, colunas_dados, lista_limites=None, col_sexo=None, sexos=None, resumos=None, chave=None):
+    """
+    Harris-Boyd de um painel inteiro: cada analito de ``colunas_dados`` e,
+    com ``col_sexo``, cada sexo de ``sexos`` separadamente.
+
+    Devolve ``{coluna: {sexo: resultado}}``, com o mesmo resultado de
+    ``run_harris_boyd`` para cada partição; sem ``col_sexo`` a única chave é
+    ``"All"``. Sexos sem nenhuma linha ficam de fora. ``resumos`` é um
+    ``{coluna: AgeSexSummary}`` opcional (``age_sex_summary``); as colunas
+    sem resumo são resumidas aqui. As partições são independentes e rodam
+    juntas em ``harris_boyd.analyze_many``.
+    """
+    if chave is not None:
+        return _run_harris_boyd_panel_cached(chave, col_idade, list(colunas_dados), lista_limites, col_sexo, sexos, df, resumos)
+    return _harris_boyd_panel(df, col_idade, colunas_dados, lista_limites, col_sexo, sexos, resumos)
+
+def _harris_boyd_panel(df, col_idade, colunas_dados, lista_limites, col_sexo, sexos, resumos):
+    por_sexo = bool(col_sexo) and sexos is not None
+    jobs = {}
+    for coluna in colunas_dados:
+        resumo = (resumos or {}).get(coluna)
+        if resumo is None:
+            resumo = summary.AgeSexSummary.from_frame(df, col_idade, coluna, col_sexo if por_sexo else None)
+        if not por_sexo:
+            jobs[(coluna, "All")] = (*resumo.partition(), "All")
+            continue
+        for sexo in map(str, sexos):
+            if resumo.has(sexo):
+                jobs[(coluna, sexo)] = (*resumo.partition(sexo), sexo)
+
+    painel = {coluna: {} for coluna in colunas_dados}
+    for (coluna, sexo), resultado in harris_boyd.analyze_many(jobs, lista_limites).items():
+        painel[coluna][sexo] = resultado
+    return painel
+
+def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, valores=None, cortes=None, chave=None, resumo=None):
+    # O gráfico sai das células (sexo, idade) do resumo: as estatísticas de cada
+    # faixa são calculadas aqui e entregues prontas ao matplotlib (bxp e plot),
+    # no mesmo desenho do sns.boxplot/sns.lineplot — o seaborn recebia cada
+    # linha e agrupava de novo em Python.
+    if resumo is None:
+        resumo = summary.AgeSexSummary.from_frame(df, col_idade, col_dados, col_sexo, valores)
+    if not resumo.has_sex: group_by_sex = False
 
-    temp_df = temp_df.dropna(subset=['Age', 'Data'])
-    
     # O Filtro de idade agora funciona pois a função recebeu o age_filter_range
-    temp_df = temp_df[(temp_df['Age'] >= age_filter_range[0]) & (temp_df['Age'] <= age_filter_range[1])]
-    
-    if 'Sex' in temp_df.columns and selected_sexes:
-        temp_df = temp_df[temp_df['Sex'].isin(selected_sexes)]
-        
-    if temp_df.empty: return None
+    keep = (resumo.cell_age >= age_filter_range[0]) & (resumo.cell_age <= age_filter_range[1])
+    if resumo.has_sex and selected_sexes:
+        keep &= np.isin(resumo.cell_code, [i for i, lbl in enumerate(resumo.labels) if lbl in selected_sexes])
+    cells = np.flatnonzero(keep)
+
+    if not len(cells): return None
 
-    min_age, max_age = int(temp_df['Age'].min()), int(temp_df['Age'].max())
+    cell_age = resumo.cell_age[cells]
+    min_age, max_age = int(cell_age.min()), int(cell_age.max())
 
     if intervalo > 1:
         min_bin, max_bin = (min_age // intervalo) * intervalo, (max_age // intervalo) * intervalo
-        temp_df['Age_Bin'] = (temp_df['Age'] // intervalo) * intervalo
-        temp_df['Age_Label'] = temp_df['Age_Bin'].astype(int).astype(str) + " to " + (temp_df['Age_Bin'] + intervalo - 1).astype(int).astype(str)
+        cell_bin = (cell_age // intervalo) * intervalo
+        cell_label = [f"{int(b)} to {int(b + intervalo - 1)}" for b in cell_bin]
         categories = [f"{b} to {b + intervalo - 1}" for b in range(min_bin, max_bin + 1, int(intervalo))]
     else:
-        temp_df['Age_Label'] = temp_df['Age'].astype(int).astype(str)
+        cell_label = [str(int(a)) for a in cell_age]
         categories = [str(age) for age in range(min_age, max_age + 1)]
-        
-    temp_df['Age_Label'] = pd.Categorical(temp_df['Age_Label'], categories=categories, ordered=True)
-    x_col = 'Age_Label'
+
+    # Posição no eixo x de cada célula; -1 se o rótulo não é uma categoria.
+    x_of = {label: i for i, label in enumerate(categories)}
+    cell_x = np.array([x_of.get(label, -1) for label in cell_label], dtype=np.int64)
 
     fig, ax = plt.subplots(figsize=(12, 5))
-    hue_col = 'Sex' if group_by_sex and 'Sex' in temp_df.columns else None
+    hue_col = 'Sex' if group_by_sex and resumo.has_sex else None
     palette_custom = [COLOR_PRIMARY, COLOR_SECONDARY, "#48CAE4", "#06D6A0"] 
     single_color = COLOR_TERTIARY
-    
+
+    # Grupos do gráfico: um por sexo (na ordem em que aparecem nos dados) ou um só.
+    if hue_col:
+        codes = resumo.cell_code[cells]
+        first_row = {}
+        for code, row in zip(codes, resumo.cell_first[cells]):
+            first_row[code] = min(row, first_row.get(code, row))
+        levels = sorted(first_row, key=first_row.get)
+        groups = [(resumo.labels[code], cells[codes == code], cell_x[codes == code]) for code in levels]
+    else:
+        groups = [("All", cells, cell_x)]
+
+    def split_by(group_cells, keys):
+        """Células agrupadas por ``keys`` (chaves em ordem, uma passada só)."""
+        order = np.argsort(keys, kind='stable')
+        uniq, starts = np.unique(keys[order], return_index=True)
+        return uniq, np.split(group_cells[order], starts[1:])
+
+    def per_x(group_cells, group_x):
+        """Células de cada posição x com dados, em ordem."""
+        plotted = group_x >= 0
+        return split_by(group_cells[plotted], group_x[plotted])
+
+    legend_handles = []
     if chart_type == 'Boxplot':
-        if hue_col: sns.boxplot(data=temp_df, x=x_col, y='Data', hue=hue_col, palette=palette_custom, ax=ax, showfliers=False)
-        else: sns.boxplot(data=temp_df, x=x_col, y='Data', color=single_color, ax=ax, showfliers=False)
+        # Cores e contorno como no sns.boxplot: preenchimento com saturação
+        # 0.75 e linhas num cinza tirado da cor mais escura.
+        base_colors = sns.color_palette(palette_custom, n_colors=len(groups)) if hue_col else [single_color]
+        fill_colors = [sns.desaturate(c, .75) for c in base_colors]
+        lum = min(colorsys.rgb_to_hls(*to_rgb(c))[1] for c in fill_colors) * .6
+        line_color = (lum, lum, lum)
+        # Caixas lado a lado só se alguma faixa tem mais de um sexo.
+        dodge = len(groups) > 1 and len(np.unique(cell_x[cell_x >= 0])) < sum(len(np.unique(gx[gx >= 0])) for _, _, gx in groups)
+        width = 0.8 / len(groups) if dodge else 0.8
+        for k, (label, group_cells, group_x) in enumerate(groups):
+            legend_handles.append(Rectangle((0, 0), 0, 0, facecolor=fill_colors[k], edgecolor=line_color, label=label))
+            xs, per_cells = per_x(group_cells, group_x)
+            if not len(xs): continue
+            positions = xs + (width * k + width / 2 - 0.4 if dodge else 0.0)
+            box_stats = [boxplot_stats(resumo.cell_values(c), whis=1.5)[0] for c in per_cells]
+            ax.bxp(box_stats, positions=positions, widths=width, capwidths=0.5 * width, patch_artist=True, vert=True,
+                   manage_ticks=False, showfliers=False,
+                   boxprops={'facecolor': fill_colors[k], 'edgecolor': line_color},
+                   medianprops={'color': line_color, 'solid_capstyle': 'butt'},
+                   whiskerprops={'color': line_color, 'solid_capstyle': 'butt'},
+                   capprops={'color': line_color})
+        ax.xaxis.grid(False)
+        ax.set_xlim(-.5, len(categories) - .5)
     elif chart_type in ['Moving Average', 'Moving Median']:
-        metric_func = np.mean if chart_type == 'Moving Average' else np.median
-        if hue_col: sns.lineplot(data=temp_df, x=x_col, y='Data', hue=hue_col, palette=palette_custom, estimator=metric_func, marker='o', errorbar=None, ax=ax, linewidth=2, markersize=8)
-        else: sns.lineplot(data=temp_df, x=x_col, y='Data', estimator=metric_func, marker='o', color=single_color, errorbar=None, ax=ax, linewidth=2, markersize=8)
+        line_colors = sns.color_palette(palette_custom, n_colors=len(groups)) if hue_col else [single_color]
+        line_kws = dict(marker='o', linewidth=2, markersize=8, markeredgewidth=.75, markeredgecolor='w')
+
+        def metric(idx):
+            if chart_type == 'Moving Average':
+                return resumo.cell_sum[idx].sum() / resumo.cell_count[idx].sum()
+            return np.median(resumo.cell_values(idx))
+
+        for k, (label, group_cells, group_x) in enumerate(groups):
+            legend_handles.append(Line2D([], [], color=line_colors[k], label=label, **line_kws))
+            xs, per_cells = per_x(group_cells, group_x)
+            if not len(xs): continue
+            ax.plot(xs, [metric(c) for c in per_cells], color=line_colors[k], **line_kws)
 
         if show_trendlines:
-            metric_str = 'mean' if chart_type == 'Moving Average' else 'median'
-            def draw_segments(df_sub, color, s_context):
-                _, _, cuts, _ = run_harris_boyd(df_sub, 'Age', 'Data', lista_limites, s_context)
-                starts, ends = [0] + [c + 1 for c in cuts], cuts + [999]
-                for s, e in zip(starts, ends):
-                    mask = (df_sub['Age'] >= s) & (df_sub['Age'] <= e)
-                    if mask.sum() == 0: continue
-                    val = df_sub[mask]['Data'].mean() if metric_str == 'mean' else df_sub[mask]['Data'].median()
-                    x_positions = [categories.index(lbl) for lbl in df_sub[mask]['Age_Label'].unique() if lbl in categories]
-                    if not x_positions: continue
-                    ax.hlines(y=val, xmin=min(x_positions)-0.4, xmax=max(x_positions)+0.4, color=color, linestyle='--', linewidth=2.5, alpha=0.8, zorder=10)
+            def draw_segments(group_cells, group_x, color, s_context):
+                ages = resumo.cell_age[group_cells]
+                # ``cortes``: {contexto: (linhas analisadas, cortes)} da análise do
+                # main(). Só vale se o zoom e o filtro de sexo não tiraram nenhuma
+                # linha daquela partição; senão os cortes são refeitos aqui.
+                reuso = (cortes or {}).get(s_context)
+                if reuso is not None and reuso[0] == int(resumo.cell_count[group_cells][ages >= 0].sum()):
+                    cuts = reuso[1]
+                else:
+                    # ``group_cells`` já são as células do zoom e dos sexos do grupo.
+                    idades, valores = resumo.rows(group_cells)
+                    df_sub = pd.DataFrame({'Age': idades, 'Data': valores})
+                    # O recorte é definido pela origem, colunas, zoom e sexos do gráfico.
+                    recorte = f"grafico:{col_idade}:{col_dados}:{col_sexo}:{tuple(age_filter_range)}:{tuple(selected_sexes or ())}:{s_context}"
+                    _, _, cuts, _ = run_harris_boyd(df_sub, 'Age', 'Data', lista_limites, s_context, chave=derived_key(chave, recorte))
+                # Segmento [s, e] de cada célula por busca binária nos fins; fica
+                # fora quem cai antes do início (idade fracionária entre e e e+1).
+                starts, ends = np.array([0] + [c + 1 for c in cuts], dtype=float), np.array(cuts + [999], dtype=float)
+                seg = np.searchsorted(ends, ages, side='left')
+                inside = seg < len(ends)
+                inside[inside] = ages[inside] >= starts[seg[inside]]
+                # Só contam segmentos com alguma posição no eixo x.
+                _, seg_cells = split_by(group_cells[inside], seg[inside])
+                _, seg_xs = split_by(group_x[inside], seg[inside])
+                drawn = [(metric(c), x[x >= 0]) for c, x in zip(seg_cells, seg_xs) if (x >= 0).any()]
+                if drawn:
+                    ax.hlines(y=[v for v, _ in drawn], xmin=[x.min() - 0.4 for _, x in drawn], xmax=[x.max() + 0.4 for _, x in drawn],
+                              color=color, linestyle='--', linewidth=2.5, alpha=0.8, zorder=10)
 
             if hue_col:
-                palette = sns.color_palette(palette_custom, n_colors=temp_df[hue_col].nunique())
-                for i, sex_val in enumerate(temp_df[hue_col].dropna().unique()): 
-                    draw_segments(temp_df[temp_df[hue_col] == sex_val], palette[i], str(sex_val))
+                palette = sns.color_palette(palette_custom, n_colors=len(groups))
+                for i, (label, group_cells, group_x) in enumerate(groups):
+                    draw_segments(group_cells, group_x, palette[i], label)
             else: 
-                draw_segments(temp_df, COLOR_SECONDARY, "All")
+                draw_segments(cells, cell_x, COLOR_SECONDARY, "All")
 
     # --- NOME DA COLUNA NO EIXO Y ---
     ax.set_ylabel(col_dados, fontsize=12, labelpad=10)
@@ -1024,29 +1468,62 @@ def plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_t
     ax.spines['right'].set_visible(False)
 
     if hue_col:
-        ax.legend(title='Sex/Gender', frameon=True, facecolor='white', edgecolor='#e0e0e0', loc='upper left', bbox_to_anchor=(1.01, 1))
+        ax.legend(handles=legend_handles, title='Sex/Gender', frameon=True, facecolor='white', edgecolor='#e0e0e0', loc='upper left', bbox_to_anchor=(1.01, 1))
         plt.subplots_adjust(right=0.85)
 
     plt.tight_layout()
     return fig
 
+def figure_png(fig) -> bytes:
+    """PNG da figura com as opções do ``st.pyplot`` (dpi 200, bbox ``tight``); fecha a figura."""
+    buffer = io.BytesIO()
+    try:
+        fig.savefig(buffer, format='png', dpi=200, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return buffer.getvalue()
+
+# O gráfico da análise fica guardado já rasterizado: a sessão guarda só os
+# bytes do PNG, e refazer a análise com os mesmos parâmetros não desenha de
+# novo. A chave é a do conteúdo (content_cache_key, que já separa por
+# laboratório) mais tudo o que muda o desenho — colunas, intervalo, tipo,
+# sexos, tendência, faixa de idade e limites de referência (os cortes das
+# linhas de tendência dependem deles). Resumo e cortes vão com ``_``: saem da
+# mesma chave.
+@st.cache_data(show_spinner=False, max_entries=8)
+def _dispersion_chart_cached(chave, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, _cortes, _resumo):
+    fig = plot_dispersion_chart(None, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, cortes=_cortes, chave=chave, resumo=_resumo)
+    return figure_png(fig) if fig else None
+
+def dispersion_chart_png(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, cortes=None, chave=None, resumo=None):
+    """``plot_dispersion_chart`` como bytes PNG (``None`` sem dados), cacheado quando há ``chave``."""
+    if chave is not None:
+        if resumo is None:
+            resumo = summary.AgeSexSummary.from_frame(df, col_idade, col_dados, col_sexo)
+        return _dispersion_chart_cached(chave, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, list(selected_sexes or []), show_trendlines, lista_limites, tuple(age_filter_range), cortes, resumo)
+    fig = plot_dispersion_chart(df, col_idade, col_dados, col_sexo, intervalo, chart_type, group_by_sex, selected_sexes, show_trendlines, lista_limites, age_filter_range, cortes=cortes, resumo=resumo)
+    return figure_png(fig) if fig else None
+
 # Os bytes do arquivo exportado são grandes; guardar só os mais recentes evita
 # acumular na memória todas as exportações já feitas na sessão do servidor.
 #
-# Multilocação: o cache do Streamlit é global do processo, mas estas funções são
-# indexadas pelo próprio DataFrame. Colidir a chave exige dados idênticos, que
-# produzem saída idêntica — nada atravessa entre laboratórios. Ver a regra em
-# security/tenancy.py. Se algum dia a chave passar a ser uma referência (um id,
-# um nome de arquivo), aí é obrigatório incluir tenancy.tenant_cache_key().
+# Como no Harris-Boyd, a chave é a do conteúdo (content_cache_key), não o hash
+# do DataFrame. Multilocação: o cache do Streamlit é global do processo e a
+# chave é uma referência, então content_cache_key já inclui
+# tenancy.tenant_cache_key() — ver a regra em security/tenancy.py.
 @st.cache_data(show_spinner="Preparing file for export...", max_entries=2)
-def to_excel(df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
-    return output.getvalue()
+def _to_excel_cached(chave, _df):
+    return export.excel_bytes(_df)
 
 @st.cache_data(show_spinner="Preparing CSV for export...", max_entries=2)
-def to_csv(df):
-    return df.to_csv(index=False, sep=';', decimal=',', encoding='utf-8-sig').encode('utf-8-sig')
+def _to_csv_cached(chave, _df):
+    return export.csv_bytes(_df)
+
+def to_excel(df, chave=None):
+    return _to_excel_cached(chave, df) if chave is not None else export.excel_bytes(df)
+
+def to_csv(df, chave=None):
+    return _to_csv_cached(chave, df) if chave is not None else export.csv_bytes(df)
 
 # --- USER INTERFACE BUILDER FUNCTIONS ---
 def draw_filter_rules(sex_column_values, column_options):
@@ -1249,7 +1726,13 @@ def main():
         def reset_results_on_upload():
             if 'filtered_result' in st.session_state: del st.session_state['filtered_result']
             if 'filtered_df' in st.session_state: del st.session_state['filtered_df']
+            st.session_state.pop('filtered_fingerprint', None)
+            st.session_state.pop('age_sex_summary_cache', None)
+            if 'filter_rule_counts' in st.session_state: del st.session_state['filter_rule_counts']
+            if 'filtered_rows' in st.session_state: del st.session_state['filtered_rows']
+            st.session_state.filter_mask_cache = RuleMaskCache()
             if 'stratified_results' in st.session_state: del st.session_state['stratified_results']
+            if 'stratified_export' in st.session_state: del st.session_state['stratified_export']
             if 'analysis_params' in st.session_state: del st.session_state['analysis_params']
             if 'analysis_results' in st.session_state: del st.session_state['analysis_results']
             st.session_state.confirm_stratify = False
@@ -1267,11 +1750,33 @@ def main():
             label_visibility="collapsed", disabled=not can_upload,
         )
 
-        if "dados_salvos" not in st.session_state: st.session_state.dados_salvos = None
+        # Modo streaming: só para CSV. O arquivo é filtrado direto do disco pelo
+        # DuckDB e nunca vira DataFrame; a tela usa apenas uma prévia das
+        # primeiras linhas para listar colunas e valores.
+        is_csv_upload = uploaded_file is not None and uploaded_file.name.lower().endswith('.csv')
+        st.checkbox(
+            "Streaming mode (large CSV files: filter from disk without loading the sheet into memory)",
+            key="streaming_mode", on_change=reset_results_on_upload, disabled=not is_csv_upload,
+            help="Only the Filter Tool is available in this mode. Output is CSV or Parquet.",
+        )
+        streaming = is_csv_upload and st.session_state.get('streaming_mode', False)
+
+        # ZIP com várias planilhas (ex.: um arquivo por mês): lê todas, em
+        # paralelo, num único dataset com a coluna "Source file".
+        is_zip_upload = uploaded_file is not None and uploaded_file.name.lower().endswith('.zip')
+        st.checkbox(
+            "Combine every spreadsheet inside the ZIP (adds a 'Source file' column)",
+            key="zip_all_members", on_change=reset_results_on_upload, disabled=not is_zip_upload,
+            help="Without this option only the first CSV/Excel file in the ZIP is read.",
+        )
+        combine_zip = is_zip_upload and st.session_state.get('zip_all_members', False)
+        load_key = (uploaded_file.file_id, streaming, combine_zip) if uploaded_file is not None else None
+
+        if "dados_dataset" not in st.session_state: st.session_state.dados_dataset = None
         if "id_arquivo_atual" not in st.session_state: st.session_state.id_arquivo_atual = None
 
         if uploaded_file is not None:
-            if st.session_state.id_arquivo_atual != uploaded_file.file_id:
+            if st.session_state.id_arquivo_atual != load_key:
                 # Ordem: permissão → limite de taxa → validação do arquivo →
                 # leitura. A leitura é a etapa cara e só acontece por último.
                 if not require_permission(user, PERM_DATA_UPLOAD, "upload"):
@@ -1293,42 +1798,65 @@ def main():
                     st.error(check.reason)
                     st.stop()
 
-                st.session_state.dados_salvos = load_dataframe(uploaded_file, user)
-                st.session_state.id_arquivo_atual = uploaded_file.file_id
+                st.session_state.dados_fingerprint = upload_fingerprint(uploaded_file)
+                if streaming:
+                    replace_dataset(None)
+                    st.session_state.stream_preview = load_csv_preview(uploaded_file, user)
+                else:
+                    st.session_state.stream_preview = None
+                    # Só o cabeçalho fica na sessão; as colunas são lidas da cópia
+                    # em Parquet à medida que cada ferramenta as pede.
+                    replace_dataset(load_dataset(uploaded_file, user, st.session_state.dados_fingerprint, combine_zip))
+                st.session_state.id_arquivo_atual = load_key
 
-                rows = 0 if st.session_state.dados_salvos is None else len(st.session_state.dados_salvos)
+                rows = 0 if st.session_state.dados_dataset is None else len(st.session_state.dados_dataset)
                 audit.record(audit.DATA_UPLOADED, audit.OUTCOME_SUCCESS, actor_id=user.id,
                              actor_email=user.email, org_id=user.org_id,
                              target=check.safe_name,
                              detail={"linhas": rows, "tamanho_kb": check.size_bytes // 1024})
         else:
-            st.session_state.dados_salvos = None
+            replace_dataset(None)
+            st.session_state.stream_preview = None
+            st.session_state.dados_fingerprint = None
             st.session_state.id_arquivo_atual = None
 
-        df = st.session_state.dados_salvos
-        column_options = df.columns.tolist() if df is not None else []
+        dataset = st.session_state.dados_dataset
+        if dataset is not None:
+            # A coluna de resultados nunca vira categoria (normalize_dtypes): ao
+            # trocá-la, as colunas já lidas são descartadas e relidas.
+            data_column = st.session_state.get('col_dados')
+            dataset.set_transform(functools.partial(normalize_dtypes, data_column=data_column), data_column)
+        # No modo streaming as colunas e os valores de sexo vêm da prévia; no
+        # modo normal, só as colunas de idade e sexo são lidas do dataset.
+        config_columns = [c for c in (st.session_state.get('col_sexo'), st.session_state.get('col_idade')) if c]
+        if streaming: config_df = st.session_state.get('stream_preview')
+        else: config_df = dataset.select(config_columns) if dataset is not None else None
+        if streaming: column_options = config_df.columns.tolist() if config_df is not None else []
+        else: column_options = dataset.columns if dataset is not None else []
         
         c1, c2, c3, c4 = st.columns(4)
         with c1: st.selectbox("Age Column", options=column_options, key="col_idade", index=None, placeholder="Select Age column")
         with c2: st.selectbox("Sex/Gender Column", options=column_options, key="col_sexo", index=None, placeholder="Select Sex/Gender")
         with c3: st.selectbox("Data Column", options=column_options, key="col_dados", index=None, placeholder="Select Data Column")
-        with c4: st.selectbox("Output Format", ["CSV (.csv)", "Excel (.xlsx)"], key="output_format")
+        with c4:
+            if streaming: st.selectbox("Output Format", ["CSV (.csv)", "Parquet (.parquet)"], key="stream_output_format")
+            else: st.selectbox("Output Format", ["CSV (.csv)", "Excel (.xlsx)"], key="output_format")
 
         st.session_state.sex_column_is_valid = True
         st.session_state.age_column_is_valid = True
         sex_column_values = []
 
-        if df is not None:
+        if config_df is not None:
             if st.session_state.col_sexo:
                 try:
-                    unique_sex_values = df[st.session_state.col_sexo].dropna().unique()
+                    unique_sex_values = config_df[st.session_state.col_sexo].dropna().unique()
                     if len(unique_sex_values) > 10: st.session_state.sex_column_is_valid = False
                     else: sex_column_values = [""] + list(unique_sex_values)
                 except KeyError: st.session_state.sex_column_is_valid = False
 
             if st.session_state.col_idade:
                 try:
-                    age_col = df[st.session_state.col_idade].dropna()
+                    age_col = config_df[st.session_state.col_idade].dropna()
                     numeric_ages = pd.to_numeric(age_col, errors='coerce')
                     if (numeric_ages.isna().sum() / len(age_col) if len(age_col) > 0 else 0) > 0.2: st.session_state.age_column_is_valid = False
                 except KeyError: st.session_state.age_column_is_valid = False
@@ -1355,31 +1883,70 @@ def main():
         st.markdown('</div></div>', unsafe_allow_html=True)
 
         if st.button("Generate Filtered Sheet", type="primary", use_container_width=True, disabled=not is_ready_for_processing):
-            if df is None: st.error("Please upload a spreadsheet in Global Settings first.")
+            if dataset is None and not streaming: st.error("Please upload a spreadsheet in Global Settings first.")
             elif not guard_processing(user):
                 pass
+            elif streaming:
+                with st.spinner("Streaming filters over the file..."):
+                    progress_bar = st.progress(0, text="Initializing...")
+                    global_config = {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}
+                    out_format = 'parquet' if "Parquet" in st.session_state.stream_output_format else 'csv'
+                    streamed = stream_filtered_export(uploaded_file, st.session_state.filter_rules, global_config, out_format, progress_bar)
+                    if streamed is not None:
+                        export_file, rows = streamed
+                        if rows:
+                            timestamp = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
+                            st.session_state.filtered_result = (export_file, f"Filtered_Sheet_{timestamp}.{out_format}")
+                            st.session_state.filtered_rows = rows
+                        else: st.success("No rows remaining after filters applied.")
             else:
                 with st.spinner("Applying filters..."):
                     progress_bar = st.progress(0, text="Initializing...")
                     processor = get_data_processor()
-                    global_config = {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}
-                    filtered_df = processor.apply_filters(df, st.session_state.filter_rules, global_config, progress_bar)
+                    # Versão numérica só das colunas que as regras citam.
+                    rule_columns = [c.strip() for f in st.session_state.filter_rules if f.get('p_check')
+                                    for c in str(f.get('p_col', '')).split(';') if c.strip()]
+                    referenced = [c for c in rule_columns + [st.session_state.col_idade, st.session_state.col_sexo] if c]
+                    global_config = {
+                        "coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo,
+                        "numeric_view": dataset_numeric_view(dataset, referenced),
+                        "dataset_fingerprint": dataset.cache_key,
+                        "mask_cache": st.session_state.setdefault('filter_mask_cache', RuleMaskCache()),
+                    }
+                    # As regras só leem as colunas citadas; a tabela inteira é
+                    # materializada depois, e só com as linhas que ficam.
+                    keep = processor.filter_mask(dataset.select(referenced), st.session_state.filter_rules, global_config, progress_bar)
+                    filtered_df = dataset.to_frame(keep)
                     if not filtered_df.empty:
+                        # A derivação é identificada pelas linhas que ficaram: o mesmo
+                        # filtro sobre o mesmo upload dá a mesma chave, e os caches de
+                        # exportação, resumo e conversão voltam a valer.
+                        linhas = "todas" if keep is None else hashlib.sha256(np.packbits(keep).tobytes()).hexdigest()
+                        filtered_key = dataset.derive(filtered_df, f"filtro:{linhas}").cache_key
+                        export_key = content_cache_key(user, filtered_key)
                         is_excel = "Excel" in st.session_state.output_format
-                        file_bytes = to_excel(filtered_df) if is_excel else to_csv(filtered_df)
+                        file_bytes = to_excel(filtered_df, export_key) if is_excel else to_csv(filtered_df, export_key)
                         timestamp = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
                         st.session_state.filtered_result = (file_bytes, f"Filtered_Sheet_{timestamp}.{'xlsx' if is_excel else 'csv'}")
                         # Keep the filtered DataFrame in memory so it can feed the
                         # Stratification Tool directly (no download/re-upload round-trip).
                         # It is a subset of the original (<= rows) and is cleared on new upload.
                         st.session_state.filtered_df = filtered_df
+                        st.session_state.filtered_rows = len(filtered_df)
+                        st.session_state.filtered_fingerprint = filtered_key
                     else: st.success("No rows remaining after filters applied.")
         if 'filtered_result' in st.session_state:
             if can_export(user):
-                clicked = st.download_button("⬇️ Download Final Filtered Sheet", data=st.session_state.filtered_result[0], file_name=st.session_state.filtered_result[1], use_container_width=True, type="secondary")
+                payload, file_name = st.session_state.filtered_result
+                # Saída do streaming: o botão lê direto do arquivo em disco.
+                with payload.open() if isinstance(payload, SessionFile) else contextlib.nullcontext(payload) as data:
+                    clicked = st.download_button("⬇️ Download Final Filtered Sheet", data=data, file_name=file_name, use_container_width=True, type="secondary")
                 if clicked:
-                    note_download(user, st.session_state.filtered_result[1],
-                                  rows=len(st.session_state.get('filtered_df', [])))
+                    note_download(user, file_name,
+                                  rows=st.session_state.get('filtered_rows', 0))
+        if st.session_state.get('filter_rule_counts'):
+            with st.expander("Rows excluded by each rule", expanded=False):
+                st.dataframe(pd.DataFrame(st.session_state.filter_rule_counts), use_container_width=True, hide_index=True)
 
     # --- TAB 3: ANALYSIS & STRATIFICATION ---
     with tab_stratify:
@@ -1387,11 +1954,16 @@ def main():
         st.markdown(f'<div class="card-header-bar">Visual-Statistical Analysis and Stratification</div>', unsafe_allow_html=True)
         st.markdown('<div class="card-content-area">', unsafe_allow_html=True)
 
-        if df is not None:
+        if dataset is not None:
             # --- DATA SOURCE SELECTOR (original upload vs. last filtered result) ---
             # Lets the user run the analysis/stratification on the sheet just produced
             # by the Filter Tool without downloading and re-uploading it.
-            source_df = df
+            # The analysis only reads age, data and sex, so only those columns are
+            # fetched from the dataset; stratification materializes every column.
+            analysis_columns = [c for c in (st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo) if c]
+            source_df = dataset.select(analysis_columns)
+            source_fingerprint = dataset.cache_key
+            use_filtered = False
             if st.session_state.get('filtered_df') is not None:
                 choice = st.radio(
                     "Data source for analysis & stratification",
@@ -1402,9 +1974,11 @@ def main():
                 )
                 if choice == "Last filtered result":
                     source_df = st.session_state.filtered_df
+                    source_fingerprint = st.session_state.get('filtered_fingerprint')
+                    use_filtered = True
                 st.caption(
                     f"Using **{choice}** — {len(source_df):,} rows "
-                    f"(uploaded: {len(df):,} · filtered: {len(st.session_state.filtered_df):,})."
+                    f"(uploaded: {len(dataset):,} · filtered: {len(st.session_state.filtered_df):,})."
                 )
 
             if not st.session_state.col_idade or not st.session_state.col_dados:
@@ -1459,33 +2033,33 @@ def main():
                             'ref_limits_list': copy.deepcopy(st.session_state.ref_limits_list)
                         }
 
-                        # 1. PRÉ-CALCULAR O GRÁFICO
                         age_range_safe = p.get('age_filter_range', (min_age_data, max_age_data))
-                        fig = plot_dispersion_chart(source_df, st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo, p['intervalo_plot'], p['chart_type'], p['group_by_sex_plot'], p['selected_sexes_for_plot'], p['show_trendlines'], p['ref_limits_list'], age_range_safe)
-
-                        # A figura é renderizada mais abaixo por st.pyplot(res['fig']).
-                        # O PNG que era gerado aqui (img_buffer) não era usado em lugar
-                        # nenhum, então deixou de ser criado — o gráfico é o mesmo.
-                        if fig:
-                            plt.close(fig)
-
-                        # 2. PRÉ-CALCULAR ESTUDOS (HARRIS-BOYD)
+                        # Idade, sexo e resultado são resumidos uma vez por planilha e
+                        # colunas (engine.summary); gráfico, Harris-Boyd e tabelas de
+                        # mediana leem do resumo, sem voltar às linhas.
+                        resumo = age_sex_summary(source_df, st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo, source_fingerprint)
+                        source_key = content_cache_key(user, source_fingerprint)
+
+                        # 1. PRÉ-CALCULAR ESTUDOS (HARRIS-BOYD)
+                        # Os sexos são partições independentes: rodam juntos no
+                        # run_harris_boyd_panel, e o gráfico reaproveita os cortes.
                         df_possiveis_global_list = []
                         df_ideais_global_list = []
                         any_haeckel_activated_at_all = False
                         hboyd_render_data = []
+                        cortes_grafico = {}
 
                         if p['group_by_sex_plot'] and st.session_state.col_sexo:
-                            sex_options_hboyd = [v for v in sex_column_values if v]
+                            sex_options_hboyd = [v for v in sex_column_values if v and v in p['selected_sexes_for_plot']]
+                            painel = run_harris_boyd_panel(source_df, st.session_state.col_idade, [st.session_state.col_dados], p['ref_limits_list'], st.session_state.col_sexo, sex_options_hboyd, {st.session_state.col_dados: resumo}, source_key)[st.session_state.col_dados]
                             for sex_val in sex_options_hboyd:
-                                if sex_val not in p['selected_sexes_for_plot']: continue
-                                sub_df = source_df[source_df[st.session_state.col_sexo].astype(str) == str(sex_val)].copy()
-                                if sub_df.empty: continue
+                                if str(sex_val) not in painel: continue
 
-                                df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(sub_df, st.session_state.col_idade, st.session_state.col_dados, p['ref_limits_list'], str(sex_val))
+                                df_possiveis, df_ideais, cuts_ideais, h_activated = painel[str(sex_val)]
                                 if h_activated: any_haeckel_activated_at_all = True
+                                cortes_grafico[str(sex_val)] = (harris_boyd_rows(*resumo.partition(str(sex_val))), cuts_ideais)
 
-                                max_age_sub = int(pd.to_numeric(sub_df[st.session_state.col_idade], errors='coerce').max())
+                                max_age_sub = int(resumo.max_age(str(sex_val)))
                                 titulo_metodo_2 = "EDA Haeckel (Practical approach)" if h_activated else "Empirical Analysis of Dispersion and Means (Empirical approach)"
 
                                 hboyd_render_data.append({
@@ -1494,7 +2068,7 @@ def main():
                                     'cuts_ideais': cuts_ideais,
                                     'max_age': max_age_sub,
                                     'titulo_metodo_2': titulo_metodo_2,
-                                    'sub_df': sub_df
+                                    'sexo': str(sex_val)
                                 })
 
                                 if not df_possiveis.empty:
@@ -1502,9 +2076,11 @@ def main():
                                 if not df_ideais.empty:
                                     df_i = df_ideais.copy(); df_i.insert(0, 'Sex', str(sex_val)); df_ideais_global_list.append(df_i)
                         else:
-                            df_possiveis, df_ideais, cuts_ideais, h_activated = run_harris_boyd(source_df, st.session_state.col_idade, st.session_state.col_dados, p['ref_limits_list'], "All")
+                            painel = run_harris_boyd_panel(source_df, st.session_state.col_idade, [st.session_state.col_dados], p['ref_limits_list'], resumos={st.session_state.col_dados: resumo}, chave=source_key)[st.session_state.col_dados]
+                            df_possiveis, df_ideais, cuts_ideais, h_activated = painel["All"]
                             if h_activated: any_haeckel_activated_at_all = True
-                            max_age_full = int(pd.to_numeric(source_df[st.session_state.col_idade], errors='coerce').max())
+                            cortes_grafico["All"] = (harris_boyd_rows(*resumo.partition()), cuts_ideais)
+                            max_age_full = int(resumo.max_age())
                             titulo_metodo_2 = "EDA Haeckel (Practical approach)" if h_activated else "Empirical Analysis of Dispersion and Means (Empirical approach)"
 
                             hboyd_render_data.append({
@@ -1513,18 +2089,24 @@ def main():
                                 'cuts_ideais': cuts_ideais,
                                 'max_age': max_age_full,
                                 'titulo_metodo_2': titulo_metodo_2,
-                                'sub_df': source_df
+                                'sexo': None
                             })
 
                             if not df_possiveis.empty: df_possiveis_global_list.append(df_possiveis)
                             if not df_ideais.empty: df_ideais_global_list.append(df_ideais)
 
+                        # 2. PRÉ-CALCULAR O GRÁFICO
+                        # Sai já como PNG (dispersion_chart_png): a sessão guarda só os
+                        # bytes, e os reruns mostram a imagem sem rasterizar a figura.
+                        fig_png = dispersion_chart_png(source_df, st.session_state.col_idade, st.session_state.col_dados, st.session_state.col_sexo, p['intervalo_plot'], p['chart_type'], p['group_by_sex_plot'], p['selected_sexes_for_plot'], p['show_trendlines'], p['ref_limits_list'], age_range_safe, cortes=cortes_grafico, chave=source_key, resumo=resumo)
+
                         valid_haeckel_rows = [r for r in p['ref_limits_list'] if r.get('lrs') is not None and r.get('lrs') > 0]
 
                         # 3. SALVAR ARTEFATOS FINAIS NO ESTADO DA SESSÃO
                         st.session_state.analysis_results = {
-                            'fig': fig,
+                            'fig_png': fig_png,
                             'hboyd_render_data': hboyd_render_data,
+                            'resumo': resumo,
                             'group_by_sex_plot': p['group_by_sex_plot'],
                             'valid_haeckel_rows': valid_haeckel_rows,
                             'df_possiveis_global_list': df_possiveis_global_list,
@@ -1542,7 +2124,9 @@ def main():
                     col_grafico, col_hboyd = st.columns([2.8, 1.2], gap="large")
 
                     with col_grafico:
-                        if res['fig']: st.pyplot(res['fig'])
+                        # Mesma largura do st.pyplot (a da coluna); use_column_width
+                        # porque o requirements fixa streamlit 1.32.2.
+                        if res.get('fig_png'): st.image(res['fig_png'], use_column_width=True, output_format='PNG')
 
                     with col_hboyd:
                         st.markdown('<div class="card-header-bar" style="margin: -1rem -1rem 1rem -1rem; border-radius: 5px 5px 0 0; padding: 10px 15px; font-size: 1.1rem; text-align: center;">Stratification Studies</div>', unsafe_allow_html=True)
@@ -1556,8 +2140,8 @@ def main():
                                 # Streamlit para todo o bloco, então o escape é por nossa conta.
                                 st.markdown(f"<hr style='border-color: rgba(7, 59, 76, 0.2); margin: 10px 0;'><p style='font-size:1.0rem; color:{COLOR_PRIMARY}; margin-bottom:2px;'><b>Sex: {sanitize.escape_html(data['sex_val'])}</b></p>", unsafe_allow_html=True)
 
-                            render_mini_tabela("Harris-Boyd (Statistical approach)", data['df_possiveis_age'], data['max_age'], data['sub_df'], st.session_state.col_idade, st.session_state.col_dados)
-                            render_mini_tabela(data['titulo_metodo_2'], data['cuts_ideais'], data['max_age'], data['sub_df'], st.session_state.col_idade, st.session_state.col_dados)
+                            render_mini_tabela("Harris-Boyd (Statistical approach)", data['df_possiveis_age'], data['max_age'], res['resumo'], data['sexo'])
+                            render_mini_tabela(data['titulo_metodo_2'], data['cuts_ideais'], data['max_age'], res['resumo'], data['sexo'])
                         st.markdown("</div>", unsafe_allow_html=True)
 
                     # --- MULTIPARAMETRIC HAECKEL AUDIT TABLES ---
@@ -1567,7 +2151,7 @@ def main():
                             st.markdown("<p style='font-size:0.9rem; color:#666;'>Verifiable mirror containing the thorough step-by-step math performed to obtain performance limits.</p>", unsafe_allow_html=True)
                             
                             for r_item in res['valid_haeckel_rows']:
-                                h = calcular_limites_haeckel(r_item.get('lri'), r_item.get('lrs'))
+                                h = haeckel.calcular_limites_haeckel(r_item.get('lri'), r_item.get('lrs'))
                                 if not h: continue
                                 
                                 faixa_etaria_label = f"{r_item['age_min']} to {r_item['age_max']} years" if (r_item['age_min'] is not None or r_item['age_max'] is not None) else "Global"
@@ -1681,7 +2265,10 @@ def main():
                             processor = get_data_processor()
                             age_rules = [r for r in st.session_state.stratum_rules if r.get('val1')]
                             sex_rules = [{'value': gender_val, 'name': str(gender_val)} for gender_val, is_selected in st.session_state.get('strat_gender_selection', {}).items() if is_selected]
-                            st.session_state.stratified_results = processor.apply_stratification(source_df.copy(), {'ages': age_rules, 'sexes': sex_rules}, {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo}, progress_bar)
+                            st.session_state.pop('stratified_export', None)
+                            strat_df = st.session_state.filtered_df if use_filtered else dataset.to_frame()
+                            numeric_view = dataset_numeric_view(dataset, [st.session_state.col_idade])
+                            st.session_state.stratified_results = processor.apply_stratification(strat_df, {'ages': age_rules, 'sexes': sex_rules}, {"coluna_idade": st.session_state.col_idade, "coluna_sexo": st.session_state.col_sexo, "numeric_view": numeric_view}, progress_bar)
                         st.session_state.confirm_stratify = False
                         st.rerun()
                     if c2.button("Cancel"):
@@ -1708,19 +2295,30 @@ def main():
                         )
 
                     if can_export(user):
+                        # Cada estrato é serializado uma única vez (em paralelo, um
+                        # processo por estrato) e os mesmos bytes servem ao ZIP e aos
+                        # botões individuais. Refeito só quando muda o formato ou a
+                        # estratificação.
+                        exported = st.session_state.get('stratified_export')
+                        if exported is None or exported[0] != ext:
+                            with st.spinner("Preparing strata for export..."):
+                                strata_files = export.serialize_strata(results, ext)
+                                zip_buffer = io.BytesIO()
+                                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+                                    for filename, file_bytes in strata_files.items():
+                                        # safe_filename: o nome do estrato deriva de valores da
+                                        # planilha (ex.: rótulo da coluna Sexo) e vira caminho
+                                        # dentro do ZIP.
+                                        zf.writestr(f"{safe_filename(filename)}.{ext}", file_bytes)
+                            exported = (ext, strata_files, zip_buffer.getvalue())
+                            st.session_state.stratified_export = exported
+                        _, strata_files, zip_bytes = exported
+
                         # --- Single ZIP with every stratum (avoids many separate clicks) ---
-                        zip_buffer = io.BytesIO()
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                            for filename, df_to_download in results.items():
-                                file_bytes = to_excel(df_to_download) if is_excel else to_csv(df_to_download)
-                                # safe_filename: o nome do estrato deriva de valores da
-                                # planilha (ex.: rótulo da coluna Sexo) e vira caminho
-                                # dentro do ZIP.
-                                zf.writestr(f"{safe_filename(filename)}.{ext}", file_bytes)
                         zip_ts = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%Y%m%d_%H%M%S")
                         if st.download_button(
                             f"⬇️ Download all {len(results)} strata (.zip)",
-                            data=zip_buffer.getvalue(),
+                            data=zip_bytes,
                             file_name=f"Stratified_Sheets_{zip_ts}.zip",
                             mime="application/zip",
                             use_container_width=True,
@@ -1735,40 +2333,30 @@ def main():
                             for filename, df_to_download in results.items():
                                 n = len(df_to_download)
                                 flag = "  ⚠️ N<120" if n < MIN_REF_N else ""
-                                file_bytes = to_excel(df_to_download) if is_excel else to_csv(df_to_download)
                                 if st.download_button(
                                     f"📄 {filename}  ·  n={n:,}{flag}",
-                                    data=file_bytes,
+                                    data=strata_files[filename],
                                     file_name=f"{safe_filename(filename)}.{ext}",
                                     key=f"dl_{filename}",
                                     type="secondary",
                                 ):
                                     note_download(user, filename, rows=n)
+        elif streaming:
+            st.info("⚠️ Streaming mode only supports the Filter Tool. Turn it off in Global Settings to run the analysis and stratification.")
         else:
             st.info("⚠️ Please upload a spreadsheet to access the analysis and stratification tools.")
         st.markdown('</div></div>', unsafe_allow_html=True)
 
 # Nova função render_mini_tabela que recebe o df para cálculo da mediana
-def render_mini_tabela(titulo, cuts, max_age, df_context, col_idade, col_dados):
+def render_mini_tabela(titulo, cuts, max_age, resumo, sexo=None):
     st.markdown(f"<p style='font-size:0.85rem; color:#41A0C4; font-weight: 600; margin-bottom:5px; margin-top:15px; text-transform: uppercase;'>{titulo}:</p>", unsafe_allow_html=True)
     if not cuts:
         st.markdown(f"<p style='font-weight:bold; font-size:0.95rem; color:{COLOR_SECONDARY};'>No stratification needed</p>", unsafe_allow_html=True)
         return
     
-    # Limpa e filtra as colunas para o cálculo exato da mediana
-    def clean_val(x):
-        if pd.isna(x): return np.nan
-        x = str(x).replace(',', '.')
-        x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
-        try: return float(x)
-        except: return np.nan
-        
-    t_age = pd.to_numeric(df_context[col_idade], errors='coerce')
-    t_data = pd.to_numeric(df_context[col_dados].apply(clean_val), errors='coerce')
-
     def get_med_str(amin, amax):
-        # Filtra a faixa etária especificada e extrai a mediana
-        m = t_data[(t_age >= amin) & (t_age <= amax)].median()
+        # Mediana exata da faixa, juntando as células (idade, sexo) do resumo
+        m = resumo.median(amin, amax, sexo)
         if pd.isna(m): return "- Mediana: N/A"
         
         # Formata com 2 casas decimais e substitui ponto por vírgula no padrão brasileiro
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de dados do DataSift.
+
+Código de leitura, conversão e exportação de planilhas que é compartilhado
+entre o ``app.py`` e as páginas em ``pages/``. Nada aqui desenha tela: os
+módulos recebem e devolvem DataFrames e bytes, e podem ser importados (e
+executados em processos auxiliares) fora de um runtime Streamlit.
+
+Módulos:
+
+- ``dataset``       — handle preguiçoso da planilha carregada (leitura por coluna).
+- ``export``        — serialização de DataFrames para CSV/XLSX, inclusive em paralelo.
+- ``haeckel``       — limites de referência casados por idade/sexo e a aproximação de Haeckel.
+- ``harris_boyd``   — busca dos cortes de idade de Harris-Boyd por somas acumuladas.
+- ``numeric``       — conversão vetorizada de colunas de resultado para float.
+- ``readers``       — leitura de CSV com o PyArrow, dialeto detectado por ``sniff``.
+- ``sniff``         — detecção de separador, decimal e encoding de CSV por amostra.
+- ``summary``       — resultados por célula sexo × idade (contagem, soma, soma dos quadrados e valores ordenados).
+- ``upload_cache``  — cache em disco (Parquet) das planilhas lidas, por conteúdo.
+- ``xlsx``          — leitura de XLSX em fluxo, sem o modelo de células do openpyxl.
+"""
+
+__all__ = [
+    "dataset",
+    "export",
+    "haeckel",
+    "harris_boyd",
+    "numeric",
+    "readers",
+    "sniff",
+    "summary",
+    "upload_cache",
+    "xlsx",
+]
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Handle preguiçoso para a planilha carregada.
+
+Depois do upload o app guardava o DataFrame inteiro na sessão, mesmo que a
+análise de dispersão e o Harris-Boyd só leiam três colunas (idade, sexo,
+resultado) e o filtro só leia as colunas citadas nas regras. Em exportações
+largas do LIS, com 150+ analitos, isso é quase tudo memória desperdiçada —
+multiplicada pelo número de sessões abertas no mesmo processo.
+
+O :class:`Dataset` guarda só o cabeçalho e uma referência à cópia em Parquet
+do ``engine.upload_cache``. :meth:`Dataset.select` lê do Parquet apenas as
+colunas pedidas (e as mantém para as próximas execuções do script);
+:meth:`Dataset.to_frame` materializa a tabela inteira, sem guardar, para as
+operações que de fato devolvem todas as colunas (filtro, estratificação).
+
+O arquivo é aberto por ``memory_map`` na criação do handle e fica aberto
+enquanto ele existir: se a entrada sair do cache por TTL ou por falta de
+espaço, o mapeamento continua válido até o fim da sessão.
+
+Quando não há cópia em Parquet (cache desligado, ou DataFrame que o Parquet
+não representa) o handle embrulha o DataFrame já lido, com a mesma interface.
+
+A normalização (``transform``) roda sobre cada leitura e pode depender da
+escolha do usuário — a coluna de resultados nunca vira categoria. Quem a
+troca chama :meth:`Dataset.set_transform` com uma chave que a identifica; se
+a chave mudou, as colunas já lidas são descartadas e relidas com a nova.
+
+:attr:`Dataset.cache_key` identifica o conteúdo sem ler a tabela: a
+impressão digital do upload (SHA-256 dos bytes, calculado uma vez, e o
+leitor que fez o parse) mais a versão — quantas derivações (filtro,
+estratificação, recorte por sexo) separam o handle do upload, e quais. As
+funções com ``st.cache_data`` do ``app.py`` usam essa chave em vez de fazer
+o hash do DataFrame inteiro a cada execução do script.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+Transform = Callable[[pd.DataFrame], pd.DataFrame]
+
+# Linhas por lote na leitura filtrada do Parquet (``Dataset.to_frame(rows)``).
+FILTER_BATCH_ROWS = 65_536
+
+
+class Dataset:
+    """Planilha carregada, lida coluna a coluna sob demanda."""
+
+    def __init__(self, columns: List[str], n_rows: int, fingerprint: Optional[str] = None,
+                 parquet=None, frame: Optional[pd.DataFrame] = None,
+                 transform: Optional[Transform] = None, lineage: Tuple[str, ...] = ()):
+        self.columns = list(columns)
+        self.n_rows = int(n_rows)
+        self.fingerprint = fingerprint
+        self.lineage = tuple(lineage)
+        self._parquet = parquet
+        self._source = None
+        self._frame = frame
+        self._transform = transform
+        self._transform_key: Hashable = None
+        self._loaded: Dict[str, pd.Series] = {}
+
+    @classmethod
+    def from_parquet(cls, path, fingerprint: Optional[str] = None, transform: Optional[Transform] = None) -> "Dataset":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        source = pa.memory_map(str(path))
+        parquet = pq.ParquetFile(source)
+        dataset = cls(parquet.schema_arrow.names, parquet.metadata.num_rows, fingerprint,
+                      parquet=parquet, transform=transform)
+        dataset._source = source
+        return dataset
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, fingerprint: Optional[str] = None, transform: Optional[Transform] = None) -> "Dataset":
+        # O DataFrame fica como foi lido; ``transform`` roda a cada leitura,
+        # como no Parquet, para que set_transform possa refazê-la.
+        return cls(df.columns.tolist(), len(df), fingerprint, frame=df, transform=transform)
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    @property
+    def version(self) -> int:
+        """Número de derivações desde o upload (0 no próprio upload)."""
+        return len(self.lineage)
+
+    @property
+    def cache_key(self) -> Optional[str]:
+        """Impressão digital mais versão; ``None`` se o handle não tem impressão digital."""
+        key = self.fingerprint
+        for step in self.lineage:
+            key = derived_key(key, step)
+        return key
+
+    def derive(self, df: pd.DataFrame, step: str) -> "Dataset":
+        """
+        Handle para ``df``, derivado deste por ``step``, com a versão seguinte.
+
+        ``step`` precisa descrever a derivação por completo — dois resultados
+        diferentes a partir do mesmo handle exigem passos diferentes.
+        """
+        return Dataset(df.columns.tolist(), len(df), self.fingerprint, frame=df,
+                       lineage=self.lineage + (str(step),))
+
+    def set_transform(self, transform: Optional[Transform], key: Hashable) -> None:
+        """
+        Troca a normalização das leituras. ``key`` identifica a normalização:
+        com a mesma chave nada muda; com outra, as colunas já lidas são
+        descartadas e relidas sob demanda.
+        """
+        if key == self._transform_key:
+            return
+        self._transform = transform
+        self._transform_key = key
+        self._loaded.clear()
+
+    def _read(self, columns: Optional[List[str]]) -> pd.DataFrame:
+        if self._parquet is not None:
+            df = self._parquet.read(columns=columns, use_pandas_metadata=True).to_pandas()
+        else:
+            df = self._frame if columns is None else self._frame[columns]
+        return self._transform(df) if self._transform is not None else df
+
+    def select(self, columns: Iterable[str]) -> pd.DataFrame:
+        """
+        Só as colunas pedidas, na ordem pedida. Nomes que não existem na
+        planilha são ignorados, e repetidos aparecem uma vez.
+        """
+        wanted = [c for c in dict.fromkeys(columns) if c in self.columns]
+        if self._frame is not None and self._transform is None:
+            return self._frame[wanted]
+        missing = [c for c in wanted if c not in self._loaded]
+        if missing:
+            part = self._read(missing)
+            for name in missing:
+                self._loaded[name] = part[name]
+        if not wanted:
+            return pd.DataFrame(index=pd.RangeIndex(self.n_rows))
+        return pd.DataFrame({name: self._loaded[name] for name in wanted})
+
+    def to_frame(self, rows: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """
+        Tabela inteira, ou só as linhas marcadas na máscara booleana ``rows``
+        (com os rótulos de índice originais). Não fica guardada no handle.
+
+        Com ``rows``, o Parquet é lido numa passada só, em lotes de
+        ``FILTER_BATCH_ROWS``, e cada lote é filtrado antes do próximo: a
+        tabela inteira nunca fica na memória, só as linhas que ficam.
+        """
+        if self._parquet is None:
+            df = self._frame if rows is None else self._frame[rows]
+            return self._transform(df) if self._transform is not None else df
+        if rows is None:
+            return self._read(None)
+        import pyarrow as pa
+
+        rows = np.asarray(rows, dtype=bool)
+        kept = []
+        offset = 0
+        for batch in self._parquet.iter_batches(batch_size=FILTER_BATCH_ROWS, use_pandas_metadata=True):
+            part = rows[offset:offset + batch.num_rows]
+            offset += batch.num_rows
+            if part.any():
+                kept.append(batch.filter(pa.array(part)))
+        schema = kept[0].schema if kept else self._parquet.schema_arrow
+        df = pa.Table.from_batches(kept, schema=schema).to_pandas()
+        # Índice guardado como coluna já vem filtrado com as linhas; o
+        # RangeIndex do pandas fica só nos metadados e é refeito aqui.
+        index_columns = (self._parquet.schema_arrow.pandas_metadata or {}).get('index_columns', [])
+        if not any(isinstance(c, str) for c in index_columns):
+            positions = np.flatnonzero(rows)
+            ranged = next((c for c in index_columns if isinstance(c, dict) and c.get('kind') == 'range'), None)
+            if ranged is not None:
+                positions = ranged['start'] + ranged['step'] * positions
+            df.index = pd.Index(positions, name=ranged.get('name') if ranged else None)
+        return self._transform(df) if self._transform is not None else df
+
+    def close(self) -> None:
+        """Fecha o Parquet mapeado em memória. O handle não pode mais ler colunas novas."""
+        if self._parquet is not None:
+            self._parquet.close(force=True)
+        if self._source is not None:
+            self._source.close()
+
+def derived_key(key: Optional[str], step: str) -> Optional[str]:
+    """Chave de cache de um recorte/derivação de ``key`` (``None`` continua ``None``)."""
+    if key is None:
+        return None
+    return f"{key}>{step}"
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Exportação de DataFrames para download.
+
+As funções daqui devolvem os bytes finais do arquivo. O cache do Streamlit
+fica no ``app.py`` (``to_excel``/``to_csv``); este módulo é puro para poder
+rodar dentro de um processo auxiliar, onde não existe sessão nem cache.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Dict, Iterable, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+# Linhas formatadas por vez na exportação CSV.
+CSV_CHUNK_ROWS = 50_000
+
+# Abaixo deste total de linhas o custo de subir os processos (cada um importa
+# pandas/openpyxl) é maior que o ganho; a exportação roda no próprio processo.
+PARALLEL_MIN_ROWS = 50_000
+
+
+def _excel_column_values(series: pd.Series) -> list:
+    """Valores da coluna como objetos Python, com vazio no lugar de NaN/NaT."""
+    values = series.astype(object)
+    if pd.api.types.is_float_dtype(series.dtype):
+        # Mesma representação do pandas.to_excel (inf_rep='inf').
+        values = values.mask(np.isposinf(series), 'inf').mask(np.isneginf(series), '-inf')
+    return values.where(series.notna(), None).tolist()
+
+
+def excel_bytes(df: pd.DataFrame, sheet_name: str = 'Sheet1', centered: bool = False,
+                cols_2dec: Optional[Iterable[str]] = None, autofit: bool = False) -> bytes:
+    """
+    XLSX gravado em modo *write-only* do openpyxl.
+
+    O ``ExcelWriter`` monta a planilha inteira como objetos ``Cell`` na
+    memória antes de salvar, e os acabamentos das páginas (centralizar, duas
+    casas decimais) eram aplicados célula a célula depois disso. Aqui cada
+    linha é serializada para o arquivo assim que é anexada, e o estilo é
+    definido uma vez por coluna: uma célula-modelo estilizada por coluna é
+    reaproveitada em todas as linhas, só trocando o valor.
+
+    - ``centered`` centraliza cabeçalho e dados;
+    - ``cols_2dec`` exibe essas colunas com formato ``0.00``;
+    - ``autofit`` ajusta a largura ao maior conteúdo (limitada a 60).
+
+    O cabeçalho tem o mesmo estilo do ``pandas.to_excel`` (negrito, borda fina).
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+    from openpyxl.utils import get_column_letter
+
+    cols_2dec = set(cols_2dec or [])
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+
+    columns = [str(col) for col in df.columns]
+    if autofit:
+        for i, col in enumerate(df.columns, start=1):
+            largura = len(columns[i - 1])
+            if len(df):
+                largura = max(largura, int(df[col].astype(str).str.len().max()))
+            ws.column_dimensions[get_column_letter(i)].width = min(largura + 2, 60)
+
+    thin = Side(style='thin')
+    header_align = Alignment(horizontal='center', vertical='center' if centered else 'top')
+    header = []
+    for name in columns:
+        cell = WriteOnlyCell(ws, value=name)
+        cell.font = Font(bold=True)
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        cell.alignment = header_align
+        header.append(cell)
+    ws.append(header)
+
+    # Células-modelo só para as colunas que têm estilo; as demais recebem o
+    # valor cru, que é o caminho mais rápido do openpyxl.
+    templates = []
+    for col in df.columns:
+        if not centered and col not in cols_2dec:
+            templates.append(None)
+            continue
+        cell = WriteOnlyCell(ws)
+        if centered:
+            cell.alignment = Alignment(horizontal='center', vertical='center')
+        if col in cols_2dec:
+            cell.number_format = '0.00'
+        templates.append(cell)
+
+    data = [_excel_column_values(df.iloc[:, i]) for i in range(df.shape[1])]
+    if any(t is not None for t in templates):
+        for values in zip(*data):
+            row = []
+            for template, value in zip(templates, values):
+                if template is None:
+                    row.append(value)
+                else:
+                    template.value = value
+                    row.append(template)
+            ws.append(row)
+    else:
+        for values in zip(*data):
+            ws.append(values)
+
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def csv_bytes(df: pd.DataFrame) -> bytes:
+    """
+    CSV no padrão brasileiro (``;`` e vírgula decimal), com BOM.
+
+    Escreve direto em bytes, em blocos de ``CSV_CHUNK_ROWS`` linhas: o pandas
+    codifica cada bloco assim que o formata, então o arquivo nunca existe
+    inteiro como str antes de virar bytes. O BOM vem do próprio codec
+    utf-8-sig, e o resultado é idêntico byte a byte ao de
+    ``df.to_csv(...).encode('utf-8-sig')``.
+    """
+    output = io.BytesIO()
+    df.to_csv(output, index=False, sep=';', decimal=',', encoding='utf-8-sig', chunksize=CSV_CHUNK_ROWS)
+    return output.getvalue()
+
+
+def file_bytes(df: pd.DataFrame, ext: str) -> bytes:
+    """Bytes do arquivo no formato ``ext`` (``'xlsx'`` ou ``'csv'``)."""
+    return excel_bytes(df) if ext == 'xlsx' else csv_bytes(df)
+
+
+def serialize_strata(strata: Mapping[str, pd.DataFrame], ext: str, max_workers: Optional[int] = None) -> Dict[str, bytes]:
+    """
+    Serializa cada estrato em um arquivo, um processo por estrato.
+
+    A geração de XLSX pelo openpyxl é CPU pura e segura o GIL, então threads
+    não ajudam; processos sim. O contexto é ``spawn``: o servidor do
+    Streamlit tem várias threads vivas, e ``fork`` nesse estado pode herdar
+    um lock travado. Devolve ``{nome: bytes}`` na mesma ordem de ``strata``.
+
+    Se o pool não puder ser criado ou morrer (limite de processos do host,
+    memória), cai para a serialização sequencial — o resultado é o mesmo.
+    """
+    names = list(strata)
+    workers = min(len(names), max_workers or os.cpu_count() or 1)
+    total_rows = sum(len(df) for df in strata.values())
+    if workers > 1 and total_rows >= PARALLEL_MIN_ROWS:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+                payloads = pool.map(file_bytes, [strata[name] for name in names], [ext] * len(names))
+                return dict(zip(names, payloads))
+        except (BrokenProcessPool, OSError):
+            pass
+    return {name: file_bytes(strata[name], ext) for name in names}
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Limites de referência e a aproximação de Haeckel.
+
+Funções que eram do ``app.py`` e agora também rodam dentro da análise de
+Harris-Boyd em processos auxiliares (``harris_boyd.analyze_many``), onde o
+``app.py`` — um script Streamlit — não pode ser importado:
+
+- :func:`calcular_limites_haeckel` — PSA, CVA e viés desejáveis a partir do
+  intervalo de referência (LRI, LRS);
+- :func:`encontrar_limites_casados` — a linha da tabela de limites que vale
+  para uma idade e um sexo;
+- :class:`ReferenceLimitIndex` — a mesma consulta sobre a tabela compilada,
+  para uma idade ou um array de idades de uma vez.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import List, Optional
+
+import numpy as np
+
+
+def calcular_limites_haeckel(lri: float, lrs: float):
+    # Interceptação para conversão automática do LRI para 15% do LRS
+    # se o LRI for vazio (None) ou igual a 0.0, DESDE que o LRS seja um valor válido.
+    if lrs is not None and lrs > 0:
+        if lri is None or lri <= 0:
+            lri = 0.15 * lrs
+            
+    if lri is None or lrs is None or lri <= 0 or lrs <= lri:
+        return None
+    
+    se_ln = (math.log(lrs) - math.log(lri)) / 3.92
+    med_ln_val = (math.log(lri) + math.log(lrs)) / 2
+    med = math.exp(med_ln_val)
+    
+    cve_star = 100 * math.sqrt(math.exp(se_ln**2) - 1)
+    val_to_sqrt = cve_star - 0.25
+    pcva = math.sqrt(val_to_sqrt) if val_to_sqrt >= 0 else 0
+    psa_med = pcva * 0.01 * med
+    
+    slope = (psa_med - 0.2 * psa_med) / med
+    intercept = 0.2 * psa_med
+    
+    def calc_for_x(x):
+        if x <= 0: return {'psa': 0, 'pcva': 0, 'pb': 0}
+        psa_x = slope * x + intercept
+        pcva_x = (psa_x / x) * 100
+        pb_x = pcva_x * 0.70
+        return {'psa': psa_x, 'pcva': pcva_x, 'pb': pb_x}
+    
+    return {
+        'lri': lri, 'lrs': lrs, 'cve': cve_star, 'pcva': pcva, 'med': med,
+        'psa_med': psa_med, 'slope': slope, 'intercept': intercept,
+        'm_lri': calc_for_x(lri), 'm_lrs': calc_for_x(lrs)
+    }
+
+
+def encontrar_limites_casados(idade: float, sexo: str, lista_limites: list) -> Optional[dict]:
+    if not lista_limites: return None
+    sexo_str = str(sexo).strip().lower() if sexo else ""
+    
+    filtrados_sexo = []
+    for item in lista_limites:
+        s_lim = str(item.get('sex', '')).strip().lower()
+        if s_lim in ('all', 'todos', '', sexo_str):
+            filtrados_sexo.append(item)
+            
+    if not filtrados_sexo: return None
+    
+    com_idade = [item for item in filtrados_sexo if item.get('age_min') is not None or item.get('age_max') is not None]
+    globais = [item for item in filtrados_sexo if item.get('age_min') is None and item.get('age_max') is None]
+    
+    if not com_idade:
+        for g in globais:
+            if str(g.get('sex', '')).strip().lower() == sexo_str: return g
+        return globais[0] if globais else None
+        
+    match_direto = []
+    for item in com_idade:
+        amin = item.get('age_min') if item.get('age_min') is not None else 0
+        amax = item.get('age_max') if item.get('age_max') is not None else 9999
+        if amin <= idade <= amax:
+            match_direto.append(item)
+            
+    if match_direto:
+        for m in match_direto:
+            if str(m.get('sex', '')).strip().lower() == sexo_str: return m
+        return match_direto[0]
+        
+    ordenados_por_min = sorted(com_idade, key=lambda x: x.get('age_min') if x.get('age_min') is not None else 0)
+    menor_idade = ordenados_por_min[0].get('age_min', 0) if ordenados_por_min[0].get('age_min') is not None else 0
+    
+    if idade < menor_idade:
+        for o in ordenados_por_min:
+            if str(o.get('sex', '')).strip().lower() == sexo_str: return o
+        return ordenados_por_min[0]
+        
+    ordenados_por_max = sorted(com_idade, key=lambda x: x.get('age_max') if x.get('age_max') is not None else 9999, reverse=True)
+    maior_idade = ordenados_por_max[0].get('age_max', 9999) if ordenados_por_max[0].get('age_max') is not None else 9999
+    
+    if idade > maior_idade:
+        for o in ordenados_por_max:
+            if str(o.get('sex', '')).strip().lower() == sexo_str: return o
+        return ordenados_por_max[0]
+        
+    return globais[0] if globais else None
+
+
+def _coeficientes(item: dict) -> Optional[dict]:
+    """Haeckel da linha casada, com a mesma condição da trilha do Harris-Boyd."""
+    if item and item.get('lrs') is not None and item.get('lrs') > 0:
+        return calcular_limites_haeckel(item.get('lri'), item.get('lrs'))
+    return None
+
+
+class _SexTable:
+    """Resposta de :func:`encontrar_limites_casados` por trecho de idade, para um sexo."""
+
+    def __init__(self, lista_limites: list, sexo: str):
+        itens = lista_limites or []
+        posicao = {id(item): i for i, item in enumerate(itens)}
+        # Os extremos de todas as faixas dividem o eixo de idade em trechos
+        # onde a resposta não muda: cada extremo e cada intervalo aberto entre
+        # dois extremos. O padrão de idade ausente (0 e 9999) também é extremo.
+        extremos = {0.0, 9999.0}
+        for item in itens:
+            for chave in ('age_min', 'age_max'):
+                if item.get(chave) is not None:
+                    extremos.add(float(item[chave]))
+        self.points = np.array(sorted(extremos), dtype='float64')
+
+        # Um representante por trecho, resolvido pela função original:
+        # abaixo do primeiro extremo, cada extremo, o meio de cada intervalo
+        # e acima do último; por fim, a idade ausente (NaN).
+        representantes = [self.points[0] - 1.0]
+        for i, ponto in enumerate(self.points):
+            representantes.append(ponto)
+            proximo = self.points[i + 1] if i + 1 < len(self.points) else ponto + 2.0
+            representantes.append((ponto + proximo) / 2)
+        representantes.append(float('nan'))
+
+        respostas = []
+        for idade in representantes:
+            casado = encontrar_limites_casados(idade, sexo, itens)
+            respostas.append(-1 if casado is None else posicao[id(casado)])
+        self.answers = np.array(respostas, dtype=np.int64)
+
+    def regions(self, idades: np.ndarray) -> np.ndarray:
+        i = np.searchsorted(self.points, idades, side='left')
+        no_ponto = (i < len(self.points)) & (self.points[np.minimum(i, len(self.points) - 1)] == idades)
+        regiao = np.where(no_ponto, 2 * i + 1, 2 * i)
+        return np.where(np.isnan(idades), len(self.answers) - 1, regiao)
+
+
+class ReferenceLimitIndex:
+    """
+    A tabela de limites de referência compilada uma vez por análise.
+
+    :func:`encontrar_limites_casados` filtra e reordena a lista inteira a
+    cada chamada, e a trilha de Haeckel a chamava uma vez por idade, seguida
+    de :func:`calcular_limites_haeckel` para a mesma linha. Aqui, por sexo
+    (compilado na primeira consulta), o eixo de idade vira uma lista ordenada
+    de trechos com a linha casada de cada um; a consulta é um
+    ``searchsorted`` — O(log k) — e os coeficientes de Haeckel de cada linha
+    são calculados uma vez só. As respostas são as da função original.
+    """
+
+    def __init__(self, lista_limites: Optional[list]):
+        self.lista_limites = list(lista_limites or [])
+        self.coeficientes = [_coeficientes(item) for item in self.lista_limites]
+        self._tables = {}
+
+    def _table(self, sexo: str) -> _SexTable:
+        chave = str(sexo).strip().lower() if sexo else ""
+        table = self._tables.get(chave)
+        if table is None:
+            table = self._tables[chave] = _SexTable(self.lista_limites, sexo)
+        return table
+
+    def match_many(self, idades, sexo: str) -> np.ndarray:
+        """Posição em ``lista_limites`` da linha casada de cada idade; -1 se nenhuma."""
+        idades = np.asarray(idades, dtype='float64')
+        table = self._table(sexo)
+        return table.answers[table.regions(idades)]
+
+    def match(self, idade: float, sexo: str) -> Optional[dict]:
+        """Mesmo resultado de ``encontrar_limites_casados(idade, sexo, lista_limites)``."""
+        i = int(self.match_many([idade], sexo)[0])
+        return self.lista_limites[i] if i >= 0 else None
+
+    def haeckel_many(self, idades, sexo: str) -> List[Optional[dict]]:
+        """Coeficientes de Haeckel da linha casada de cada idade (``None`` sem LRS)."""
+        return [self.coeficientes[i] if i >= 0 else None for i in self.match_many(idades, sexo)]
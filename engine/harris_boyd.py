@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Busca dos cortes de idade de Harris-Boyd por somas acumuladas.
+
+O ``find_best_cut`` original do ``run_harris_boyd`` testava cada idade
+inteira entre a mínima e a máxima filtrando o DataFrame duas vezes e
+recalculando média e variância do zero: O(idades × n) por nível, repetido
+em até seis níveis de recursão. Com 1 milhão de resultados, dezenas de
+segundos por analito.
+
+Aqui os resultados são ordenados por idade uma vez. Cada partição da
+recursão vira um intervalo contíguo de linhas, e n, soma e soma dos
+quadrados de qualquer um dos dois lados de um corte saem de somas
+acumuladas em O(1) — todos os cortes de uma partição são avaliados de uma
+vez, em O(idades).
+
+A regra de decisão é a mesma (razão de DP > 1,5 ou z > z crítico, fica o
+maior z significativo, mínimo de 30 por lado). Somas de quadrados perdem
+precisão perto de zero e nas fronteiras, então todo corte em que o
+arredondamento poderia mudar a decisão — variância quase nula, razão de DP
+ou z a um fio do limite, z empatado com o melhor — é refeito pelo cálculo
+direto (``np.var`` em duas passadas) antes de decidir. Os cortes escolhidos
+e os valores exibidos são os do cálculo original.
+
+:func:`tukey_fences` é a remoção iterativa de outliers que precede a busca,
+sobre a coluna ordenada uma vez em vez de uma cópia do DataFrame por
+iteração.
+
+:func:`analyze` é a análise completa de uma partição (Tukey, Harris-Boyd e
+a avaliação de Haeckel/AEDM), a mesma do ``run_harris_boyd`` do ``app.py``,
+que agora só a chama. :func:`analyze_many` roda várias partições
+independentes — cada sexo de cada analito de um painel — num pool de
+processos.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Dict, Hashable, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from engine.haeckel import ReferenceLimitIndex
+
+# Mínimo de resultados em cada lado para que um corte seja testado.
+MIN_N = 30
+
+# Profundidade máxima da recursão: no máximo 2^6 - 1 cortes.
+MAX_DEPTH = 6
+
+# Tolerância relativa abaixo da qual a soma acumulada não decide sozinha.
+_RTOL = 1e-7
+
+# Abaixo deste total de resultados, subir os processos (cada um importa
+# numpy/pandas) custa mais que a análise inteira; tudo roda no próprio processo.
+PARALLEL_MIN_ROWS = 1_000_000
+
+
+def _quantile_sorted(values: np.ndarray, q: float) -> float:
+    """Quantil linear de um array já ordenado, com a mesma interpolação do numpy."""
+    position = q * (len(values) - 1)
+    i = int(np.floor(position))
+    t = position - i
+    a = values[i]
+    b = values[min(i + 1, len(values) - 1)]
+    diff = b - a
+    # O numpy interpola a partir do vizinho mais próximo.
+    return b - diff * (1 - t) if t >= 0.5 else a + diff * t
+
+
+def tukey_fences(values, iterations: int = 5, multiplier: float = 2.0):
+    """
+    Faixa ``(mínimo, máximo)`` que sobra da remoção iterativa de Tukey.
+
+    Mesma regra do ``remove_outliers_tukey`` original: a cada iteração,
+    mantém o que está em ``[Q1 - k·IQR, Q3 + k·IQR]`` e para quando nada sai.
+    Os valores são ordenados uma vez; cada iteração só aperta os índices
+    ``[lo, hi)`` sobre o array ordenado, com ``searchsorted``. NaN nunca
+    fica. Devolve ``None`` se nada sobrar.
+    """
+    ordered = np.sort(np.asarray(values, dtype="float64"))
+    lo, hi = 0, len(ordered) - int(np.isnan(ordered).sum())
+    for _ in range(iterations):
+        if lo >= hi:
+            break
+        window = ordered[lo:hi]
+        q1 = _quantile_sorted(window, 0.25)
+        q3 = _quantile_sorted(window, 0.75)
+        iqr = q3 - q1
+        new_lo = lo + int(np.searchsorted(window, q1 - multiplier * iqr, side="left"))
+        new_hi = lo + int(np.searchsorted(window, q3 + multiplier * iqr, side="right"))
+        if new_lo == lo and new_hi == hi:
+            break
+        lo, hi = new_lo, new_hi
+    if lo >= hi:
+        return None
+    return ordered[lo], ordered[hi - 1]
+
+
+def _evaluate(g1: np.ndarray, g2: np.ndarray):
+    """Estatísticas de um corte pelo cálculo direto, como no código original."""
+    n1, n2 = len(g1), len(g2)
+    mean1, mean2 = float(np.mean(g1)), float(np.mean(g2))
+    var1, var2 = float(np.var(g1, ddof=1)), float(np.var(g2, ddof=1))
+    sd1, sd2 = np.sqrt(var1), np.sqrt(var2)
+    # Se min(sd1, sd2) for 0, a razão fica 1.0 e não ativa o gatilho > 1.5.
+    sd_ratio = max(sd1, sd2) / min(sd1, sd2) if min(sd1, sd2) > 0 else 1.0
+    denom = np.sqrt((var1 / n1) + (var2 / n2))
+    z = abs(mean1 - mean2) / denom if denom != 0 else np.nan
+    return z, sd_ratio, mean1, mean2
+
+
+def _z_crit(n: int) -> float:
+    return 3 * np.sqrt(n / 120) if n < 120 else 3.0
+
+
+class _SortedResults:
+    """Resultados ordenados por idade, com somas acumuladas centradas."""
+
+    def __init__(self, age, data):
+        age = np.asarray(age, dtype="float64")
+        data = np.asarray(data, dtype="float64")
+        # Ordenação estável: dentro da mesma idade, a ordem original.
+        order = np.argsort(age, kind="stable")
+        self.age = age[order]
+        self.data = data[order]
+        # Centrar na média reduz o cancelamento em q - s²/n.
+        x = self.data - (self.data.mean() if len(self.data) else 0.0)
+        self.cs = np.concatenate(([0.0], np.cumsum(x)))
+        self.cq = np.concatenate(([0.0], np.cumsum(x * x)))
+
+    def best_cut(self, start: int, end: int, min_n: int) -> Optional[tuple]:
+        """``(idade, linha do corte, z, razão DP, média1, média2)`` ou ``None``."""
+        n = end - start
+        if n < 2 * min_n:
+            return None
+        ages = self.age[start:end]
+        cutoffs = np.arange(int(ages[0]), int(ages[-1]))
+        if not len(cutoffs):
+            return None
+        split = start + np.searchsorted(ages, cutoffs, side="right")
+        n1 = split - start
+        n2 = end - split
+        valid = (n1 >= min_n) & (n2 >= min_n)
+        if not valid.any():
+            return None
+        cutoffs, split, n1, n2 = cutoffs[valid], split[valid], n1[valid], n2[valid]
+
+        s1 = self.cs[split] - self.cs[start]
+        s2 = self.cs[end] - self.cs[split]
+        q1 = self.cq[split] - self.cq[start]
+        q2 = self.cq[end] - self.cq[split]
+        m1, m2 = s1 / n1, s2 / n2
+        var1 = np.maximum(q1 - s1 * m1, 0.0) / (n1 - 1)
+        var2 = np.maximum(q2 - s2 * m2, 0.0) / (n2 - 1)
+        sd1, sd2 = np.sqrt(var1), np.sqrt(var2)
+        sd_lo, sd_hi = np.minimum(sd1, sd2), np.maximum(sd1, sd2)
+        denom = np.sqrt(var1 / n1 + var2 / n2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sd_ratio = np.where(sd_lo > 0, sd_hi / sd_lo, 1.0)
+            z = np.where(denom > 0, np.abs(m1 - m2) / denom, np.nan)
+        z_crit = _z_crit(n)
+
+        # Onde a conta por somas não é confiável, refaz pelo cálculo direto.
+        doubtful = (
+            (var1 <= _RTOL * q1 / n1) | (var2 <= _RTOL * q2 / n2)
+            | (np.abs(sd_ratio - 1.5) <= _RTOL * 1.5)
+            | (np.abs(z - z_crit) <= _RTOL * z_crit)
+        )
+        significant = ((sd_ratio > 1.5) | (z > z_crit)) & (z > 0)
+        if significant.any():
+            z_best = np.nanmax(np.where(significant, z, np.nan))
+            doubtful |= significant & (z >= z_best * (1 - _RTOL))
+        exact = {}
+        for i in np.flatnonzero(doubtful):
+            r = split[i]
+            exact[i] = _evaluate(self.data[start:r], self.data[r:end])
+            z[i], sd_ratio[i] = exact[i][0], exact[i][1]
+        significant = ((sd_ratio > 1.5) | (z > z_crit)) & (z > 0)
+        if not significant.any():
+            return None
+
+        # Primeiro maior z, como o ``z > best_z`` do laço original.
+        i = int(np.nanargmax(np.where(significant, z, -np.inf)))
+        r = int(split[i])
+        z_i, ratio_i, mean1, mean2 = exact.get(i) or _evaluate(self.data[start:r], self.data[r:end])
+        return int(cutoffs[i]), r, z_i, ratio_i, mean1, mean2
+
+
+def find_cuts(age, data, min_n: int = MIN_N, max_depth: int = MAX_DEPTH) -> List[dict]:
+    """
+    Cortes de Harris-Boyd por particionamento hierárquico.
+
+    Acha o corte mais significativo, depois repete em cada metade. Cada
+    partição contribui com no máximo um corte. Devolve os cortes ordenados
+    por idade, no formato da tabela de Harris-Boyd do ``app.py``.
+    """
+    results = _SortedResults(age, data)
+    found: List[dict] = []
+
+    def partition(start: int, end: int, depth: int) -> None:
+        if depth >= max_depth:
+            return
+        best = results.best_cut(start, end, min_n)
+        if best is None:
+            return
+        cut_age, r, z, sd_ratio, mean1, mean2 = best
+        found.append({
+            'age': cut_age,
+            'Age Cutoff': f"<= {cut_age} vs > {cut_age}",
+            'Z-score': round(z, 2),
+            'SD Ratio': round(sd_ratio, 2),
+            'Mean (<= Cutoff)': round(mean1, 2),
+            'Mean (> Cutoff)': round(mean2, 2),
+        })
+        partition(start, r, depth + 1)
+        partition(r, end, depth + 1)
+
+    partition(0, len(results.age), 0)
+    found.sort(key=lambda cut: cut['age'])
+    return found
+
+
+def analyze(age, data, lista_limites: Optional[list] = None, sexo_contexto: str = "All"):
+    """
+    Análise de Harris-Boyd de uma partição.
+
+    ``age`` e ``data`` são arrays alinhados; NaN e idades negativas são
+    descartados, e os outliers saem por :func:`tukey_fences`. Devolve
+    ``(df_possible, df_ideal, idades_sugeridas, any_haeckel_applied)``, no
+    formato do ``run_harris_boyd`` do ``app.py``.
+    """
+    temp_df = pd.DataFrame({
+        'Age': np.asarray(age, dtype='float64'),
+        'Data': np.asarray(data, dtype='float64'),
+    })
+    temp_df = temp_df.dropna(subset=['Age', 'Data'])
+    temp_df = temp_df[temp_df['Age'] >= 0]
+    fences = tukey_fences(temp_df['Data'].to_numpy())
+    if fences is None:
+        return pd.DataFrame(), pd.DataFrame(), [], False
+    temp_df = temp_df[(temp_df['Data'] >= fences[0]) & (temp_df['Data'] <= fences[1])]
+
+    if temp_df.empty: return pd.DataFrame(), pd.DataFrame(), [], False
+    max_age = int(temp_df['Age'].max())
+    if max_age < 1: return pd.DataFrame(), pd.DataFrame(), [], False
+
+    # =========================================================================
+    # TRACK 1: HARRIS-BOYD — RECURSIVE HIERARCHICAL PARTITIONING
+    # Finds the globally best cut, then recurses on each partition.
+    # Result: typically 2–5 clinically meaningful cuts instead of 70+.
+    # =========================================================================
+    possible_cuts_hb = find_cuts(temp_df['Age'].to_numpy(), temp_df['Data'].to_numpy())
+
+    df_possible = pd.DataFrame(possible_cuts_hb) if possible_cuts_hb else pd.DataFrame()
+
+    # =========================================================================
+    # TRACK 2: DYNAMIC CRITICAL BOUNDARY EVALUATION (HAECKEL VS AEDM)
+    # =========================================================================
+    global_mean = temp_df['Data'].mean()
+    global_sd   = temp_df['Data'].std(ddof=1)
+    global_cv   = (global_sd / global_mean) if global_mean > 0 else 0.10
+    cv_tolerance_margin = global_cv * 0.50
+
+    age_groups = temp_df.groupby('Age')['Data'].agg(['mean', 'count']).reset_index()
+    age_groups = age_groups.sort_values(by='Age').to_dict('records')
+
+    clinical_cuts = []
+    idades_sugeridas = []
+    any_haeckel_applied = False
+
+    # Limites casados e coeficientes de Haeckel de todas as idades de uma vez,
+    # sobre a tabela de limites compilada para este sexo.
+    limites = ReferenceLimitIndex(lista_limites)
+    haeckel_por_idade = limites.haeckel_many([g['Age'] for g in age_groups], sexo_contexto)
+
+    if age_groups:
+        current_bracket_means = [age_groups[0]['mean']]
+
+        for i in range(1, len(age_groups)):
+            current_age_data = age_groups[i]
+            reference_mean   = np.mean(current_bracket_means)
+            pct_diff = abs(current_age_data['mean'] - reference_mean) / reference_mean if reference_mean > 0 else 0
+
+            is_significant = False
+            margin_disp    = 0
+
+            h_local = haeckel_por_idade[i]
+
+            if h_local and reference_mean > 0:
+                any_haeckel_applied = True
+                psa_x        = (h_local['slope'] * reference_mean) + h_local['intercept']
+                pd_margin    = 1.645 * psa_x
+                diff_absoluta = abs(current_age_data['mean'] - reference_mean)
+                is_significant = diff_absoluta > pd_margin
+                margin_disp  = round(pd_margin, 3)
+            else:
+                is_significant = pct_diff > cv_tolerance_margin
+                margin_disp  = round(cv_tolerance_margin * 100, 2)
+
+            if is_significant and current_age_data['count'] >= 5:
+                cutoff_age = int(age_groups[i - 1]['Age'])
+                m_less    = temp_df[temp_df['Age'] <= cutoff_age]['Data'].mean()
+                m_greater = temp_df[temp_df['Age'] > cutoff_age]['Data'].mean()
+
+                clinical_cuts.append({
+                    'age': cutoff_age,
+                    'Age Cutoff': f"<= {cutoff_age} vs > {cutoff_age}",
+                    'Diff %':   round(pct_diff * 100, 2),
+                    'Limit Threshold': margin_disp,
+                    'Mean (<= Cutoff)': round(m_less, 2),
+                    'Mean (> Cutoff)':  round(m_greater, 2),
+                })
+                idades_sugeridas.append(cutoff_age)
+                current_bracket_means = [current_age_data['mean']]
+            else:
+                current_bracket_means.append(current_age_data['mean'])
+
+    df_ideal = pd.DataFrame(clinical_cuts).sort_values(by='age') if clinical_cuts else pd.DataFrame()
+
+    return df_possible, df_ideal, idades_sugeridas, any_haeckel_applied
+
+
+def _analyze_job(job: Tuple, lista_limites: Optional[list]):
+    age, data, sexo_contexto = job
+    return analyze(age, data, lista_limites, sexo_contexto)
+
+
+def analyze_many(jobs: Mapping[Hashable, Tuple], lista_limites: Optional[list] = None,
+                 max_workers: Optional[int] = None) -> Dict[Hashable, tuple]:
+    """
+    :func:`analyze` de várias partições independentes.
+
+    ``jobs`` é ``{chave: (age, data, sexo_contexto)}`` — uma entrada por
+    sexo e por analito. O trabalho é numpy/pandas com muito Python no meio
+    (recursão, laço de Haeckel), então as partições vão para processos, no
+    mesmo contexto ``spawn`` e com a mesma queda para o modo sequencial do
+    ``export.serialize_strata``. Devolve ``{chave: resultado}`` na ordem de
+    ``jobs``.
+    """
+    keys = list(jobs)
+    workers = min(len(keys), max_workers or os.cpu_count() or 1)
+    total_rows = sum(len(jobs[key][0]) for key in keys)
+    if workers > 1 and total_rows >= PARALLEL_MIN_ROWS:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+                results = pool.map(_analyze_job, [jobs[key] for key in keys], [lista_limites] * len(keys))
+                return dict(zip(keys, results))
+        except (BrokenProcessPool, OSError):
+            pass
+    return {key: _analyze_job(jobs[key], lista_limites) for key in keys}
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Conversão vetorizada de colunas de resultado para float.
+
+A mesma coluna de resultado era convertida três vezes a cada clique em
+"Process Analysis" — ``run_harris_boyd``, ``plot_dispersion_chart`` e
+``render_mini_tabela`` tinham cada uma o seu ``clean_val``, aplicado célula
+a célula com ``str`` e geradores — e as páginas tinham ainda o ``_conv`` do
+``normalizar_serie_numerica``. Aqui as duas regras ficam num lugar só e
+rodam sobre a coluna inteira com o ``pyarrow.compute``:
+
+- :func:`clean_numeric` — regra do ``app.py``: vírgula vira ponto, sobra só
+  dígito, ponto e sinal de menos;
+- :func:`parse_localized` — regra das páginas: separador de milhar e decimal
+  decididos pela posição (``"1.234,56"`` e ``"1,234.56"`` → 1234.56) e
+  unidades descartadas (``"12,5 mg/dL"`` → 12.5).
+
+O resultado é o mesmo da conversão célula a célula. Os poucos valores em que
+o caminho vetorizado poderia divergir — texto com dígitos fora do ASCII,
+número que o ``str`` escreve em notação científica, texto longo demais —
+passam pela função original, valor a valor. Cada texto distinto é convertido
+uma vez só (``dictionary_encode``): resultados de laboratório se repetem muito.
+
+:class:`NumericColumnCache` guarda as colunas já convertidas por
+``(impressão digital, coluna, regra)``, para que análise, gráfico e tabelas
+leiam a mesma conversão.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+# Números que ``str(float)`` escreve em notação científica.
+_SCI_LOW, _SCI_HIGH = 1e-4, 1e16
+
+# Texto maior que isso vai para o caminho célula a célula.
+_MAX_TEXT = 300
+
+_FLOAT_LITERAL = r"^[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)$"
+
+
+def _clean_val(x) -> float:
+    """``clean_val`` original do ``app.py``, para uma célula."""
+    if pd.isna(x):
+        return np.nan
+    x = str(x).replace(',', '.')
+    x = ''.join(c for c in x if c.isdigit() or c == '.' or c == '-')
+    try:
+        return float(x)
+    except ValueError:
+        return np.nan
+
+
+def _localized_val(x) -> float:
+    """``normalizar_serie_numerica._conv`` original das páginas, para uma célula."""
+    if pd.isna(x):
+        return np.nan
+    s = str(x).strip()
+    if s == "" or s.lower() in ("nan", "none", "na", "n/a", "-", "--", "."):
+        return np.nan
+    s = s.replace("\xa0", "").replace(" ", "")
+    s = re.sub(r"[^0-9,.\-+]", "", s)
+    if s in ("", "+", "-", ".", ","):
+        return np.nan
+    has_dot, has_comma = "." in s, "," in s
+    if has_dot and has_comma:
+        if s.rfind(",") > s.rfind("."):
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", "")
+    elif has_comma:
+        s = s.replace(",", ".")
+    if s.count(".") > 1:
+        partes = s.split(".")
+        s = "".join(partes[:-1]) + "." + partes[-1]
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
+
+def _to_float(text, pc, pa):
+    """Texto já limpo para float64; o que ``float()`` recusaria vira NaN."""
+    valid = pc.fill_null(pc.match_substring_regex(text, _FLOAT_LITERAL), False)
+    numbers = pc.cast(pc.if_else(valid, text, pa.scalar(None, pa.string())), pa.float64())
+    return numbers.to_numpy(zero_copy_only=False)
+
+
+def _clean_kernel(text, pc, pa):
+    text = pc.replace_substring(text, ",", ".")
+    text = pc.replace_substring_regex(text, r"[^0-9.\-]", "")
+    return _to_float(text, pc, pa)
+
+
+def _localized_kernel(text, pc, pa):
+    text = pc.replace_substring_regex(text, r"[^0-9,.+\-]", "")
+    # Vírgula decimal quando nenhum ponto vem depois da última vírgula.
+    comma_decimal = pc.fill_null(pc.match_substring_regex(text, r",[^.]*$"), False)
+    text = pc.if_else(
+        comma_decimal,
+        pc.replace_substring(pc.replace_substring(text, ".", ""), ",", "."),
+        pc.replace_substring(text, ",", ""),
+    )
+    # Mais de um ponto ("1.234.567"): só o último fica.
+    many = pc.fill_null(pc.greater(pc.count_substring(text, "."), 1), False)
+    if pc.any(many).as_py():
+        parts = pc.extract_regex(text, r"^(?P<head>.*)\.(?P<tail>[^.]*)$")
+        head = pc.replace_substring(pc.struct_field(parts, [0]), ".", "")
+        joined = pc.binary_join_element_wise(head, pc.struct_field(parts, [1]), ".")
+        text = pc.if_else(many, joined, text)
+    return _to_float(text, pc, pa)
+
+
+def _parse(series: pd.Series, kernel, scalar: Callable) -> pd.Series:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        # Converte só as categorias e espalha pelos códigos.
+        parsed = _parse(pd.Series(dtype.categories), kernel, scalar).to_numpy()
+        codes = series.cat.codes.to_numpy()
+        values = np.where(codes >= 0, parsed[np.maximum(codes, 0)] if len(parsed) else np.nan, np.nan)
+        return pd.Series(values, index=series.index, dtype="float64")
+
+    if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        values = series.to_numpy(dtype="float64", na_value=np.nan, copy=True)
+        if pd.api.types.is_float_dtype(dtype):
+            # inf e os números que ``str`` escreve em notação científica
+            # ("1e-05") passam pela regra textual, como antes.
+            magnitude = np.abs(values)
+            odd = np.isinf(values) | (magnitude >= _SCI_HIGH) | ((magnitude > 0) & (magnitude < _SCI_LOW))
+            if odd.any():
+                values[odd] = [scalar(v) for v in series.to_numpy(dtype=object)[odd]]
+        return pd.Series(values, index=series.index, dtype="float64")
+
+    try:
+        text = pa.array(series, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Coluna mista (texto e números, datas): a mesma conversão com ``str``.
+        text = pa.array([None if _is_missing(v) else str(v) for v in series], type=pa.string())
+    if isinstance(text, pa.ChunkedArray):
+        text = text.combine_chunks()
+    if text.type != pa.string():
+        # ``string[pyarrow]`` do pandas chega como ``large_string``.
+        text = text.cast(pa.string())
+
+    # Converte cada texto distinto uma vez e espalha pelos índices.
+    encoded = pc.dictionary_encode(text)
+    distinct = encoded.dictionary
+    parsed = np.array(kernel(distinct, pc, pa), dtype="float64")
+    odd = pc.or_(pc.invert(pc.string_is_ascii(distinct)), pc.greater(pc.utf8_length(distinct), _MAX_TEXT))
+    odd = odd.to_numpy(zero_copy_only=False)
+    if odd.any():
+        raw = distinct.to_numpy(zero_copy_only=False)
+        parsed[odd] = [scalar(v) for v in raw[odd]]
+    indices = encoded.indices.to_numpy(zero_copy_only=False)
+    if encoded.null_count:
+        indices = np.nan_to_num(indices, nan=-1).astype(np.int64)
+    parsed = np.append(parsed, np.nan)
+    values = parsed[indices]
+    return pd.Series(values, index=series.index, dtype="float64")
+
+
+def _is_missing(value) -> bool:
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def clean_numeric(series: pd.Series) -> pd.Series:
+    """Coluna como float64 pela regra do ``clean_val`` do ``app.py``."""
+    return _parse(series, _clean_kernel, _clean_val)
+
+
+def parse_localized(series: pd.Series) -> pd.Series:
+    """Coluna como float64 pela regra do ``normalizar_serie_numerica`` das páginas."""
+    return _parse(series, _localized_kernel, _localized_val)
+
+
+class NumericColumnCache:
+    """
+    Colunas já convertidas, por ``(impressão digital, coluna, regra)``.
+
+    Mesmo desenho do ``RuleMaskCache`` do ``app.py``: fica em
+    ``st.session_state`` (o valor é dado de um laboratório), tem poucas
+    entradas e descarta a menos usada. Uma entrada só vale para uma tabela
+    com o mesmo índice da que a gerou.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, fingerprint: str, column: str, rule: str, index: pd.Index) -> Optional[pd.Series]:
+        key = (fingerprint, column, rule)
+        entry = self._entries.get(key)
+        if entry is None or not entry.index.equals(index):
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, fingerprint: str, column: str, rule: str, values: pd.Series) -> None:
+        key = (fingerprint, column, rule)
+        self._entries[key] = values
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Leitura de CSV com o leitor multithread do Arrow.
+
+O ``app.py`` e as páginas liam CSV cada um do seu jeito — as páginas com
+``engine="python"``, cerca de dez vezes mais lento que o PyArrow nos
+relatórios de original × repetição, e a Análise de Impacto tentando até
+quatro combinações de separador/encoding, cada uma um parse completo. Aqui
+fica um leitor só: dialeto detectado por amostra (``engine.sniff``) e um
+único parse com o PyArrow. O parser C do pandas fica como rede de proteção
+para arquivo malformado, que o PyArrow recusa e o C tolera.
+
+Para ZIP, cada membro é descompactado em fluxo direto para um temporário
+(``ZipFile.open`` + ``copyfileobj``), sem passar inteiro pela memória como
+fazia ``z.read``. :func:`read_zip` lê só o primeiro membro, como sempre, ou
+todos eles — em paralelo — num único DataFrame com a coluna de origem.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import List, Optional, Union
+
+import pandas as pd
+
+from engine import sniff, xlsx
+from security.uploads import secure_tempfile
+
+TABLE_EXTENSIONS = (".csv", ".xlsx", ".xls")
+
+Source = Union[str, bytes]
+
+
+def read_csv(source: Source, dialect: Optional[sniff.CsvDialect] = None) -> pd.DataFrame:
+    """
+    Lê um CSV a partir de um caminho ou dos bytes do arquivo.
+
+    Sem ``dialect``, ele é detectado na amostra inicial do próprio arquivo.
+    Se a amostra era só ASCII (``dialect.ascii_sample``) e o resto do arquivo
+    não é UTF-8, a leitura é refeita uma vez em latin-1: o PyArrow não falha
+    nesse caso, devolve a coluna inteira como ``bytes``.
+    """
+    if dialect is None:
+        dialect = sniff.sniff_bytes(source[:sniff.SAMPLE_BYTES]) if isinstance(source, bytes) else sniff.sniff_path(source)
+    if not dialect.ascii_sample:
+        return _parse(source, dialect)
+    latin1 = replace(dialect, encoding="latin-1", ascii_sample=False)
+    try:
+        df = _parse(source, dialect)
+    except UnicodeDecodeError:
+        return _parse(source, latin1)
+    return _parse(source, latin1) if _has_bytes_column(df) else df
+
+
+def _parse(source: Source, dialect: sniff.CsvDialect) -> pd.DataFrame:
+    options = dict(sep=dialect.sep, decimal=dialect.decimal, encoding=dialect.encoding)
+    if dialect.engine == "pyarrow":
+        try:
+            return pd.read_csv(_open(source), engine="pyarrow", **options)
+        except Exception:
+            pass
+    return pd.read_csv(_open(source), engine="c", low_memory=False, **options)
+
+
+def _has_bytes_column(df: pd.DataFrame) -> bool:
+    """Coluna de texto que o PyArrow entregou como ``bytes`` (UTF-8 inválido)."""
+    for column in df.columns[df.dtypes == object]:
+        first = df[column].first_valid_index()
+        if first is not None and isinstance(df[column].loc[first], bytes):
+            return True
+    return False
+
+
+def _open(source: Source):
+    # Um BytesIO novo a cada tentativa: o parse que falhou pode ter deixado o
+    # anterior no meio do arquivo.
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+class EmptyArchiveError(ValueError):
+    """ZIP sem nenhum CSV ou Excel legível."""
+
+
+def read_table_file(path: str, name: str) -> pd.DataFrame:
+    """CSV ou Excel em disco, decidido pela extensão de ``name``."""
+    if name.lower().endswith(".csv"):
+        return read_csv(path)
+    return xlsx.read_excel(path)
+
+
+def zip_members(archive: zipfile.ZipFile) -> List[str]:
+    """Membros do ZIP que são planilhas, na ordem do arquivo."""
+    return [f for f in archive.namelist()
+            if not f.startswith("__MACOSX/") and not f.endswith("/")
+            and f.lower().endswith(TABLE_EXTENSIONS)]
+
+
+def read_zip_member(zip_path: str, member: str) -> pd.DataFrame:
+    """
+    Descompacta um membro em fluxo para um temporário e faz o parse.
+
+    Cada chamada abre o seu próprio ``ZipFile``: o objeto não é seguro para
+    leituras simultâneas de várias threads.
+    """
+    with zipfile.ZipFile(zip_path) as archive, secure_tempfile(os.path.splitext(member)[1]) as inner_path:
+        with archive.open(member) as src, open(inner_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return read_table_file(inner_path, member)
+
+
+def read_zip(zip_path: str, all_members: bool = False, source_column: str = "Source file",
+             max_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Planilha(s) de dentro de um ZIP.
+
+    Por padrão lê só o primeiro membro válido. Com ``all_members`` lê todos
+    em paralelo (o parse do PyArrow solta o GIL) e empilha na ordem do ZIP,
+    com ``source_column`` na frente indicando o arquivo de origem de cada
+    linha. Colunas que só existem em alguns membros ficam vazias nos demais.
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        members = zip_members(archive)
+    if not members:
+        raise EmptyArchiveError("O ZIP não contém CSV ou Excel válidos.")
+    if not all_members:
+        return read_zip_member(zip_path, members[0])
+
+    workers = min(len(members), max_workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(lambda member: read_zip_member(zip_path, member), members))
+    for member, frame in zip(members, frames):
+        frame.insert(0, source_column, os.path.basename(member))
+    return pd.concat(frames, ignore_index=True)
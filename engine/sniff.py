@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Detecção do dialeto de CSV (separador, decimal, encoding) por amostra.
+
+A leitura antiga tentava ``;``/``,``/latin-1 e, se o parse falhasse, lia o
+arquivo inteiro de novo como ``,``/``.``/utf-8 — e cada uma dessas leituras
+ainda podia cair do PyArrow para o parser C. Um palpite errado custava até
+quatro passadas completas por um arquivo de centenas de MB. Pior: o palpite
+só era corrigido quando o parse *quebrava*. Um CSV com vírgula lido com
+``;`` não quebra, vira uma coluna só.
+
+Aqui a decisão é tomada olhando só o começo do arquivo (``SAMPLE_BYTES``),
+e o leitor faz um único parse completo com o dialeto escolhido.
+
+O encoding é a exceção: uma amostra só com ASCII não distingue UTF-8 de
+latin-1 — o primeiro ``JOSÉ`` pode estar depois dela. Nesse caso o dialeto
+sai com ``ascii_sample=True`` e o palpite UTF-8 é conferido por quem lê o
+arquivo inteiro (``engine.readers.read_csv``), que volta para latin-1 se
+encontrar byte que não é UTF-8.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import re
+from dataclasses import dataclass
+from typing import BinaryIO
+
+SAMPLE_BYTES = 64 * 1024
+
+# Ordem de preferência no empate: ``;`` primeiro, que é o padrão dos
+# relatórios brasileiros que o DataSift recebe.
+_SEPARATORS = (";", ",", "\t", "|")
+
+_DECIMAL_COMMA = re.compile(r"-?\d+,\d+")
+_DECIMAL_POINT = re.compile(r"-?\d+\.\d+")
+
+
+@dataclass(frozen=True)
+class CsvDialect:
+    """
+    Dialeto detectado. ``engine`` é o parser indicado para o arquivo inteiro;
+    ``ascii_sample`` diz que a amostra era só ASCII e o ``encoding`` UTF-8 é
+    um palpite ainda não confirmado pelo resto do arquivo.
+    """
+
+    sep: str
+    decimal: str
+    encoding: str
+    engine: str = "pyarrow"
+    ascii_sample: bool = False
+
+
+def sniff_bytes(sample: bytes) -> CsvDialect:
+    """Decide o dialeto a partir dos primeiros bytes do arquivo."""
+    # Sem nenhuma quebra de linha na amostra, a primeira linha passa de
+    # SAMPLE_BYTES: é o caso em que o PyArrow falha com "straddling object
+    # straddles two block boundaries", então o parser C já é a escolha.
+    cut = sample.rfind(b"\n")
+    engine = "pyarrow"
+    if cut < 0 and len(sample) >= SAMPLE_BYTES:
+        engine = "c"
+    elif cut >= 0:
+        # Corta na última linha completa: uma linha (ou um caractere UTF-8 de
+        # vários bytes) pela metade no fim da amostra não pode decidir nada.
+        sample = sample[:cut + 1]
+
+    if sample.startswith(b"\xef\xbb\xbf"):
+        encoding = "utf-8-sig"
+    else:
+        try:
+            sample.decode("utf-8")
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            encoding = "latin-1"
+    text = sample.decode(encoding, errors="replace")
+
+    sep = _sniff_separator(text)
+    return CsvDialect(sep=sep, decimal=_sniff_decimal(text, sep), encoding=encoding, engine=engine,
+                      ascii_sample=encoding == "utf-8" and sample.isascii())
+
+
+def sniff_file(handle: BinaryIO) -> CsvDialect:
+    """Como :func:`sniff_bytes`, lendo a amostra de um arquivo aberto sem mudar a posição."""
+    position = handle.tell()
+    try:
+        handle.seek(0)
+        return sniff_bytes(handle.read(SAMPLE_BYTES))
+    finally:
+        handle.seek(position)
+
+
+def sniff_path(path: str) -> CsvDialect:
+    with open(path, "rb") as handle:
+        return sniff_bytes(handle.read(SAMPLE_BYTES))
+
+
+def _sniff_separator(text: str) -> str:
+    """
+    Separador que divide as linhas em um número de campos mais constante.
+
+    Conta os campos com o ``csv`` da biblioteca padrão (que respeita aspas) e
+    pontua cada candidato por ``(fração de linhas com a contagem mais comum,
+    contagem mais comum)``. Candidato que não divide nada (1 campo) perde.
+    """
+    lines = [line for line in text.splitlines() if line.strip()][:200]
+    if not lines:
+        return _SEPARATORS[0]
+
+    best, best_score = _SEPARATORS[0], (0.0, 1)
+    for sep in _SEPARATORS:
+        try:
+            counts = [len(row) for row in csv.reader(io.StringIO("\n".join(lines)), delimiter=sep)]
+        except csv.Error:
+            continue
+        if not counts:
+            continue
+        modal = max(set(counts), key=counts.count)
+        if modal < 2:
+            continue
+        score = (counts.count(modal) / len(counts), modal)
+        if score > best_score:
+            best, best_score = sep, score
+    return best
+
+
+def _sniff_decimal(text: str, sep: str) -> str:
+    """Vírgula decimal só é possível quando a vírgula não é o separador."""
+    if sep == ",":
+        return "."
+    comma = point = 0
+    for row in csv.reader(io.StringIO(text), delimiter=sep):
+        for field in row:
+            field = field.strip()
+            if _DECIMAL_COMMA.fullmatch(field):
+                comma += 1
+            elif _DECIMAL_POINT.fullmatch(field):
+                point += 1
+    if point > comma:
+        return "."
+    if comma > point:
+        return ","
+    # Sem números com casa decimal na amostra: mantém o padrão brasileiro
+    # para ``;``, como a leitura antiga fazia.
+    return "," if sep == ";" else "."
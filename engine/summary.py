@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Resultados de uma coluna agrupados em células (sexo, idade).
+
+A aba de análise varria as linhas cruas de novo para cada coisa que mostra:
+o ``run_harris_boyd`` convertia idade e resultado e separava os sexos, o
+``render_mini_tabela`` filtrava a tabela por faixa para cada mediana, e o
+``plot_dispersion_chart`` refazia ``to_numeric`` e ``astype(str)`` antes de
+agrupar por faixa. O :class:`AgeSexSummary` é montado uma vez por (planilha,
+colunas) e guarda, para cada célula (sexo, idade), contagem, soma e soma dos
+quadrados — média e desvio de qualquer faixa saem daí — e os resultados da
+célula ordenados.
+
+Os resultados ordenados são o esboço de quantis, e é exato: medianas,
+boxplots e o Harris-Boyd precisam dos valores, não de uma aproximação. Cada
+resultado válido fica uma vez só, em float64, na ordem das células; idade e
+sexo de cada linha não são guardados, saem de ``cell_age``/``cell_code``
+quando uma partição é pedida (:meth:`AgeSexSummary.partition`). A ordem das
+linhas dentro da partição não muda a análise de Harris-Boyd.
+
+As células são por valor distinto de idade, não pela idade truncada: com
+idades inteiras é o mesmo, e com idades fracionárias as faixas ``[a, b]`` do
+app continuam excluindo o que fica entre ``b`` e ``b + 1``, como antes. Os
+números servidos pelo resumo são os mesmos do cálculo sobre as linhas.
+
+:class:`SummaryCache` guarda os resumos da sessão, limitado por entradas e
+por bytes (:attr:`AgeSexSummary.nbytes`).
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class AgeSexSummary:
+    """Linhas válidas de uma coluna de resultados, ordenadas em células (sexo, idade)."""
+
+    def __init__(self, age, data, sex=None):
+        age = np.asarray(age, dtype='float64')
+        data = np.asarray(data, dtype='float64')
+        if sex is None:
+            codes = np.zeros(len(age), dtype=np.int64)
+            self.labels: List[str] = []
+        else:
+            codes, uniques = pd.factorize(np.asarray(sex, dtype=object))
+            self.labels = [str(u) for u in uniques]
+        self.has_sex = sex is not None
+
+        # Maior idade de cada sexo entre todas as linhas com idade, mesmo as
+        # sem resultado — é o fim da última faixa nas tabelas de mediana.
+        n_codes = max(len(self.labels), 1)
+        with_age = ~np.isnan(age)
+        self._max_age = np.full(n_codes, np.nan)
+        np.fmax.at(self._max_age, codes[with_age], age[with_age])
+
+        keep = with_age & ~np.isnan(data)
+        age, data, codes = age[keep], data[keep], codes[keep]
+
+        # Células (sexo, idade): linhas ordenadas por sexo, idade e resultado.
+        # Só os resultados ordenados ficam; idade e sexo por linha são descartados.
+        order = np.lexsort((data, age, codes))
+        sorted_codes = codes[order]
+        sorted_age = age[order]
+        self.sorted_data = data[order]
+        if len(order):
+            change = (np.diff(sorted_codes) != 0) | (np.diff(sorted_age) != 0)
+            starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        self.cell_start = starts
+        # Primeira linha (na ordem original) de cada célula: dá a ordem em que
+        # os sexos aparecem, que é a ordem da legenda nos gráficos.
+        self.cell_first = np.minimum.reduceat(order, starts) if len(starts) else np.zeros(0, dtype=np.int64)
+        self.cell_count = np.diff(np.append(starts, len(order)))
+        self.cell_code = sorted_codes[starts]
+        self.cell_age = sorted_age[starts]
+        self.cell_sum = np.add.reduceat(self.sorted_data, starts) if len(starts) else np.zeros(0)
+        self.cell_sumsq = np.add.reduceat(self.sorted_data ** 2, starts) if len(starts) else np.zeros(0)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, col_idade: str, col_dados: str, col_sexo: Optional[str] = None,
+                   valores: Optional[pd.Series] = None) -> "AgeSexSummary":
+        """
+        Resumo de ``df``. ``valores`` é a coluna de resultados já convertida;
+        sem ela, a conversão é a do ``numeric.clean_numeric``. O sexo é o
+        texto da coluna (``astype(str)``), como nos filtros do app.
+        """
+        from engine import numeric
+
+        age = pd.to_numeric(df[col_idade], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        if valores is None:
+            valores = numeric.clean_numeric(df[col_dados])
+        sex = df[col_sexo].astype(str).to_numpy() if col_sexo and col_sexo in df.columns else None
+        return cls(age, valores.to_numpy(dtype='float64'), sex)
+
+    def __len__(self) -> int:
+        return len(self.sorted_data)
+
+    @property
+    def nbytes(self) -> int:
+        """Memória dos arrays do resumo."""
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    def _code(self, sex: Optional[str]) -> Optional[int]:
+        """Código do sexo; ``None`` para todos. Sexo ausente vira -1 (nenhuma linha)."""
+        if sex is None:
+            return None
+        try:
+            return self.labels.index(str(sex))
+        except ValueError:
+            return -1
+
+    def has(self, sex: str) -> bool:
+        """Se a coluna de sexo tem alguma linha com este valor (válida ou não)."""
+        return str(sex) in self.labels
+
+    def max_age(self, sex: Optional[str] = None) -> float:
+        """Maior idade do sexo (ou geral), NaN se não houver idade."""
+        code = self._code(sex)
+        if code is None:
+            return float(np.nanmax(self._max_age)) if not np.isnan(self._max_age).all() else float('nan')
+        return float(self._max_age[code]) if code >= 0 else float('nan')
+
+    def partition(self, sex: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """``(idade, resultado)`` das linhas válidas do sexo, na ordem das células."""
+        return self.rows(self._cells(sex, -np.inf, np.inf))
+
+    def rows(self, idx) -> Tuple[np.ndarray, np.ndarray]:
+        """``(idade, resultado)`` das linhas das células ``idx``."""
+        idx = np.asarray(idx, dtype=np.int64)
+        return np.repeat(self.cell_age[idx], self.cell_count[idx]), self.cell_values(idx)
+
+    def _cells(self, sex: Optional[str], age_min: float, age_max: float) -> np.ndarray:
+        code = self._code(sex)
+        mask = (self.cell_age >= age_min) & (self.cell_age <= age_max)
+        if code is not None:
+            mask &= self.cell_code == code
+        return np.flatnonzero(mask)
+
+    def cell_values(self, idx) -> np.ndarray:
+        """Resultados das células ``idx``, ordenados dentro de cada célula."""
+        idx = np.asarray(idx, dtype=np.int64)
+        if not len(idx):
+            return np.zeros(0)
+        return np.concatenate([self.sorted_data[s:s + n] for s, n in zip(self.cell_start[idx], self.cell_count[idx])])
+
+    def values(self, age_min: float = -np.inf, age_max: float = np.inf, sex: Optional[str] = None) -> np.ndarray:
+        """Resultados com idade em ``[age_min, age_max]``, ordenados dentro de cada célula."""
+        return self.cell_values(self._cells(sex, age_min, age_max))
+
+    def median(self, age_min: float, age_max: float, sex: Optional[str] = None) -> float:
+        """Mediana dos resultados da faixa de idade; NaN se a faixa está vazia."""
+        values = self.values(age_min, age_max, sex)
+        return float(np.median(values)) if len(values) else float('nan')
+
+
+class SummaryCache:
+    """
+    Resumos já montados, por chave (``Dataset.cache_key`` e colunas).
+
+    Fica em ``st.session_state`` — é dado de um laboratório — com poucas
+    entradas e no máximo ``max_bytes`` somando os resumos, descartando os
+    menos usados (o mais recente fica sempre). Como no ``NumericColumnCache``,
+    uma entrada só vale para uma tabela com o mesmo índice da que a gerou.
+    """
+
+    def __init__(self, max_entries: int = 4, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, index: pd.Index) -> Optional[AgeSexSummary]:
+        entry = self._entries.get(key)
+        if entry is None or not entry[0].equals(index):
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: Hashable, index: pd.Index, summary: AgeSexSummary) -> None:
+        self._entries[key] = (index, summary)
+        self._entries.move_to_end(key)
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            self._entries.popitem(last=False)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(summary.nbytes for _, summary in self._entries.values())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de uploads em disco, endereçado por conteúdo.
+
+Cada página do DataSift lia a mesma planilha do zero, com o seu próprio
+``st.cache_data``: abrir na Análise de Repetições o relatório de 200 MB que
+acabou de passar pelo filtro significava esperar todo o parse de novo. Aqui a
+primeira leitura grava o DataFrame em Parquet, e qualquer leitura seguinte do
+mesmo arquivo — em qualquer página, em qualquer sessão do mesmo laboratório —
+é um ``read_table`` com ``memory_map``.
+
+A chave é ``(laboratório, SHA-256 dos bytes enviados, leitor)``:
+
+- **laboratório** vira um subdiretório próprio (``tenant_cache_key``), então
+  o mesmo arquivo enviado por dois laboratórios gera duas entradas, e nenhuma
+  consulta de um enxerga o diretório do outro;
+- **leitor** identifica o parse que produziu o DataFrame. Leitores diferentes
+  podem devolver tipos diferentes para o mesmo arquivo, e o cache nunca deve
+  trocar um pelo outro.
+
+É dado clínico em disco, então o cache é deliberadamente curto: diretórios
+``0700``, arquivos ``0600``, vida máxima de ``UPLOAD_CACHE_TTL_MINUTES`` e
+teto de ``UPLOAD_CACHE_MB`` — as entradas menos usadas saem primeiro.
+``UPLOAD_CACHE_MB=0`` desliga o cache.
+
+Falha no cache nunca é erro de leitura: DataFrame que o Parquet não consegue
+representar (coluna com tipos misturados, nome de coluna não textual) apenas
+não é guardado, e entrada ilegível é apagada e lida de novo.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+
+from engine.dataset import Dataset, Transform, derived_key
+from security.config import get_config
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+_READER = re.compile(r"[a-z0-9_]{1,40}")
+_SUFFIX = ".parquet"
+
+
+def digest_bytes(conteudo: bytes) -> str:
+    return hashlib.sha256(conteudo).hexdigest()
+
+
+def _tenant_dir(tenant: str) -> Path:
+    # O nome do diretório é o hash da chave: ``org:12`` não é nome de arquivo
+    # portável, e o hash não revela quais laboratórios usam o servidor.
+    name = hashlib.sha256(str(tenant).encode("utf-8")).hexdigest()[:24]
+    return get_config().upload_cache_dir / name
+
+
+def _entry_path(tenant: str, digest: str, reader: str) -> Path:
+    if not _DIGEST.fullmatch(digest or "") or not _READER.fullmatch(reader or ""):
+        raise ValueError("Chave de cache inválida.")
+    return _tenant_dir(tenant) / f"{digest}.{reader}{_SUFFIX}"
+
+
+def _enabled() -> bool:
+    return get_config().upload_cache_mb > 0
+
+
+def lookup(tenant: str, digest: str, reader: str) -> Optional[Path]:
+    """Caminho da entrada válida para esta chave, ou ``None``. Conta como uso."""
+    if not _enabled():
+        return None
+    path = _entry_path(tenant, digest, reader)
+    try:
+        age = time.time() - path.stat().st_mtime
+    except OSError:
+        return None
+    if age > get_config().upload_cache_ttl_minutes * 60:
+        with contextlib.suppress(OSError):
+            path.unlink()
+        return None
+    # mtime marca o último uso: é o relógio da TTL e da ordem de despejo.
+    with contextlib.suppress(OSError):
+        os.utime(path)
+    return path
+
+
+def fetch(tenant: str, digest: str, reader: str) -> Optional[pd.DataFrame]:
+    """DataFrame guardado para esta chave, ou ``None``."""
+    path = lookup(tenant, digest, reader)
+    if path is None:
+        return None
+    try:
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path, memory_map=True).to_pandas()
+    except Exception:
+        with contextlib.suppress(OSError):
+            path.unlink()
+        return None
+
+
+def store(tenant: str, digest: str, reader: str, df: pd.DataFrame) -> None:
+    """Guarda ``df``; silencioso se o DataFrame não couber em Parquet."""
+    if not _enabled() or df is None:
+        return
+    path = _entry_path(tenant, digest, reader)
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df)
+    except Exception:
+        return
+
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    # Grava num temporário do mesmo diretório e renomeia: uma sessão que leia
+    # a entrada ao mesmo tempo vê o arquivo inteiro ou nenhum arquivo.
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        return
+    evict()
+
+
+def get_or_read(tenant: str, digest: str, reader: str, read: Callable[[], Optional[pd.DataFrame]]) -> Optional[pd.DataFrame]:
+    """Devolve a entrada do cache ou chama ``read()`` e guarda o resultado."""
+    df = fetch(tenant, digest, reader)
+    if df is None:
+        df = read()
+        store(tenant, digest, reader, df)
+    return df
+
+
+def open_dataset(tenant: str, digest: str, reader: str, read: Callable[[], Optional[pd.DataFrame]],
+                 transform: Optional[Transform] = None) -> Optional[Dataset]:
+    """
+    Como :func:`get_or_read`, mas devolve um :class:`~engine.dataset.Dataset`
+    apoiado na cópia em Parquet, sem materializar a tabela.
+
+    ``transform`` é aplicado a cada leitura do handle (ex.: normalização de
+    tipos) — nunca ao que é gravado no cache, que guarda o parse cru.
+
+    A impressão digital do handle é o SHA-256 mais o leitor: o mesmo ZIP lido
+    só no primeiro membro ou com todos eles são conteúdos diferentes, e os
+    caches indexados por ``Dataset.cache_key`` não podem confundi-los.
+    """
+    fingerprint = derived_key(digest, reader)
+    path = lookup(tenant, digest, reader)
+    if path is not None:
+        try:
+            return Dataset.from_parquet(path, fingerprint, transform)
+        except Exception:
+            with contextlib.suppress(OSError):
+                path.unlink()
+    df = read()
+    if df is None:
+        return None
+    store(tenant, digest, reader, df)
+    path = lookup(tenant, digest, reader)
+    if path is not None:
+        try:
+            return Dataset.from_parquet(path, fingerprint, transform)
+        except Exception:
+            pass
+    return Dataset.from_frame(df, fingerprint, transform)
+
+
+def evict(now: Optional[float] = None) -> None:
+    """
+    Apaga entradas vencidas e, se o total passar do teto, as menos usadas.
+
+    Percorre o cache inteiro (todos os laboratórios): o teto de bytes é do
+    disco do servidor, não de cada laboratório.
+    """
+    cfg = get_config()
+    root = cfg.upload_cache_dir
+    if not root.is_dir():
+        return
+    now = time.time() if now is None else now
+    ttl = cfg.upload_cache_ttl_minutes * 60
+
+    entries = []
+    for path in root.glob(f"*/*{_SUFFIX}"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if now - stat.st_mtime > ttl:
+            with contextlib.suppress(OSError):
+                path.unlink()
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cfg.upload_cache_bytes:
+            break
+        with contextlib.suppress(OSError):
+            path.unlink()
+        total -= size
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Leitura de XLSX em fluxo, sem o modelo de células do openpyxl.
+
+``pd.read_excel(engine="openpyxl")`` cria um objeto ``ReadOnlyCell`` (e um
+dicionário intermediário) para cada célula da planilha antes de o pandas
+converter o valor — num relatório de 40 MB são dezenas de milhões de
+objetos, e mais de um minuto de espera. Aqui o XML da aba é lido direto do
+ZIP com o ``expat``, em blocos, e cada linha sai como uma lista de valores
+Python já convertidos.
+
+O resultado é o mesmo do ``pd.read_excel`` com o openpyxl: as regras de
+conversão (número inteiro vira ``int``, data pelo formato do estilo, erro
+vira ``NaN``, célula vazia vira ``""``) e o ``TextParser`` do final são os
+mesmos, e os formatos de data vêm das próprias funções do openpyxl. Se o
+arquivo tiver algo que este leitor não entende, a leitura cai para o
+``pd.read_excel`` — nunca fica pior do que era.
+
+Com ``sheet_name=None`` as abas são lidas em processos paralelos (o parse
+é Python puro e segura o GIL), com o mesmo contexto ``spawn`` e a mesma
+volta para o sequencial de ``engine.export.serialize_strata``.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import posixpath
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Dict, Iterator, List, Optional, Union
+from xml.parsers import expat
+
+import numpy as np
+import pandas as pd
+
+Source = Union[str, bytes]
+
+# Bytes de XML descompactado entregues ao expat por vez.
+CHUNK_BYTES = 1 << 20
+
+# Abaixo deste total de XML das abas, subir processos custa mais que o parse.
+PARALLEL_MIN_BYTES = 8 << 20
+
+_REL_WORKSHEET = "/worksheet"
+_REL_SHARED_STRINGS = "/sharedStrings"
+_REL_STYLES = "/styles"
+
+
+class UnsupportedWorkbook(ValueError):
+    """Arquivo que este leitor não entende; quem chama cai para o openpyxl."""
+
+
+def _local(name: str) -> str:
+    # Geradores .NET gravam ``x:c`` em vez de ``c``; o prefixo não importa.
+    return name.rpartition(":")[2]
+
+
+def _parser() -> "expat.XMLParserType":
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1 << 16
+
+    # XLSX não tem DTD. Recusar qualquer DOCTYPE fecha a porta para expansão
+    # de entidades (billion laughs) vinda de arquivo enviado pelo usuário.
+    def _no_doctype(*_):
+        raise UnsupportedWorkbook("XLSX com DOCTYPE.")
+
+    parser.StartDoctypeDeclHandler = _no_doctype
+    return parser
+
+
+def _feed(parser, stream) -> None:
+    while True:
+        chunk = stream.read(CHUNK_BYTES)
+        parser.Parse(chunk, not chunk)
+        if not chunk:
+            return
+
+
+def _open_archive(source: Source) -> zipfile.ZipFile:
+    return zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+class _Workbook:
+    """Abas, textos compartilhados e estilos de data de um XLSX aberto."""
+
+    def __init__(self, archive: zipfile.ZipFile):
+        self.archive = archive
+        self.sheets: Dict[str, str] = {}
+        self.epoch_1904 = False
+        rels = self._relationships("xl/workbook.xml")
+
+        order: List[tuple] = []
+
+        def start(name, attrs):
+            tag = _local(name)
+            if tag == "sheet":
+                rid = next((v for k, v in attrs.items() if _local(k) == "id"), None)
+                order.append((attrs.get("name"), rid))
+            elif tag == "workbookPr":
+                self.epoch_1904 = attrs.get("date1904") in ("1", "true")
+
+        parser = _parser()
+        parser.StartElementHandler = start
+        with archive.open("xl/workbook.xml") as stream:
+            _feed(parser, stream)
+
+        for name, rid in order:
+            rel = rels.get(rid)
+            # Só abas de dados: chartsheet não tem células.
+            if rel is not None and rel[0].endswith(_REL_WORKSHEET):
+                self.sheets[name] = rel[1]
+
+        targets = {kind: target for kind, target in rels.values()}
+        self.shared_strings = self._read_shared_strings(
+            next((t for k, t in targets.items() if k.endswith(_REL_SHARED_STRINGS)), None))
+        self.date_styles = self._read_styles(
+            next((t for k, t in targets.items() if k.endswith(_REL_STYLES)), None))
+
+    def _relationships(self, part: str) -> Dict[str, tuple]:
+        folder, base = posixpath.split(part)
+        rels_path = posixpath.join(folder, "_rels", base + ".rels")
+        rels: Dict[str, tuple] = {}
+
+        def start(name, attrs):
+            if _local(name) == "Relationship" and attrs.get("TargetMode") != "External":
+                target = attrs.get("Target", "")
+                if target.startswith("/"):
+                    target = target[1:]
+                else:
+                    target = posixpath.normpath(posixpath.join(folder, target))
+                rels[attrs.get("Id")] = (attrs.get("Type", ""), target)
+
+        parser = _parser()
+        parser.StartElementHandler = start
+        try:
+            with self.archive.open(rels_path) as stream:
+                _feed(parser, stream)
+        except KeyError:
+            pass
+        return rels
+
+    def _read_shared_strings(self, part: Optional[str]) -> List[str]:
+        strings: List[str] = []
+        if part is None or part not in self.archive.namelist():
+            return strings
+        # Texto de ``<t>`` dentro de ``<si>``, exceto a leitura fonética
+        # (``<rPh>``), que o openpyxl também descarta.
+        state = {"phonetic": 0, "in_t": False}
+        parts: List[str] = []
+
+        def start(name, attrs):
+            tag = _local(name)
+            if tag == "si":
+                parts.clear()
+            elif tag == "rPh":
+                state["phonetic"] += 1
+            elif tag == "t" and not state["phonetic"]:
+                state["in_t"] = True
+
+        def end(name):
+            tag = _local(name)
+            if tag == "si":
+                strings.append("".join(parts).replace("x005F_", ""))
+            elif tag == "rPh":
+                state["phonetic"] -= 1
+            elif tag == "t":
+                state["in_t"] = False
+
+        def text(data):
+            if state["in_t"]:
+                parts.append(data)
+
+        parser = _parser()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text
+        with self.archive.open(part) as stream:
+            _feed(parser, stream)
+        return strings
+
+    def _read_styles(self, part: Optional[str]):
+        from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+
+        if part is None or part not in self.archive.namelist():
+            return frozenset()
+        custom: Dict[int, str] = {}
+        xf_formats: List[int] = []
+        state = {"cell_xfs": False}
+
+        def start(name, attrs):
+            tag = _local(name)
+            if tag == "numFmt":
+                custom[int(attrs.get("numFmtId", 0))] = attrs.get("formatCode", "")
+            elif tag == "cellXfs":
+                state["cell_xfs"] = True
+            elif tag == "xf" and state["cell_xfs"]:
+                xf_formats.append(int(attrs.get("numFmtId", 0)))
+
+        def end(name):
+            if _local(name) == "cellXfs":
+                state["cell_xfs"] = False
+
+        parser = _parser()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        with self.archive.open(part) as stream:
+            _feed(parser, stream)
+
+        # Formatos de duração (``[h]:mm``) também viram ``datetime``: o modo
+        # somente-leitura do openpyxl, usado pelo pandas, não os distingue.
+        return frozenset(idx for idx, fmt_id in enumerate(xf_formats)
+                         if is_date_format(custom.get(fmt_id, BUILTIN_FORMATS.get(fmt_id)) or ""))
+
+    def sheet_part(self, sheet: Union[int, str]) -> str:
+        names = list(self.sheets)
+        if isinstance(sheet, int):
+            if not 0 <= sheet < len(names):
+                raise ValueError(f"Worksheet index {sheet} is invalid, {len(names)} worksheets found")
+            return self.sheets[names[sheet]]
+        if sheet not in self.sheets:
+            raise ValueError(f"Worksheet named '{sheet}' not found")
+        return self.sheets[sheet]
+
+    def iter_rows(self, sheet: Union[int, str]) -> Iterator[list]:
+        """Linhas da aba, convertidas como no ``_convert_cell`` do pandas."""
+        from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+
+        epoch = CALENDAR_MAC_1904 if self.epoch_1904 else CALENDAR_WINDOWS_1900
+        shared = self.shared_strings
+        dates = self.date_styles
+        nan = np.nan
+
+        rows: List[list] = []
+        text: List[str] = []
+        columns: Dict[str, int] = {}
+        row: list = []
+        row_number = col = style = phonetic = 0
+        kind = "n"
+        # O que está sendo coletado: ``"v"``, ``"is"`` (texto em linha) ou ``None``.
+        mode = None
+        in_t = False
+
+        def column_index(ref: str) -> int:
+            letters = ref.rstrip("0123456789")
+            n = columns.get(letters)
+            if n is None:
+                n = 0
+                for ch in letters:
+                    n = n * 26 + ord(ch) - 64
+                columns[letters] = n
+            return n
+
+        def convert(kind, style, raw):
+            if kind == "n":
+                number = float(raw) if ("." in raw or "E" in raw or "e" in raw) else int(raw)
+                if style in dates:
+                    try:
+                        return from_excel(number, epoch)
+                    except (OverflowError, ValueError):
+                        return nan
+                as_int = int(number)
+                return as_int if as_int == number else float(number)
+            if kind == "s":
+                return shared[int(raw)]
+            if kind in ("str", "inlineStr"):
+                return raw
+            if kind == "b":
+                return bool(int(raw))
+            if kind == "e":
+                return nan
+            if kind == "d":
+                return from_ISO8601(raw)
+            return raw
+
+        def start(name, attrs):
+            nonlocal row, row_number, col, style, kind, mode, in_t, phonetic
+            tag = name if ":" not in name else _local(name)
+            if tag == "c":
+                ref = attrs.get("r")
+                col = column_index(ref) if ref else col + 1
+                kind = attrs.get("t", "n")
+                s = attrs.get("s")
+                style = int(s) if s else 0
+                mode = None
+            elif tag == "v":
+                if kind != "inlineStr":
+                    text.clear()
+                    mode = "v"
+            elif tag == "is":
+                text.clear()
+                mode = "is"
+            elif tag == "t":
+                in_t = True
+            elif tag == "rPh":
+                phonetic += 1
+            elif tag == "row":
+                number = attrs.get("r")
+                number = int(float(number)) if number else row_number + 1
+                # Linhas ausentes no XML viram linhas vazias, como no openpyxl.
+                for _ in range(row_number + 1, number):
+                    rows.append([])
+                row_number = number
+                col = 0
+                row = []
+
+        def end(name):
+            nonlocal mode, in_t, phonetic
+            tag = name if ":" not in name else _local(name)
+            if tag == "c":
+                if mode is None:
+                    return
+                if mode == "is":
+                    value = "".join(text)
+                elif kind == "inlineStr":
+                    return
+                else:
+                    value = convert(kind, style, "".join(text))
+                mode = None
+                width = len(row)
+                if col == width + 1:
+                    row.append(value)
+                elif col > width:
+                    row.extend([""] * (col - 1 - width))
+                    row.append(value)
+                else:
+                    row[col - 1] = value
+            elif tag == "v":
+                # ``<v></v>`` é célula vazia, como no ``findtext(...) or None``.
+                if mode == "v" and not text:
+                    mode = None
+            elif tag == "row":
+                rows.append(row)
+            elif tag == "t":
+                in_t = False
+            elif tag == "rPh":
+                phonetic -= 1
+
+        def chars(data):
+            if mode == "v" or (mode == "is" and in_t and not phonetic):
+                text.append(data)
+
+        parser = _parser()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = chars
+
+        with self.archive.open(self.sheet_part(sheet)) as stream:
+            while True:
+                chunk = stream.read(CHUNK_BYTES)
+                parser.Parse(chunk, not chunk)
+                if rows:
+                    yield from rows
+                    rows.clear()
+                if not chunk:
+                    return
+
+
+def sheet_names(source: Source) -> List[str]:
+    with _open_archive(source) as archive:
+        return list(_Workbook(archive).sheets)
+
+
+def iter_rows(source: Source, sheet: Union[int, str] = 0) -> Iterator[list]:
+    """
+    Linhas da aba, uma lista de valores por linha, sem montar a aba inteira.
+
+    As linhas têm o comprimento até a última célula preenchida; vazias no
+    meio vêm como ``""``.
+    """
+    with _open_archive(source) as archive:
+        yield from _Workbook(archive).iter_rows(sheet)
+
+
+def _frame(data: List[list]) -> pd.DataFrame:
+    # Mesmo acabamento do ``get_sheet_data`` do pandas: tira as células e as
+    # linhas vazias do fim e completa as linhas até a largura máxima.
+    last = -1
+    for idx, values in enumerate(data):
+        while values and values[-1] == "":
+            values.pop()
+        if values:
+            last = idx
+    data = data[:last + 1]
+    if not data:
+        return pd.DataFrame()
+    width = max(len(values) for values in data)
+    data = [values + [""] * (width - len(values)) if len(values) < width else values for values in data]
+
+    from pandas.errors import EmptyDataError
+    from pandas.io.parsers import TextParser
+
+    try:
+        return TextParser(data, header=0, skip_blank_lines=False).read()
+    except EmptyDataError:
+        return pd.DataFrame()
+
+
+def _read_one(source: Source, sheet: Union[int, str]) -> pd.DataFrame:
+    with _open_archive(source) as archive:
+        return _frame(list(_Workbook(archive).iter_rows(sheet)))
+
+
+def _read_many(source: Source, sheets: List[str], max_workers: Optional[int]) -> Dict[str, pd.DataFrame]:
+    with _open_archive(source) as archive:
+        book = _Workbook(archive)
+        xml_bytes = sum(archive.getinfo(book.sheet_part(name)).file_size for name in sheets)
+    workers = min(len(sheets), max_workers or os.cpu_count() or 1)
+    if workers > 1 and xml_bytes >= PARALLEL_MIN_BYTES:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                frames = pool.map(_read_one, [source] * len(sheets), sheets)
+                return dict(zip(sheets, frames))
+        except (BrokenProcessPool, OSError):
+            pass
+    return {name: _read_one(source, name) for name in sheets}
+
+
+def read_excel(source: Source, sheet_name: Union[int, str, None] = 0,
+               max_workers: Optional[int] = None) -> Union[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """
+    Substituto de ``pd.read_excel(source, sheet_name=..., engine="openpyxl")``.
+
+    ``sheet_name=None`` devolve ``{aba: DataFrame}`` com todas as abas, lidas
+    em paralelo quando o arquivo é grande o bastante. Arquivo que não é XLSX
+    (``.xls`` antigo) ou que este leitor não consegue interpretar vai para o
+    ``pd.read_excel``, que dá o mesmo resultado ou o mesmo erro de antes.
+    """
+    try:
+        if sheet_name is None:
+            return _read_many(source, sheet_names(source), max_workers)
+        return _read_one(source, sheet_name)
+    except (zipfile.BadZipFile, KeyError, UnsupportedWorkbook, expat.ExpatError, IndexError, ValueError):
+        pass
+    return pd.read_excel(io.BytesIO(source) if isinstance(source, bytes) else source,
+                         sheet_name=sheet_name, engine="openpyxl")
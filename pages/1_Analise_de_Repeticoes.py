@@ -27,12 +27,9 @@ de forma independente com ``streamlit run pages/1_Analise_de_Repeticoes.py``.
 """
 
 import hashlib
-import io
 import os
 import re
 import unicodedata
-import zipfile
-import tempfile
 
 import numpy as np
 import pandas as pd
@@ -60,10 +57,11 @@ except Exception:
 # Sem esta chamada, esta página seria acessível sem login por mais protegido que
 # o resto do app estivesse. Ela vem antes de qualquer leitura de arquivo.
 # --------------------------------------------------------------------------- #
-from security import audit, ratelimit, ui as security_ui  # noqa: E402
+from security import audit, ratelimit, tenancy, ui as security_ui  # noqa: E402
 from security.guard import hide_admin_nav, require_login  # noqa: E402
 from security.models import PERM_DATA_EXPORT, PERM_DATA_UPLOAD  # noqa: E402
 from security.uploads import secure_tempfile, validate_upload  # noqa: E402
+from engine import export as export_engine, numeric, readers, upload_cache, xlsx  # noqa: E402
 
 _user = require_login(page_name="Análise de Repetições")
 hide_admin_nav(_user)
@@ -205,35 +203,7 @@ def normalizar_serie_numerica(serie: pd.Series) -> pd.Series:
     decimal é o que aparece POR ÚLTIMO; o outro é tratado como milhar. Quando há
     apenas ",", ela é tratada como decimal (padrão brasileiro).
     """
-    def _conv(x):
-        if pd.isna(x):
-            return np.nan
-        s = str(x).strip()
-        if s == "" or s.lower() in ("nan", "none", "na", "n/a", "-", "--", "."):
-            return np.nan
-        # remove espaços (inclusive não separável) e mantém só dígitos/sinais/separadores
-        s = s.replace("\xa0", "").replace(" ", "")
-        s = re.sub(r"[^0-9,.\-+]", "", s)
-        if s in ("", "+", "-", ".", ","):
-            return np.nan
-        has_dot, has_comma = "." in s, "," in s
-        if has_dot and has_comma:
-            if s.rfind(",") > s.rfind("."):      # vírgula é o decimal
-                s = s.replace(".", "").replace(",", ".")
-            else:                                # ponto é o decimal
-                s = s.replace(",", "")
-        elif has_comma:                          # só vírgula -> decimal
-            s = s.replace(",", ".")
-        # se houver mais de um ponto (milhar tipo "1.234.567"), remove todos menos o último
-        if s.count(".") > 1:
-            partes = s.split(".")
-            s = "".join(partes[:-1]) + "." + partes[-1]
-        try:
-            return float(s)
-        except ValueError:
-            return np.nan
-
-    return serie.apply(_conv)
+    return numeric.parse_localized(serie)
 
 
 def parse_limite(txt: str):
@@ -299,7 +269,7 @@ def carregar_base_etm():
 
     try:
         if caminho.lower().endswith(".xlsx"):
-            abas = pd.read_excel(caminho, sheet_name=None, engine="openpyxl")
+            abas = xlsx.read_excel(caminho, sheet_name=None)
             base_db = None
             for d in abas.values():
                 d.columns = [str(c).strip() for c in d.columns]
@@ -342,48 +312,45 @@ def carregar_base_etm():
 # 2. Leitura robusta da planilha (csv / xlsx / xls / zip)
 # --------------------------------------------------------------------------- #
 def _ler_csv(path):
-    """Tenta o padrão brasileiro (;, decimal ,) e cai para (, decimal .)."""
-    try:
-        return pd.read_csv(path, sep=";", decimal=",", encoding="latin-1", engine="python")
-    except Exception:
-        return pd.read_csv(path, sep=",", decimal=".", encoding="utf-8", engine="python")
+    """
+    Lê com o leitor do app (``engine.readers``): separador, decimal e encoding
+    detectados numa amostra e um único parse com o PyArrow.
+    """
+    return readers.read_csv(path)
 
 
 # max_entries=4: mantém em cache as planilhas em uso (a análise usa até 2 ao mesmo
 # tempo), sem guardar para sempre todos os arquivos já enviados ao servidor.
 # A leitura e os valores são exatamente os mesmos.
 @st.cache_data(show_spinner="Lendo planilha...", max_entries=4)
-def carregar_planilha(conteudo: bytes, nome: str) -> pd.DataFrame:
-    """Recebe os bytes do arquivo enviado e devolve um DataFrame."""
+def carregar_planilha(_tenant: str, conteudo: bytes, nome: str) -> pd.DataFrame:
+    """
+    Recebe os bytes do arquivo enviado e devolve um DataFrame.
+
+    Por trás do cache em memória fica o cache de uploads em disco
+    (``engine.upload_cache``), endereçado pelo SHA-256 do conteúdo: a mesma
+    planilha reenviada — nesta ou em outra sessão do laboratório — é lida do
+    Parquet em vez de passar pelo parse de novo.
+    """
+    return upload_cache.get_or_read(_tenant, upload_cache.digest_bytes(conteudo), "repeticoes_v2",
+                                    lambda: _ler_planilha(conteudo, nome))
+
+
+def _ler_planilha(conteudo: bytes, nome: str) -> pd.DataFrame:
+    # secure_tempfile apaga no finally. Com NamedTemporaryFile (delete=False)
+    # + os.remove no fim do bloco, uma falha de leitura — planilha corrompida,
+    # coluna estranha — pulava a remoção e deixava a planilha clínica no disco
+    # do servidor.
     nome = nome.lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(nome)[1]) as tmp:
-        tmp.write(conteudo)
-        tmp_path = tmp.name
-    try:
+    with secure_tempfile(os.path.splitext(nome)[1]) as tmp_path:
+        with open(tmp_path, "wb") as tmp:
+            tmp.write(conteudo)
         if nome.endswith(".zip"):
-            with zipfile.ZipFile(tmp_path) as z:
-                validos = [f for f in z.namelist()
-                           if not f.startswith("__MACOSX/")
-                           and f.lower().endswith((".csv", ".xlsx", ".xls"))]
-                if not validos:
-                    raise ValueError("O ZIP não contém CSV ou Excel válidos.")
-                # secure_tempfile apaga no finally. Com NamedTemporaryFile
-                # (delete=False) + os.remove no fim do bloco, uma falha de
-                # leitura — planilha corrompida, coluna estranha — pulava a
-                # remoção e deixava a planilha clínica no disco do servidor.
-                with secure_tempfile(os.path.splitext(validos[0])[1]) as inner_path:
-                    with open(inner_path, "wb") as inner:
-                        inner.write(z.read(validos[0]))
-                    df = (_ler_csv(inner_path) if validos[0].lower().endswith(".csv")
-                          else pd.read_excel(inner_path, engine="openpyxl"))
-        elif nome.endswith(".csv"):
-            df = _ler_csv(tmp_path)
-        else:
-            df = pd.read_excel(tmp_path, engine="openpyxl")
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-    return df
+            # Primeiro membro válido, descompactado em fluxo (sem z.read).
+            return readers.read_zip(tmp_path)
+        if nome.endswith(".csv"):
+            return _ler_csv(tmp_path)
+        return xlsx.read_excel(tmp_path)
 
 
 def montar_datahora(df: pd.DataFrame, col_data: str | None, col_hora: str | None):
@@ -628,26 +595,7 @@ def to_excel(df: pd.DataFrame, cols_2dec=None) -> bytes:
     Exporta em .xlsx com todo o conteúdo centralizado, largura das colunas
     ajustada ao conteúdo (autofit) e 2 casas decimais nas colunas indicadas.
     """
-    from openpyxl.styles import Alignment
-    from openpyxl.utils import get_column_letter
-    cols_2dec = set(cols_2dec or [])
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Repeticoes")
-        ws = writer.sheets["Repeticoes"]
-        centro = Alignment(horizontal="center", vertical="center")
-        n = len(df)
-        for i, col in enumerate(df.columns, start=1):
-            letra = get_column_letter(i)
-            # autofit: largura = maior conteúdo/cabeçalho (limitada a 60)
-            largura = max([len(str(col))] + [len(str(v)) for v in df[col].values])
-            ws.column_dimensions[letra].width = min(largura + 2, 60)
-            for r in range(1, n + 2):                       # centraliza cabeçalho + dados
-                ws.cell(row=r, column=i).alignment = centro
-            if col in cols_2dec:                            # exibe 2 casas decimais
-                for r in range(2, n + 2):
-                    ws.cell(row=r, column=i).number_format = "0.00"
-    return output.getvalue()
+    return export_engine.excel_bytes(df, sheet_name="Repeticoes", centered=True, cols_2dec=cols_2dec, autofit=True)
 
 
 # =========================================================================== #
@@ -691,7 +639,7 @@ if not dois_relatorios:
         )
         st.stop()
     _checar_upload(arquivo, "planilha única")
-    df = carregar_planilha(arquivo.getvalue(), arquivo.name)
+    df = carregar_planilha(tenancy.tenant_cache_key(_user), arquivo.getvalue(), arquivo.name)
     if df is None or df.empty:
         st.error("Não foi possível ler a planilha ou ela está vazia.")
         st.stop()
@@ -782,8 +730,8 @@ else:
         st.stop()
     _checar_upload(arq1, "relatório original")
     _checar_upload(arq2, "relatório de repetição")
-    df1 = carregar_planilha(arq1.getvalue(), arq1.name)
-    df2 = carregar_planilha(arq2.getvalue(), arq2.name)
+    df1 = carregar_planilha(tenancy.tenant_cache_key(_user), arq1.getvalue(), arq1.name)
+    df2 = carregar_planilha(tenancy.tenant_cache_key(_user), arq2.getvalue(), arq2.name)
     if df1 is None or df1.empty or df2 is None or df2.empty:
         st.error("Não foi possível ler um dos relatórios (ou algum está vazio).")
         st.stop()
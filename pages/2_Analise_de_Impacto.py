@@ -52,6 +52,7 @@ except Exception:
 from security import audit, ratelimit, ui as security_ui  # noqa: E402
 from security.guard import hide_admin_nav, require_login  # noqa: E402
 from security.models import PERM_DATA_EXPORT, PERM_DATA_UPLOAD  # noqa: E402
+from engine import export as export_engine, numeric, readers, xlsx  # noqa: E402
 
 _user = require_login(page_name="Análise de Impacto")
 hide_admin_nav(_user)
@@ -226,32 +227,7 @@ APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # --------------------------------------------------------------------------- #
 def normalizar_serie_numerica(serie: pd.Series) -> pd.Series:
     """Converte texto/misto em float, aceitando vírgula ou ponto como decimal."""
-    def _conv(x):
-        if pd.isna(x):
-            return np.nan
-        s = str(x).strip()
-        if s == "" or s.lower() in ("nan", "none", "na", "n/a", "-", "--", "."):
-            return np.nan
-        s = s.replace("\xa0", "").replace(" ", "")
-        s = re.sub(r"[^0-9,.\-+]", "", s)
-        if s in ("", "+", "-", ".", ","):
-            return np.nan
-        has_dot, has_comma = "." in s, "," in s
-        if has_dot and has_comma:
-            if s.rfind(",") > s.rfind("."):
-                s = s.replace(".", "").replace(",", ".")
-            else:
-                s = s.replace(",", "")
-        elif has_comma:
-            s = s.replace(",", ".")
-        if s.count(".") > 1:
-            partes = s.split(".")
-            s = "".join(partes[:-1]) + "." + partes[-1]
-        try:
-            return float(s)
-        except ValueError:
-            return np.nan
-    return serie.apply(_conv)
+    return numeric.parse_localized(serie)
 
 
 def parse_ref_range(txt):
@@ -307,13 +283,23 @@ _COLS_ESPERADAS = ("Teste", "ETM", "IR")
 
 def _ler_tabela(conteudo: bytes, nome: str) -> pd.DataFrame:
     """
-    Lê CSV ou Excel a partir dos bytes. Para CSV, testa combinações de
-    separador/decimal/encoding e escolhe a primeira que traz as colunas
-    esperadas — evita 'mojibake' (UTF-8 lido como latin-1) e separador errado.
+    Lê CSV ou Excel a partir dos bytes. Para CSV, o dialeto é detectado numa
+    amostra e o arquivo é lido uma vez com o PyArrow (``engine.readers``). Só
+    se essa leitura falhar ou não trouxer as colunas esperadas — arquivo
+    malformado ou atípico — testa as combinações de separador/decimal/encoding
+    e escolhe a primeira que traz as colunas esperadas, evitando 'mojibake'
+    (UTF-8 lido como latin-1) e separador errado.
     """
     nome = (nome or "").lower()
     if nome.endswith((".xlsx", ".xls")):
-        return pd.read_excel(io.BytesIO(conteudo), engine="openpyxl")
+        return xlsx.read_excel(conteudo)
+    try:
+        df = readers.read_csv(conteudo)
+        df.columns = [str(c).strip() for c in df.columns]
+        if all(e in df.columns for e in _COLS_ESPERADAS):
+            return df
+    except Exception:
+        pass
     tentativas = [
         dict(sep=";", decimal=",", encoding="utf-8-sig"),
         dict(sep=";", decimal=",", encoding="latin-1"),
@@ -343,13 +329,13 @@ def carregar_base():
       - equipamentos: lista da aba **Equipamentos** (coluna **Equipamentos**);
         se não houver essa aba, cai para os valores únicos da coluna Equipamento.
     """
-    xlsx = os.path.join(APP_DIR, "Base de Dados.xlsx")
+    caminho_xlsx = os.path.join(APP_DIR, "Base de Dados.xlsx")
     csv = os.path.join(APP_DIR, "Base de Dados.csv")
     base, equipamentos = None, []
 
-    if os.path.exists(xlsx):
+    if os.path.exists(caminho_xlsx):
         try:
-            abas = pd.read_excel(xlsx, sheet_name=None, engine="openpyxl")
+            abas = xlsx.read_excel(caminho_xlsx, sheet_name=None)
         except Exception:
             abas = {}
         for _, d in abas.items():
@@ -384,25 +370,7 @@ def carregar_base():
 
 def to_excel(df: pd.DataFrame, cols_2dec=None) -> bytes:
     """Exporta .xlsx centralizado, com autofit e 2 casas nas colunas indicadas."""
-    from openpyxl.styles import Alignment
-    from openpyxl.utils import get_column_letter
-    cols_2dec = set(cols_2dec or [])
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Impacto")
-        ws = writer.sheets["Impacto"]
-        centro = Alignment(horizontal="center", vertical="center")
-        n = len(df)
-        for i, col in enumerate(df.columns, start=1):
-            letra = get_column_letter(i)
-            largura = max([len(str(col))] + [len(str(v)) for v in df[col].values])
-            ws.column_dimensions[letra].width = min(largura + 2, 60)
-            for r in range(1, n + 2):
-                ws.cell(row=r, column=i).alignment = centro
-            if col in cols_2dec:
-                for r in range(2, n + 2):
-                    ws.cell(row=r, column=i).number_format = "0.00"
-    return output.getvalue()
+    return export_engine.excel_bytes(df, sheet_name="Impacto", centered=True, cols_2dec=cols_2dec, autofit=True)
 
 
 def analisar_bloco(entrada: pd.DataFrame, teste, etm, ir_txt, lo, hi, zc_lo=None, zc_hi=None):
@@ -29,6 +29,9 @@ Chaves reconhecidas (prefixo ``DATASIFT_``)::
     DATASIFT_SESSION_REVALIDATE_SECONDS janela de revalidação da sessão (default 30)
     DATASIFT_REQUIRE_2FA_FOR_ADMIN    "1" exige TOTP para papéis administrativos
     DATASIFT_AUDIT_RETENTION_DAYS     retenção da auditoria (default 730)
+    DATASIFT_UPLOAD_CACHE_DIR         cache de uploads em Parquet (default <tmp>/datasift_uploads)
+    DATASIFT_UPLOAD_CACHE_TTL_MINUTES vida de cada entrada do cache de uploads (default 60)
+    DATASIFT_UPLOAD_CACHE_MB          teto do cache de uploads em disco, 0 desliga (default 1024)
 
 No Streamlit Community Cloud estas chaves vão em *Settings → Secrets*, que
 persistem mesmo quando o container é recriado. Como o disco lá é efêmero,
@@ -46,6 +49,7 @@ uma seção ``[datasift]``::
 from __future__ import annotations
 
 import os
+import tempfile
 from dataclasses import dataclass
 from functools import lru_cache
 from pathlib import Path
@@ -143,6 +147,10 @@ class SecurityConfig:
     require_2fa_for_admin: bool
     audit_retention_days: int
 
+    upload_cache_dir: Path
+    upload_cache_ttl_minutes: int
+    upload_cache_mb: int
+
     @property
     def max_upload_bytes(self) -> int:
         return self.max_upload_mb * 1024 * 1024
@@ -151,6 +159,10 @@ class SecurityConfig:
     def max_uncompressed_bytes(self) -> int:
         return self.max_uncompressed_mb * 1024 * 1024
 
+    @property
+    def upload_cache_bytes(self) -> int:
+        return self.upload_cache_mb * 1024 * 1024
+
     @property
     def is_postgres(self) -> bool:
         return bool(self.database_url)
@@ -205,6 +217,10 @@ def get_config() -> SecurityConfig:
     # Neon e Heroku já usam, e evita duplicar a mesma string em dois lugares.
     database_url = get_setting("DATABASE_URL") or os.environ.get("DATABASE_URL") or None
 
+    raw_cache_dir = get_setting("UPLOAD_CACHE_DIR")
+    upload_cache_dir = (Path(raw_cache_dir).expanduser() if raw_cache_dir
+                        else Path(tempfile.gettempdir()) / "datasift_uploads")
+
     return SecurityConfig(
         database_url=database_url,
         db_path=db_path,
@@ -226,4 +242,7 @@ def get_config() -> SecurityConfig:
         trusted_proxy_hops=max(1, _int("TRUSTED_PROXY_HOPS", 1)),
         require_2fa_for_admin=_bool("REQUIRE_2FA_FOR_ADMIN", False),
         audit_retention_days=_int("AUDIT_RETENTION_DAYS", 730),
+        upload_cache_dir=upload_cache_dir,
+        upload_cache_ttl_minutes=max(1, _int("UPLOAD_CACHE_TTL_MINUTES", 60)),
+        upload_cache_mb=max(0, _int("UPLOAD_CACHE_MB", 1024)),
     )
@@ -64,11 +64,21 @@ from .models import ROLE_SUPERADMIN, User
 # Chaves de ``st.session_state`` que carregam dados de planilha. São apagadas
 # no logout, na troca de conta e quando a sessão expira.
 _DATA_STATE_KEYS = (
-    "dados_salvos",
+    "dados_dataset",
+    "dados_fingerprint",
+    "filter_mask_cache",
+    "filter_rule_counts",
+    "stream_preview",
+    "filtered_rows",
     "id_arquivo_atual",
     "filtered_df",
+    "filtered_fingerprint",
+    "numeric_column_cache",
+    "numeric_view_cache",
+    "age_sex_summary_cache",
     "filtered_result",
     "stratified_results",
+    "stratified_export",
     "analysis_params",
     "analysis_results",
     "filter_rules",
@@ -26,6 +26,8 @@ from __future__ import annotations
 
 import contextlib
 import os
+import tempfile
+import weakref
 import zipfile
 from dataclasses import dataclass
 from typing import Optional
@@ -224,6 +226,29 @@ def _inspect_zip(uploaded_file, cfg) -> UploadCheck:
     return UploadCheck(True, detail={"entries": len(entries)})
 
 
+def _private_tempfile(suffix: str = "") -> str:
+    """Cria um temporário ``0600`` com sufixo higienizado e devolve o caminho."""
+    clean_suffix = ""
+    if suffix:
+        clean_suffix = "." + "".join(
+            ch for ch in str(suffix).lstrip(".") if ch.isalnum()
+        )[:10]
+
+    fd, path = tempfile.mkstemp(suffix=clean_suffix)
+    os.close(fd)
+    # mkstemp já cria com 0600, mas deixamos explícito: em host compartilhado
+    # é isto que impede outro processo de ler a planilha clínica.
+    with contextlib.suppress(OSError):
+        os.chmod(path, 0o600)
+    return path
+
+
+def _remove(path: str) -> None:
+    with contextlib.suppress(OSError):
+        if os.path.exists(path):
+            os.remove(path)
+
+
 @contextlib.contextmanager
 def secure_tempfile(suffix: str = ""):
     """
@@ -238,23 +263,31 @@ def secure_tempfile(suffix: str = ""):
     O sufixo é higienizado porque hoje vem de ``os.path.splitext`` do nome
     enviado pelo usuário.
     """
-    import tempfile
-
-    clean_suffix = ""
-    if suffix:
-        clean_suffix = "." + "".join(
-            ch for ch in str(suffix).lstrip(".") if ch.isalnum()
-        )[:10]
-
-    fd, path = tempfile.mkstemp(suffix=clean_suffix)
-    os.close(fd)
-    # mkstemp já cria com 0600, mas deixamos explícito: em host compartilhado
-    # é isto que impede outro processo de ler a planilha clínica.
-    with contextlib.suppress(OSError):
-        os.chmod(path, 0o600)
+    path = _private_tempfile(suffix)
     try:
         yield path
     finally:
-        with contextlib.suppress(OSError):
-            if os.path.exists(path):
-                os.remove(path)
+        _remove(path)
+
+
+class SessionFile:
+    """
+    Temporário que vive enquanto o objeto estiver no ``st.session_state``.
+
+    Para resultados grandes demais para ficar na memória da sessão (a saída
+    do filtro em streaming): o arquivo é ``0600`` como o do
+    :func:`secure_tempfile`, e é apagado quando o objeto é descartado —
+    chave removida no logout, resultado substituído, sessão encerrada — ou,
+    no máximo, quando o processo termina.
+    """
+
+    def __init__(self, suffix: str = ""):
+        self.path = _private_tempfile(suffix)
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def discard(self) -> None:
+        """Apaga o arquivo agora."""
+        self._finalizer()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Leitura de CSV com o dialeto detectado por amostra (engine.sniff + engine.readers)."""
+
+from engine import readers, sniff
+
+
+def _latin1_after_sample() -> bytes:
+    """CSV latin-1 cujo único byte não ASCII fica depois de ``SAMPLE_BYTES``."""
+    head = "Nome;Idade\n" + "ANA;30\n" * 12_000
+    assert len(head) > sniff.SAMPLE_BYTES
+    return (head + "JOSÉ;40\n").encode("latin-1")
+
+
+def test_ascii_sample_is_only_a_guess():
+    data = _latin1_after_sample()
+    dialect = sniff.sniff_bytes(data[:sniff.SAMPLE_BYTES])
+    assert dialect.encoding == "utf-8"
+    assert dialect.ascii_sample
+
+
+def test_latin1_byte_past_sample_from_bytes():
+    df = readers.read_csv(_latin1_after_sample())
+    assert (df["Nome"] == "ANA").sum() == 12_000
+    assert df["Nome"].iloc[-1] == "JOSÉ"
+
+
+def test_latin1_byte_past_sample_from_path(tmp_path):
+    path = tmp_path / "latin1.csv"
+    path.write_bytes(_latin1_after_sample())
+    df = readers.read_csv(str(path))
+    assert df["Nome"].iloc[-1] == "JOSÉ"
+    assert df["Idade"].iloc[-1] == 40
+
+
+def test_utf8_past_sample_is_kept():
+    data = ("Nome;Idade\n" + "ANA;30\n" * 12_000 + "JOSÉ;40\n").encode("utf-8")
+    df = readers.read_csv(data)
+    assert df["Nome"].iloc[-1] == "JOSÉ"
+
+
+def test_c_engine_falls_back_to_latin1():
+    data = _latin1_after_sample()
+    dialect = sniff.sniff_bytes(data[:sniff.SAMPLE_BYTES])
+    df = readers.read_csv(data, sniff.CsvDialect(dialect.sep, dialect.decimal, dialect.encoding, "c", True))
+    assert df["Nome"].iloc[-1] == "JOSÉ"